@@ -0,0 +1,116 @@
+import json
+import hashlib
+from typing import Literal, Sequence, TypeVar
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.mysql import insert
+from sqlmodel import Session, SQLModel, select
+
+"""
+Bulk upserts for MariaDB/MySQL.
+
+Syncing Canvas data used to create or update each row through the
+ORM one at a time and then refresh every row after committing, i.e.,
+several statements per row. ``bulk_upsert`` writes every row of a
+table with a single ``INSERT ... ON DUPLICATE KEY UPDATE`` statement
+instead, so a sync costs a handful of statements per table no
+matter how many rows it writes.
+
+Each upserted table needs a unique key over the columns used to
+identify its rows (e.g., ``(group_id, canvas_id)`` for assignments).
+"""
+
+ModelType = TypeVar("ModelType", bound=SQLModel)
+
+def get_content_hash(row : dict, columns : Sequence[str]) -> str:
+    """
+    Hash the values of the given columns of a row.
+    """
+    content = json.dumps([row.get(column) for column in columns], default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def bulk_upsert(
+    session : Session,
+    model : type[ModelType],
+    rows : list[dict],
+    key_columns : Sequence[str],
+    update_columns : Sequence[str],
+    hash_column : str | None = "content_hash",
+    options : Sequence = (),
+    returning : Literal["changed", "all"] | None = "changed"
+) -> list[ModelType]:
+    """
+    Insert or update many rows of a table at once.
+
+    1. If the table has a content hash column, one SELECT obtains
+       the stored hash of every row, and rows whose content has
+       not changed are skipped.
+    2. One ``INSERT ... ON DUPLICATE KEY UPDATE`` statement writes
+       every new or changed row.
+    3. One SELECT loads the new and changed rows (or every row, see
+       ``returning``), so that their IDs are available without
+       refreshing each row. It is skipped if no rows are returned.
+
+    NOTE: The session is not committed.
+
+    Args:
+        session (Session): SQLModel connection with the database.
+        model (type[ModelType]): The table model, e.g., ``Assignment``.
+        rows (list[dict]): The column values of each row. If several rows have the same key, the last one is used.
+        key_columns (Sequence[str]): The columns of a unique key which identifies each row.
+        update_columns (Sequence[str]): The columns to overwrite if a row already exists.
+        hash_column (str | None, optional): The column which stores a hash of the update columns, if any. Defaults to "content_hash".
+        options (Sequence, optional): Loader options for the returned rows, e.g., ``selectinload(Assignment.group)``. Defaults to none.
+        returning (Literal["changed", "all"] | None, optional):
+            Which rows to load and return after writing them: "changed" for the
+            new and changed rows, "all" for every given row (e.g., when their IDs
+            are needed), or None for none. Without a hash column, every row
+            counts as changed. Defaults to "changed".
+
+    Returns:
+        list[ModelType]: The rows selected by ``returning``, in the order they were given.
+    """
+    if not rows: return []
+
+    rows_by_key = {tuple(row[c] for c in key_columns) : dict(row) for row in rows}
+    keys = list(rows_by_key.keys())
+    key_clause = tuple_(*[getattr(model, c) for c in key_columns]).in_(keys)
+
+    changed_rows = list(rows_by_key.values())
+
+    if hash_column:
+        for row in changed_rows:
+            row[hash_column] = get_content_hash(row, update_columns)
+
+        stored = session.exec(
+            select(*[getattr(model, c) for c in key_columns], getattr(model, hash_column))
+            .where(key_clause)
+        ).all()
+        stored_hashes = {tuple(r[:-1]) : r[-1] for r in stored}
+
+        changed_rows = [
+            row for key, row in rows_by_key.items()
+            if stored_hashes.get(key) != row[hash_column]
+        ]
+
+    if changed_rows:
+        columns = [*update_columns, *([hash_column] if hash_column else [])]
+        statement = insert(model).values(changed_rows)
+        statement = statement.on_duplicate_key_update(
+            {column : statement.inserted[column] for column in columns}
+        )
+        session.execute(statement)
+
+    if returning == "changed":
+        keys = [tuple(row[c] for c in key_columns) for row in changed_rows]
+        key_clause = tuple_(*[getattr(model, c) for c in key_columns]).in_(keys)
+
+    if returning is None or not keys: return []
+
+    results = session.exec(
+        select(model)
+        .where(key_clause)
+        .options(*options)
+        .execution_options(populate_existing=True)
+    ).all()
+    results_by_key = {tuple(getattr(r, c) for c in key_columns) : r for r in results}
+    return [results_by_key[key] for key in keys if key in results_by_key]
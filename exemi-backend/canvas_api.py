@@ -1,14 +1,387 @@
+import os
+import asyncio
 import httpx
 import requests
 import json
 import pandas as pd
 from datetime import datetime, timezone
 from fastapi import HTTPException
+from pydantic import TypeAdapter
+from typing import AsyncGenerator
+from dotenv import load_dotenv
+from .canvas_cache import canvas_cache, get_cache_key
+from .canvas_providers import provider_resolver, CircuitOpenError
+from .canvas_singleflight import canvas_single_flight
+from .canvas_ratelimit import canvas_rate_limiter, is_throttled, get_backoff, CANVAS_RATE_RETRIES
 
 """
 Decodes Canvas API responses into strings for downstream use.
 """
 
+load_dotenv()
+
+# Connection pool settings for the Canvas API clients.
+# These can be overridden in the .env file.
+CANVAS_MAX_CONNECTIONS = int(os.environ.get("CANVAS_MAX_CONNECTIONS", 20))
+CANVAS_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("CANVAS_MAX_KEEPALIVE_CONNECTIONS", 10))
+CANVAS_KEEPALIVE_EXPIRY = float(os.environ.get("CANVAS_KEEPALIVE_EXPIRY", 30))
+CANVAS_HTTP2 = os.environ.get("CANVAS_HTTP2", "true").lower() != "false"
+CANVAS_RETRIES = int(os.environ.get("CANVAS_RETRIES", 3))
+
+class CanvasClientPool:
+    """
+    Long-lived HTTP clients for the Canvas API, one per provider host
+    (e.g., "swinburne.instructure.com").
+
+    Creating a new ``httpx.AsyncClient`` for every request means a
+    new TCP and TLS handshake with Canvas every time. Instead, each
+    provider host gets a single client which is reused for every
+    request to that host, keeping connections alive between requests
+    and multiplexing concurrent requests over HTTP/2.
+
+    Clients are created lazily the first time a provider is queried
+    and are closed when the application shuts down (see ``main.lifespan``).
+    """
+
+    def __init__(
+        self,
+        max_connections : int = CANVAS_MAX_CONNECTIONS,
+        max_keepalive_connections : int = CANVAS_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry : float = CANVAS_KEEPALIVE_EXPIRY,
+        http2 : bool = CANVAS_HTTP2,
+        retries : int = CANVAS_RETRIES
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.http2 = http2
+        self.retries = retries
+        self._clients : dict[str, httpx.AsyncClient] = {}
+
+    def get(self, provider : str) -> httpx.AsyncClient:
+        """
+        Obtain the shared client for a given Canvas provider,
+        creating it if it does not exist yet.
+
+        Args:
+            provider (str): The name of the institution which has installed Canvas in lowercase.
+
+        Returns:
+            httpx.AsyncClient: The client for "https://{provider}.instructure.com/api/v1/".
+        """
+        client = self._clients.get(provider)
+        if client is not None and not client.is_closed:
+            return client
+
+        # NOTE: When a transport is given, httpx ignores the client's
+        # own http2/limits arguments, so they must be set on the transport.
+        transport = httpx.AsyncHTTPTransport(
+            retries=self.retries,
+            http2=self.http2,
+            limits=self.limits
+        )
+
+        client = httpx.AsyncClient(
+            base_url=f"https://{provider}.instructure.com/api/v1/",
+            transport=transport
+        )
+        self._clients[provider] = client
+        return client
+
+    async def aclose(self):
+        """
+        Close every client and release their connections.
+        """
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+canvas_clients = CanvasClientPool()
+
+def get_canvas_client(provider : str) -> httpx.AsyncClient:
+    """
+    Obtain the app-wide pooled HTTP client for a given Canvas provider.
+    """
+    return canvas_clients.get(provider)
+
+async def _send_get(
+    client : httpx.AsyncClient,
+    provider : str,
+    url : str | httpx.URL,
+    params : dict | None,
+    magic : str,
+    timeout : int
+) -> httpx.Response:
+    """
+    Send a GET request to Canvas, revalidating any cached copy
+    of the response with a conditional request (see ``canvas_cache``).
+
+    Server errors (5xx) and connection failures are counted by the
+    provider's circuit breaker (see ``canvas_providers``).
+
+    Requests are paced to fit the access token's Canvas rate limit
+    (see ``canvas_ratelimit``), and requests which Canvas rejects
+    for exceeding the rate limit are retried ``CANVAS_RATE_RETRIES``
+    times with jittered exponential backoff.
+
+    If Canvas responds with ``304 Not Modified``, the cached response
+    is returned as a 200 response instead. Responses backed by the
+    cache carry their cache entry in ``response.extensions["canvas_cache_entry"]``
+    so that previously validated items can be reused.
+
+    Args:
+        client (httpx.AsyncClient): The pooled client for the provider.
+        provider (str): The name of the provider the request is sent to.
+        url (str | httpx.URL): The Canvas API path or full URL to request.
+        params (dict | None): Request parameters, if any.
+        magic (str): The Canvas access token used for the request.
+        timeout (int): How many seconds to allow the API to respond before timing out.
+
+    Raises:
+        CircuitOpenError: If the provider's circuit breaker is open.
+
+    Returns:
+        httpx.Response: The (possibly cached) response.
+    """
+    key = get_cache_key(
+        provider=provider,
+        path=str(httpx.URL(url).copy_remove_param("access_token")),
+        params=params,
+        magic=magic
+    )
+    entry = canvas_cache.get(key)
+    headers = entry.conditional_headers if entry else {}
+
+    breaker = provider_resolver.breaker(provider)
+    budget = canvas_rate_limiter.budget(magic)
+
+    for attempt in range(CANVAS_RATE_RETRIES + 1):
+        if not breaker.acquire(): raise CircuitOpenError(provider)
+
+        async with budget.slot():
+            try:
+                response = await client.get(url, params=params, headers=headers, timeout=timeout)
+            except httpx.TransportError:
+                breaker.record_failure()
+                raise
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            budget.update(response.headers)
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        if not is_throttled(response): break
+
+        budget.record_throttled()
+        if attempt < CANVAS_RATE_RETRIES:
+            await asyncio.sleep(get_backoff(attempt))
+
+    if response.status_code == 304 and entry is not None:
+        canvas_cache.record(entry, not_modified=True)
+        return httpx.Response(
+            200,
+            headers=entry.headers,
+            content=entry.body,
+            request=response.request,
+            extensions={"canvas_cache_entry" : entry}
+        )
+
+    if response.status_code == 200:
+        canvas_cache.record(entry, not_modified=False)
+        entry = canvas_cache.store(
+            key,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+            link=response.headers.get("Link"),
+            body=response.content
+        )
+        if entry is not None:
+            response.extensions["canvas_cache_entry"] = entry
+
+    return response
+
+def _validate_page(response : httpx.Response, adapter : TypeAdapter | None) -> list:
+    """
+    Parse a page of Canvas results, reusing the items
+    already validated from the cached response if
+    Canvas reported that the page has not changed.
+    """
+    if adapter is None:
+        return json.loads(response.content)
+
+    entry = response.extensions.get("canvas_cache_entry")
+    if entry is not None:
+        return canvas_cache.validate(entry, adapter)
+
+    return adapter.validate_json(response.content)
+
+async def _get_from_provider(
+    provider : str,
+    path : str,
+    params : dict,
+    timeout : int
+) -> tuple[httpx.Response | None, HTTPException | None]:
+    """
+    Send a GET request to a single Canvas provider.
+
+    Returns:
+        response (httpx.Response | None): The response if it was successful, otherwise None.
+        error (HTTPException | None): The reason the request failed, if it failed.
+    """
+    url = f"https://{provider}.instructure.com/api/v1/{path}"
+
+    try:
+        response = await _send_get(
+            client=get_canvas_client(provider),
+            provider=provider,
+            url=path,
+            params=params,
+            magic=params["access_token"],
+            timeout=timeout
+        )
+    except httpx.TimeoutException:
+        return (None, HTTPException(
+            status_code = 408,
+            detail = f"{provider.capitalize()} Canvas API GET request timed out after {timeout} seconds. Request URL: {url}"
+        ))
+    except CircuitOpenError:
+        return (None, HTTPException(
+            status_code = 503,
+            detail = f"{provider.capitalize()} Canvas API is currently unavailable. Please try again later."
+        ))
+    except httpx.TransportError as e:
+        return (None, HTTPException(
+            status_code = 502,
+            detail = f"Error connecting to the {provider.capitalize()} Canvas API: {str(e)}"
+        ))
+
+    if not response.status_code == 200:
+        return (None, HTTPException(
+            status_code = response.status_code,
+            detail=response.text
+        ))
+
+    if not response.content:
+        return (None, HTTPException(status_code=400, detail="Canvas API response contained no content"))
+
+    return (response, None)
+
+async def _get_from_providers(
+    path : str,
+    params : dict,
+    providers : list[str],
+    timeout : int
+) -> tuple[httpx.Response, str]:
+    """
+    Send a GET request to the first Canvas provider in a list
+    which responds successfully.
+
+    Providers are tried in the order given by ``provider_resolver``:
+    the provider which last accepted the access token is tried first,
+    and providers whose circuit breaker is open are skipped. If a
+    provider fails, the next provider is tried straight away. If a
+    provider is slow to respond (``CANVAS_HEDGE_DELAY``), the next
+    provider is also tried in parallel and whichever responds
+    successfully first is used.
+
+    Args:
+        path (str): The Canvas v1 API path suffix.
+        params (dict): Request parameters, including the access token.
+        providers (list[str]): Canvas providers to try in order.
+        timeout (int): How many seconds to allow each provider to respond before timing out.
+
+    Raises:
+        HTTPException: If no provider returns status 200, the error from the last provider tried is raised.
+
+    Returns:
+        response (httpx.Response): The successful response.
+        provider (str): The name of the provider which responded.
+    """
+    magic = params["access_token"]
+    remaining = provider_resolver.order(providers, magic)
+
+    pending : dict[asyncio.Task, str] = {}
+    errors : dict[str, HTTPException] = {}
+    tried : list[str] = []
+
+    def try_next_provider():
+        provider = remaining.pop(0)
+        tried.append(provider)
+        task = asyncio.create_task(
+            _get_from_provider(provider=provider, path=path, params=params, timeout=timeout)
+        )
+        pending[task] = provider
+
+    try_next_provider()
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending.keys(),
+                timeout=provider_resolver.hedge_delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            # The current provider is slow, so hedge
+            # by trying the next provider as well.
+            if not done:
+                try_next_provider()
+                continue
+
+            for task in done:
+                provider = pending.pop(task)
+                response, error = task.result()
+
+                if response is not None:
+                    provider_resolver.remember(magic, provider)
+                    return (response, provider)
+
+                provider_resolver.forget(magic, provider)
+                errors[provider] = error
+
+            if remaining and len(pending) == 0:
+                try_next_provider()
+    finally:
+        # Cancel any slower requests which lost the race.
+        for task in pending:
+            task.cancel()
+
+    raise errors[tried[-1]]
+
+async def find_canvas_provider(
+    magic : str,
+    providers : list[str],
+    timeout : int = 15
+) -> str | None:
+    """
+    Find which of a list of Canvas providers accepts a given access token.
+
+    Args:
+        magic (str): The Canvas access token to verify.
+        providers (list[str]): Canvas providers to try in order.
+        timeout (int, optional): How many seconds to allow each provider to respond before timing out. Defaults to 15.
+
+    Returns:
+        provider (str | None): Name of the provider which accepted the token, if any, otherwise None.
+    """
+    try:
+        _, provider = await _get_from_providers(
+            path="users/self",
+            params={"access_token" : magic},
+            providers=providers,
+            timeout=timeout
+        )
+    except HTTPException:
+        return None
+    return provider
+
 async def query_canvas(
     path : str,
     magic : str,
@@ -16,13 +389,19 @@ async def query_canvas(
     fallback_providers : list[str] = [],
     params : dict = {},
     max_items : int = 100,
-    timeout : int = 60,
-    retries : int = 3
+    timeout : int = 60
 ) -> (str, str):
     """
     Obtain data from the Canvas API using a HTTP GET request.
     See https://developerdocs.instructure.com/services/canvas/resources for more information.
 
+    Requests are sent through the app-wide Canvas client pool
+    (see ``CanvasClientPool``), which retries failed connections
+    ``CANVAS_RETRIES`` times.
+
+    NOTE: Only the first page of results is returned.
+    Use ``query_canvas_pages`` to obtain every page of a list resource.
+
     Args:
         path (str): The Canvas v1 API path suffix. E.g., "courses" for "provider.instructure.com/api/v1/courses"
         magic (str): The magic key generated by the wizard to enter the gate.
@@ -31,11 +410,10 @@ async def query_canvas(
         params (dict, optional): Additional request parameters for the API to use. Specific to each resource. Defaults to an empty dictionary.
         max_items (int, optional): The maximum number of items to return. Defaults to 100.
         timeout (int, optional): How many seconds to allow the API to respond before timing out. Defaults to 60.
-        retries (int, optional): How many times to reattempt the request if it fails. Defaults to 3.
 
     Raises:
         HTTPException: If the request does not return status 200 or times out, a HTTPException is raised.
-    
+
     Returns:
         data (str): The response from Canvas as a UTF-8 decoded string.
         active_university_name (str):
@@ -46,50 +424,225 @@ async def query_canvas(
             'fallback_providers' list may have been used instead.
     """
 
-    providers = [provider, *fallback_providers]
-    
+    providers = [p for p in [provider, *fallback_providers] if p]
+
     if not providers: raise HTTPException(status_code=400, detail="To query canvas, you must have a university assigned")
-    
-    params["access_token"] = magic
-    params["per_page"] = max_items
-
-    for i, provider in enumerate(providers):
-        is_last_provider = i == len(providers) - 1
-        
-        url = f"https://{provider}.instructure.com/api/v1/{path}"
-
-        transport = httpx.AsyncHTTPTransport(retries=retries)
-    
-        try:
-            async with httpx.AsyncClient(timeout=timeout, transport=transport) as client:
-                response = await client.get(url, params=params)
-        except httpx.ReadTimeout:
-            if not is_last_provider: continue
-            raise HTTPException(
-                status_code = 408,
-                detail = f"{provider.capitalize()} Canvas API GET request timed out after {timeout} seconds. Request URL: {url}"
-            )
-        
-        if not response.status_code == 200:
-            if not is_last_provider: continue
-            raise HTTPException(
-                status_code = response.status_code,
-                detail=response.text
-            )
 
-        content = None
-        try:
-            content = response.content
-        except:
-            content = None
-    
-        # Canvas API will always respond in JSON format,
-        # but we obtain the response in bytes, so it
-        # must be decoded into a raw string.
-
-        if content:
-            data = content.decode('utf-8')
-            return (data, provider)
-        else:
-            if not is_last_provider: continue
-            raise HTTPException(status_code=400, detail="Canvas API response contained no content")
\ No newline at end of file
+    # Copy the parameters so the caller's dictionary
+    # (or the shared default) is never modified.
+    params = {**params, "access_token" : magic, "per_page" : max_items}
+
+    response, provider = await _get_from_providers(
+        path=path,
+        params=params,
+        providers=providers,
+        timeout=timeout
+    )
+
+    # Canvas API will always respond in JSON format,
+    # but we obtain the response in bytes, so it
+    # must be decoded into a raw string.
+    data = response.content.decode('utf-8')
+    return (data, provider)
+
+async def _get_next_page(
+    client : httpx.AsyncClient,
+    provider : str,
+    url : str,
+    magic : str,
+    timeout : int
+) -> httpx.Response:
+    """
+    Obtain the next page of a paginated Canvas response from the
+    URL given by its ``Link: <url>; rel="next"`` header.
+
+    Canvas does not include the access token in pagination links,
+    so it is added back onto the URL here.
+    """
+    url = httpx.URL(url).copy_set_param("access_token", magic)
+
+    try:
+        response = await _send_get(
+            client=client,
+            provider=provider,
+            url=url,
+            params=None,
+            magic=magic,
+            timeout=timeout
+        )
+    except httpx.TimeoutException:
+        raise HTTPException(
+            status_code = 408,
+            detail = f"Canvas API GET request timed out after {timeout} seconds. Request URL: {url.copy_remove_param('access_token')}"
+        )
+    except CircuitOpenError:
+        raise HTTPException(
+            status_code = 503,
+            detail = f"{provider.capitalize()} Canvas API is currently unavailable. Please try again later."
+        )
+    except httpx.TransportError as e:
+        # _send_get has already counted the failure with the provider's breaker
+        raise HTTPException(
+            status_code = 502,
+            detail = f"Error connecting to the {provider.capitalize()} Canvas API: {str(e)}"
+        )
+
+    if not response.status_code == 200:
+        raise HTTPException(
+            status_code = response.status_code,
+            detail=response.text
+        )
+
+    return response
+
+async def query_canvas_pages(
+    path : str,
+    magic : str,
+    provider : str | None,
+    fallback_providers : list[str] = [],
+    params : dict = {},
+    adapter : TypeAdapter | None = None,
+    per_page : int = 100,
+    timeout : int = 60,
+    prefetch : bool = True
+) -> AsyncGenerator[tuple[list, str], None]:
+    """
+    Obtain every page of a Canvas API list resource by following the
+    ``Link: <url>; rel="next"`` headers of each response, yielding
+    the items of each page as they arrive.
+
+    Each page is validated straight from the response bytes, so
+    only one page of raw response data is held in memory at a time.
+    Pages which Canvas reports as unchanged since they were last
+    downloaded (see ``canvas_cache``) are not validated again.
+    While a page is being validated, the next page can be downloaded
+    in the background.
+
+    See https://developerdocs.instructure.com/services/canvas/basics/file.pagination for more information.
+
+    Args:
+        path (str): The Canvas v1 API path suffix. E.g., "courses" for "provider.instructure.com/api/v1/courses"
+        magic (str): The magic key generated by the wizard to enter the gate.
+        provider (str): The name of the institution which has installed Canvas in lowercase.
+        fallback_providers (str, optional): List of backup Canvas providers to use in case the first provider fails (most likely a 401). Defaults to an empty list.
+        params (dict, optional): Additional request parameters for the API to use. Specific to each resource. Defaults to an empty dictionary.
+        adapter (TypeAdapter | None, optional): Pydantic adapter used to validate each page, e.g., ``TypeAdapter(list[CanvasUnit])``. If not given, each page is parsed as plain JSON. Defaults to None.
+        per_page (int, optional): The number of items to request per page. Defaults to 100.
+        timeout (int, optional): How many seconds to allow the API to respond to each page before timing out. Defaults to 60.
+        prefetch (bool, optional): Whether to download the next page while the current page is being processed. Defaults to True.
+
+    Raises:
+        HTTPException: If any page does not return status 200 or times out, a HTTPException is raised.
+
+    Yields:
+        items (list): The validated items of the next page.
+        active_university_name (str): The name of the university which was used to retrieve this data (see ``query_canvas``).
+    """
+
+    providers = [p for p in [provider, *fallback_providers] if p]
+
+    if not providers: raise HTTPException(status_code=400, detail="To query canvas, you must have a university assigned")
+
+    params = {**params, "access_token" : magic, "per_page" : per_page}
+
+    # The first page determines which provider is used for the rest of the pages.
+    response, active_provider = await _get_from_providers(
+        path=path,
+        params=params,
+        providers=providers,
+        timeout=timeout
+    )
+
+    client = get_canvas_client(active_provider)
+    next_page : asyncio.Task | None = None
+
+    try:
+        while True:
+            next_url : str | None = response.links.get("next", {}).get("url")
+
+            if next_url and prefetch:
+                next_page = asyncio.create_task(
+                    _get_next_page(client=client, provider=active_provider, url=next_url, magic=magic, timeout=timeout)
+                )
+
+            items = _validate_page(response, adapter)
+
+            # Release the raw page before the next one is processed.
+            response = None
+
+            yield (items, active_provider)
+
+            if not next_url: return
+
+            if next_page is not None:
+                response = await next_page
+                next_page = None
+            else:
+                response = await _get_next_page(client=client, provider=active_provider, url=next_url, magic=magic, timeout=timeout)
+    finally:
+        # Stop downloading the next page if the
+        # caller stops consuming pages early.
+        if next_page is not None:
+            next_page.cancel()
+
+async def query_canvas_all(
+    path : str,
+    magic : str,
+    provider : str | None,
+    fallback_providers : list[str] = [],
+    params : dict = {},
+    adapter : TypeAdapter | None = None,
+    per_page : int = 100,
+    timeout : int = 60
+) -> tuple[list, str]:
+    """
+    Obtain every item of a Canvas API list resource (see ``query_canvas_pages``).
+
+    Identical requests which are in flight at the same time, or which
+    were already made in the current request scope, share a single
+    result instead of each being sent to Canvas (see ``canvas_singleflight``).
+
+    Args:
+        path (str): The Canvas v1 API path suffix. E.g., "courses" for "provider.instructure.com/api/v1/courses"
+        magic (str): The magic key generated by the wizard to enter the gate.
+        provider (str): The name of the institution which has installed Canvas in lowercase.
+        fallback_providers (str, optional): List of backup Canvas providers to use in case the first provider fails (most likely a 401). Defaults to an empty list.
+        params (dict, optional): Additional request parameters for the API to use. Specific to each resource. Defaults to an empty dictionary.
+        adapter (TypeAdapter | None, optional): Pydantic adapter used to validate each page. Defaults to None.
+        per_page (int, optional): The number of items to request per page. Defaults to 100.
+        timeout (int, optional): How many seconds to allow the API to respond to each page before timing out. Defaults to 60.
+
+    Raises:
+        HTTPException: If any page does not return status 200 or times out, a HTTPException is raised.
+
+    Returns:
+        items (list): Every validated item. The items themselves are shared between callers and must not be modified.
+        active_university_name (str): The name of the university which was used to retrieve this data (see ``query_canvas``).
+    """
+    providers = [p for p in [provider, *fallback_providers] if p]
+
+    key = get_cache_key(
+        provider=",".join(providers),
+        path=path,
+        params={**params, "per_page" : per_page, "adapter" : id(adapter)},
+        magic=magic
+    )
+
+    async def fetch() -> tuple[list, str]:
+        items = []
+        active_university_name = None
+        async for page, active_university_name in query_canvas_pages(
+            path=path,
+            magic=magic,
+            provider=provider,
+            fallback_providers=fallback_providers,
+            params=params,
+            adapter=adapter,
+            per_page=per_page,
+            timeout=timeout
+        ):
+            items.extend(page)
+        return (items, active_university_name)
+
+    items, active_university_name = await canvas_single_flight.do(key, fetch)
+    return (list(items), active_university_name)
@@ -0,0 +1,347 @@
+import os
+import copy
+import json
+import time
+import hashlib
+from collections import OrderedDict
+from pydantic import BaseModel, TypeAdapter
+from dotenv import load_dotenv
+
+"""
+Conditional-request (ETag / Last-Modified) cache for Canvas API GET requests.
+
+Most Canvas syncs download payloads which are identical to the
+last sync. By remembering the ETag and Last-Modified headers of
+each response alongside its body, the next request for the same
+resource can ask Canvas whether anything has changed
+(If-None-Match / If-Modified-Since). If Canvas responds with
+``304 Not Modified``, the cached body - and the pydantic models
+already validated from it - are reused instead.
+
+The disk mirror holds the same entries as the memory cache: evicted
+entries are deleted from disk, and on startup the directory is pruned
+to the newest CANVAS_CACHE_MAX_ENTRIES responses within
+CANVAS_CACHE_MAX_BYTES. Cached responses contain students'
+submissions and grades, so the files are only readable by the
+backend's user.
+"""
+
+load_dotenv()
+
+# Cache settings. These can be overridden in the .env file.
+CANVAS_CACHE_MAX_ENTRIES = int(os.environ.get("CANVAS_CACHE_MAX_ENTRIES", 512))
+CANVAS_CACHE_TTL = float(os.environ.get("CANVAS_CACHE_TTL", 60 * 60 * 24))
+CANVAS_CACHE_MAX_BYTES = int(os.environ.get("CANVAS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CANVAS_CACHE_DIR = os.environ.get("CANVAS_CACHE_DIR") or None
+
+def hash_magic(magic : str) -> str:
+    """
+    Hash a Canvas access token so that it can be used
+    as part of a cache key without storing the token itself.
+    """
+    return hashlib.sha256(magic.encode("utf-8")).hexdigest()
+
+def get_cache_key(
+    provider : str,
+    path : str,
+    params : dict | None,
+    magic : str
+) -> str:
+    """
+    Create a cache key for a Canvas GET request.
+
+    Args:
+        provider (str): The Canvas provider the request is sent to.
+        path (str): The Canvas API path or, for subsequent pages, the full page URL without the access token.
+        params (dict | None): The request parameters. The access token is excluded from the key.
+        magic (str): The Canvas access token used for the request. Only its hash is used.
+
+    Returns:
+        str: The cache key.
+    """
+    params = {k : v for k, v in (params or {}).items() if k != "access_token"}
+    key = json.dumps(
+        [provider, path, sorted(params.items(), key=lambda p: p[0]), hash_magic(magic)],
+        default=str
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class CanvasCacheEntry:
+    """
+    A cached Canvas response.
+
+    Attributes:
+        etag (str | None): The ETag header of the response.
+        last_modified (str | None): The Last-Modified header of the response.
+        link (str | None): The Link header of the response, used for pagination.
+        body (bytes): The raw response body.
+        stored_at (float): When the response was cached (UNIX time).
+        parsed (dict): Items previously validated from the body, keyed by the adapter used to validate them.
+    """
+    def __init__(
+        self,
+        etag : str | None,
+        last_modified : str | None,
+        link : str | None,
+        body : bytes,
+        stored_at : float | None = None
+    ):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.link = link
+        self.body = body
+        self.stored_at = stored_at if stored_at is not None else time.time()
+        self.parsed : dict[int, object] = {}
+
+    @property
+    def headers(self) -> dict[str, str]:
+        """
+        Response headers to restore when serving this entry.
+        """
+        headers = {}
+        if self.etag: headers["ETag"] = self.etag
+        if self.last_modified: headers["Last-Modified"] = self.last_modified
+        if self.link: headers["Link"] = self.link
+        return headers
+
+    @property
+    def conditional_headers(self) -> dict[str, str]:
+        """
+        Request headers which ask Canvas to respond with
+        ``304 Not Modified`` if this entry is still current.
+        """
+        headers = {}
+        if self.etag: headers["If-None-Match"] = self.etag
+        if self.last_modified: headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class CanvasResponseCache:
+    """
+    LRU cache of Canvas responses with a time-to-live,
+    held in memory and optionally mirrored on disk.
+
+    Args:
+        max_entries (int, optional): Maximum number of responses held in memory (and on disk). Defaults to CANVAS_CACHE_MAX_ENTRIES.
+        ttl (float, optional): How many seconds a response may be cached for. Defaults to CANVAS_CACHE_TTL.
+        directory (str | None, optional): If given, responses are also stored in this directory so they survive restarts. Defaults to CANVAS_CACHE_DIR.
+        max_bytes (int, optional): Maximum total size of the cached response bodies (in memory and on disk). Defaults to CANVAS_CACHE_MAX_BYTES.
+    """
+
+    def __init__(
+        self,
+        max_entries : int = CANVAS_CACHE_MAX_ENTRIES,
+        ttl : float = CANVAS_CACHE_TTL,
+        directory : str | None = CANVAS_CACHE_DIR,
+        max_bytes : int = CANVAS_CACHE_MAX_BYTES
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries : OrderedDict[str, CanvasCacheEntry] = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.changed = 0
+        self.evictions = 0
+
+        if self.directory:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            self._prune_disk()
+
+    def _is_expired(self, entry : CanvasCacheEntry) -> bool:
+        return time.time() - entry.stored_at > self.ttl
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.directory, f"{key}.cache")
+
+    def _prune_disk(self):
+        """
+        Delete the expired responses left on disk by previous runs,
+        then the oldest ones until the directory fits within
+        max_entries and max_bytes. The remaining responses are
+        loaded into memory, so that they are evicted from disk
+        along with the responses cached from now on.
+        """
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".cache"): continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        kept : list[str] = []
+        kept_bytes = 0
+        for modified_at, size, name in sorted(files, reverse=True):
+            key = name.removesuffix(".cache")
+            if (
+                time.time() - modified_at <= self.ttl
+                and len(kept) < self.max_entries
+                and kept_bytes + size <= self.max_bytes
+            ):
+                kept.append(key)
+                kept_bytes += size
+            else:
+                self._remove_disk(key)
+
+        # From the oldest to the newest, so the newest are evicted last
+        for key in reversed(kept):
+            entry = self._read_disk(key)
+            if entry is None: self._remove_disk(key)
+            else: self._insert(key, entry)
+
+    def _read_disk(self, key : str) -> CanvasCacheEntry | None:
+        if not self.directory: return None
+        try:
+            with open(self._path(key), "rb") as file:
+                header = json.loads(file.readline())
+                body = file.read()
+        except (OSError, ValueError):
+            return None
+        return CanvasCacheEntry(body=body, **header)
+
+    def _write_disk(self, key : str, entry : CanvasCacheEntry):
+        if not self.directory: return
+        header = {
+            "etag" : entry.etag,
+            "last_modified" : entry.last_modified,
+            "link" : entry.link,
+            "stored_at" : entry.stored_at
+        }
+        try:
+            # Only the backend's user may read the cached responses
+            fd = os.open(self._path(key), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.fchmod(fd, 0o600)
+            with open(fd, "wb") as file:
+                file.write(json.dumps(header).encode("utf-8") + b"\n")
+                file.write(entry.body)
+        except OSError:
+            pass
+
+    def _remove_disk(self, key : str):
+        if not self.directory: return
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key : str) -> CanvasCacheEntry | None:
+        """
+        Obtain a cached response if it exists and has not expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._insert(key, entry)
+
+        if entry is None: return None
+
+        if self._is_expired(entry):
+            self.remove(key)
+            self.evictions += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def _insert(self, key : str, entry : CanvasCacheEntry):
+        self._pop(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+            evicted_key = next(iter(self._entries))
+            self.remove(evicted_key)
+            self.evictions += 1
+
+    def _pop(self, key : str):
+        entry = self._entries.pop(key, None)
+        if entry is not None: self._bytes -= len(entry.body)
+
+    def store(
+        self,
+        key : str,
+        etag : str | None,
+        last_modified : str | None,
+        link : str | None,
+        body : bytes
+    ) -> CanvasCacheEntry | None:
+        """
+        Cache a response. Responses without an ETag or
+        Last-Modified header cannot be revalidated and
+        are not cached.
+
+        Returns:
+            CanvasCacheEntry | None: The new cache entry, if the response was cached.
+        """
+        if not etag and not last_modified:
+            self.remove(key)
+            return None
+
+        entry = CanvasCacheEntry(etag=etag, last_modified=last_modified, link=link, body=body)
+        self._insert(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def remove(self, key : str):
+        self._pop(key)
+        self._remove_disk(key)
+
+    def record(self, entry : CanvasCacheEntry | None, not_modified : bool):
+        """
+        Count the outcome of a request for the hit-ratio counters.
+
+        Args:
+            entry (CanvasCacheEntry | None): The entry which was revalidated, if any.
+            not_modified (bool): Whether Canvas responded with 304 Not Modified.
+        """
+        if entry is None: self.misses += 1
+        elif not_modified: self.hits += 1
+        else: self.changed += 1
+
+    def validate(self, entry : CanvasCacheEntry, adapter : TypeAdapter) -> list:
+        """
+        Validate the body of a cached response with a pydantic adapter,
+        reusing the result of any previous validation with the same adapter.
+
+        Returns:
+            list:
+                A deep copy of the validated items, so that a caller
+                which modifies its items does not modify the cache.
+        """
+        items = entry.parsed.get(id(adapter))
+        if items is None:
+            items = adapter.validate_json(entry.body)
+            entry.parsed[id(adapter)] = items
+        return [
+            item.model_copy(deep=True) if isinstance(item, BaseModel) else copy.deepcopy(item)
+            for item in items
+        ]
+
+    def clear(self):
+        for key in list(self._entries.keys()):
+            self.remove(key)
+
+    def stats(self) -> dict:
+        """
+        Obtain the cache's hit-ratio counters.
+
+        ``hits`` counts requests answered with 304 Not Modified,
+        ``changed`` counts cached requests which Canvas answered with
+        new content, and ``misses`` counts requests with no cached entry.
+        """
+        requests = self.hits + self.changed + self.misses
+        return {
+            "entries" : len(self._entries),
+            "bytes" : self._bytes,
+            "hits" : self.hits,
+            "changed" : self.changed,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "hit_ratio" : self.hits / requests if requests else 0.0
+        }
+
+canvas_cache = CanvasResponseCache()
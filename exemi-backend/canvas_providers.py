@@ -0,0 +1,201 @@
+import os
+import time
+from collections import OrderedDict
+from fastapi import HTTPException
+from dotenv import load_dotenv
+from .canvas_cache import hash_magic
+
+"""
+Decides which Canvas provider (university alias) each request should be sent to.
+
+A university may have several Canvas providers (e.g., "swinburne" and
+"swinburneonline"), and only one of them will accept a given student's
+Canvas token. Rather than trying every provider in order for every
+request, the provider which last accepted each token is remembered
+and tried first. Each provider host also has a circuit breaker so
+that a provider which is down is not retried on every request.
+"""
+
+load_dotenv()
+
+# Provider resolution settings. These can be overridden in the .env file.
+CANVAS_BREAKER_FAILURES = int(os.environ.get("CANVAS_BREAKER_FAILURES", 5))
+CANVAS_BREAKER_RESET = float(os.environ.get("CANVAS_BREAKER_RESET", 30))
+CANVAS_HEDGE_DELAY = float(os.environ.get("CANVAS_HEDGE_DELAY", 3))
+CANVAS_STICKY_MAX_TOKENS = int(os.environ.get("CANVAS_STICKY_MAX_TOKENS", 10000))
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a request is not sent because
+    the provider's circuit breaker is open.
+    """
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a single Canvas provider host.
+
+    The breaker is **closed** (requests are sent) until the provider
+    fails ``failure_threshold`` times in a row with a server error
+    (5xx) or timeout, at which point it **opens** and requests to the
+    provider are skipped. After ``reset_timeout`` seconds the breaker
+    becomes **half-open** and lets a single probe request through:
+    if it succeeds the breaker closes, otherwise it opens again.
+
+    Client errors (such as a 401 from a university alias which does
+    not recognise the student's token) do not count as failures.
+    """
+
+    def __init__(
+        self,
+        failure_threshold : int = CANVAS_BREAKER_FAILURES,
+        reset_timeout : float = CANVAS_BREAKER_RESET
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at : float | None = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        """
+        Returns:
+            str: "closed", "open", or "half_open".
+        """
+        if self.opened_at is None: return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout: return "half_open"
+        return "open"
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether a request to this provider would currently be allowed.
+        """
+        state = self.state
+        if state == "open": return False
+        if state == "half_open": return not self.probing
+        return True
+
+    def acquire(self) -> bool:
+        """
+        Ask to send a request to this provider.
+
+        Returns:
+            bool: True if the request may be sent.
+        """
+        if not self.available: return False
+        if self.state == "half_open": self.probing = True
+        return True
+
+    def release(self):
+        """
+        Give up a request which was allowed but never completed
+        (e.g., a hedged request which lost the race).
+        """
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+class ProviderResolver:
+    """
+    Remembers which Canvas provider accepts each access token
+    and keeps a circuit breaker for each provider host.
+
+    Args:
+        max_tokens (int, optional): Maximum number of tokens to remember providers for. Defaults to CANVAS_STICKY_MAX_TOKENS.
+        hedge_delay (float, optional):
+            How many seconds to wait for a provider to respond before
+            also trying the next provider in parallel. Defaults to CANVAS_HEDGE_DELAY.
+    """
+
+    def __init__(
+        self,
+        max_tokens : int = CANVAS_STICKY_MAX_TOKENS,
+        hedge_delay : float = CANVAS_HEDGE_DELAY
+    ):
+        self.max_tokens = max_tokens
+        self.hedge_delay = hedge_delay
+        self._sticky : OrderedDict[str, str] = OrderedDict()
+        self._breakers : dict[str, CircuitBreaker] = {}
+
+    def breaker(self, provider : str) -> CircuitBreaker:
+        """
+        Obtain the circuit breaker for a given provider host.
+        """
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self._breakers[provider] = breaker
+        return breaker
+
+    def order(self, providers : list[str], magic : str) -> list[str]:
+        """
+        Order a list of providers for a request, trying the provider
+        which last accepted the token first and skipping any providers
+        whose circuit breaker is open.
+
+        Args:
+            providers (list[str]): The user's university and its aliases in their default order.
+            magic (str): The Canvas access token used for the request.
+
+        Raises:
+            HTTPException: Raises a 503 if every provider's circuit breaker is open.
+
+        Returns:
+            list[str]: The providers to try, in order.
+        """
+        providers = list(dict.fromkeys(providers))
+
+        sticky = self._sticky.get(hash_magic(magic))
+        if sticky in providers:
+            providers.remove(sticky)
+            providers.insert(0, sticky)
+
+        available = [p for p in providers if self.breaker(p).available]
+        if not available:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Canvas is currently unavailable ({', '.join(providers)}). Please try again later."
+            )
+        return available
+
+    def remember(self, magic : str, provider : str):
+        """
+        Remember that a provider accepted a given token.
+        """
+        key = hash_magic(magic)
+        self._sticky[key] = provider
+        self._sticky.move_to_end(key)
+        while len(self._sticky) > self.max_tokens:
+            self._sticky.popitem(last=False)
+
+    def forget(self, magic : str, provider : str):
+        """
+        Forget a remembered provider if it no longer accepts a given token.
+        """
+        key = hash_magic(magic)
+        if self._sticky.get(key) == provider:
+            del self._sticky[key]
+
+    def stats(self) -> dict:
+        """
+        Obtain the state of every provider's circuit breaker.
+        """
+        return {
+            "remembered_tokens" : len(self._sticky),
+            "breakers" : {
+                provider : {"state" : b.state, "failures" : b.failures}
+                for provider, b in self._breakers.items()
+            }
+        }
+
+provider_resolver = ProviderResolver()
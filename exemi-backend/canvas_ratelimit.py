@@ -0,0 +1,223 @@
+import os
+import time
+import random
+import asyncio
+import httpx
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+from .canvas_cache import hash_magic
+
+"""
+Paces Canvas API requests to stay within each access token's rate limit.
+
+Canvas gives every access token a "leaky bucket" of request cost.
+Each request drains the bucket by its cost (``X-Request-Cost``) and
+the bucket refills over time. Responses report how much of the bucket
+is left (``X-Rate-Limit-Remaining``), and once it runs dry Canvas
+responds with ``403 Forbidden (Rate Limit Exceeded)`` until it refills.
+
+Every Canvas request is sent through the token's ``TokenBudget``, which
+limits how many requests for the token may be in flight at once (based
+on the budget Canvas last reported) and paces requests with a local
+token bucket. This lets a sync run as many requests in parallel as
+Canvas allows without tripping its throttling.
+
+See https://developerdocs.instructure.com/services/canvas/basics/file.throttling for more information.
+"""
+
+load_dotenv()
+
+# Rate limit settings. These can be overridden in the .env file.
+CANVAS_RATE_PER_SECOND = float(os.environ.get("CANVAS_RATE_PER_SECOND", 10))
+CANVAS_RATE_BURST = float(os.environ.get("CANVAS_RATE_BURST", 10))
+CANVAS_RATE_MIN_CONCURRENCY = int(os.environ.get("CANVAS_RATE_MIN_CONCURRENCY", 1))
+CANVAS_RATE_MAX_CONCURRENCY = int(os.environ.get("CANVAS_RATE_MAX_CONCURRENCY", 8))
+CANVAS_RATE_RETRIES = int(os.environ.get("CANVAS_RATE_RETRIES", 4))
+CANVAS_RATE_BACKOFF = float(os.environ.get("CANVAS_RATE_BACKOFF", 1))
+CANVAS_RATE_MAX_TOKENS = int(os.environ.get("CANVAS_RATE_MAX_TOKENS", 10000))
+
+# Canvas charges every concurrent request an up-front
+# cost of 50 which is refunded once the request completes.
+CANVAS_PREFLIGHT_COST = 50
+
+def is_throttled(response : httpx.Response) -> bool:
+    """
+    Whether a Canvas response is a rate limit rejection
+    (rather than a 403 caused by missing permissions).
+    """
+    return response.status_code == 403 and "rate limit exceeded" in response.text.lower()
+
+def get_backoff(attempt : int, base : float = CANVAS_RATE_BACKOFF) -> float:
+    """
+    Obtain how many seconds to wait before retrying a
+    throttled request, using exponential backoff with full jitter.
+
+    Args:
+        attempt (int): How many times the request has been throttled, starting at 0.
+        base (float, optional): The maximum wait for the first retry. Defaults to CANVAS_RATE_BACKOFF.
+    """
+    return random.uniform(0, base * (2 ** attempt))
+
+class TokenBudget:
+    """
+    Tracks the Canvas rate limit budget of a single access token
+    and schedules the token's requests to fit within it.
+
+    Attributes:
+        remaining (float | None): The most recent ``X-Rate-Limit-Remaining`` reported by Canvas, if any.
+        cost (float | None): A moving average of the ``X-Request-Cost`` reported by Canvas, if any.
+        in_flight (int): How many requests are currently being sent.
+        queued (int): How many requests are waiting to be sent.
+        requests (int): How many requests have been sent.
+        throttled (int): How many requests Canvas rejected with a rate limit error.
+    """
+
+    def __init__(
+        self,
+        rate : float = CANVAS_RATE_PER_SECOND,
+        burst : float = CANVAS_RATE_BURST,
+        min_concurrency : int = CANVAS_RATE_MIN_CONCURRENCY,
+        max_concurrency : int = CANVAS_RATE_MAX_CONCURRENCY
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+
+        self.remaining : float | None = None
+        self.cost : float | None = None
+        self.in_flight = 0
+        self.queued = 0
+        self.requests = 0
+        self.throttled = 0
+
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._condition : asyncio.Condition | None = None
+
+    @property
+    def concurrency(self) -> int:
+        """
+        How many requests may be in flight at once. Until Canvas has
+        reported the token's budget, the maximum is used. Afterwards, only
+        as many requests as the remaining budget can pay for are allowed.
+        """
+        if self.remaining is None: return self.max_concurrency
+        cost = (self.cost or 0) + CANVAS_PREFLIGHT_COST
+        allowed = int(self.remaining // cost)
+        return max(self.min_concurrency, min(self.max_concurrency, allowed))
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    async def _wait_for_token(self):
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Wait until a request may be sent for this token.
+
+        Usage:
+            async with budget.slot():
+                response = await client.get(...)
+                budget.update(response.headers)
+        """
+        if self._condition is None: self._condition = asyncio.Condition()
+
+        self.queued += 1
+        try:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.in_flight < self.concurrency)
+                self.in_flight += 1
+        finally:
+            self.queued -= 1
+
+        try:
+            await self._wait_for_token()
+            self.requests += 1
+            yield
+        finally:
+            self.in_flight -= 1
+            async with self._condition:
+                self._condition.notify_all()
+
+    def update(self, headers):
+        """
+        Record the rate limit headers of a Canvas response.
+        """
+        remaining = headers.get("X-Rate-Limit-Remaining")
+        cost = headers.get("X-Request-Cost")
+        try:
+            if remaining is not None: self.remaining = float(remaining)
+            if cost is not None:
+                cost = float(cost)
+                self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
+        except ValueError:
+            pass
+
+    def record_throttled(self):
+        """
+        Record that Canvas rejected a request with a rate limit
+        error, so that only one request is sent at a time
+        until Canvas reports that the budget has recovered.
+        """
+        self.throttled += 1
+        self.remaining = 0
+
+    def stats(self) -> dict:
+        return {
+            "remaining" : self.remaining,
+            "request_cost" : self.cost,
+            "concurrency" : self.concurrency,
+            "in_flight" : self.in_flight,
+            "queued" : self.queued,
+            "requests" : self.requests,
+            "throttled" : self.throttled
+        }
+
+class CanvasRateLimiter:
+    """
+    Keeps a ``TokenBudget`` for each Canvas access token.
+
+    Budgets are keyed by the hash of the token
+    so that the token itself is never stored.
+
+    Args:
+        max_tokens (int, optional): Maximum number of token budgets to keep. Defaults to CANVAS_RATE_MAX_TOKENS.
+    """
+
+    def __init__(self, max_tokens : int = CANVAS_RATE_MAX_TOKENS):
+        self.max_tokens = max_tokens
+        self._budgets : OrderedDict[str, TokenBudget] = OrderedDict()
+
+    def budget(self, magic : str) -> TokenBudget:
+        """
+        Obtain the budget for a given access token, creating it if it does not exist yet.
+        """
+        key = hash_magic(magic)
+        budget = self._budgets.get(key)
+        if budget is None:
+            budget = TokenBudget()
+            self._budgets[key] = budget
+        self._budgets.move_to_end(key)
+
+        while len(self._budgets) > self.max_tokens:
+            self._budgets.popitem(last=False)
+        return budget
+
+    def stats(self) -> dict:
+        """
+        Obtain the budget of every token, keyed by a short prefix of the token's hash.
+        """
+        return {key[:12] : budget.stats() for key, budget in self._budgets.items()}
+
+canvas_rate_limiter = CanvasRateLimiter()
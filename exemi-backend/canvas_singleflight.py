@@ -0,0 +1,153 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+from dotenv import load_dotenv
+
+"""
+Coalesces identical Canvas requests so that they share one result.
+
+The frontend may ask for the same Canvas resources several times at
+once, e.g., when two views both call GET /canvas/units. With single-flight, a request which is identical to one
+already in flight waits for that request's result instead of sending
+its own. Results are also remembered:
+
+- for the rest of the current request scope (see ``canvas_request_scope``), and
+- for ``CANVAS_SINGLEFLIGHT_TTL`` seconds across requests, if set.
+
+Keys must include the access token (or its hash) so
+that results are never shared between users.
+"""
+
+load_dotenv()
+
+# Single-flight settings. These can be overridden in the .env file.
+CANVAS_SINGLEFLIGHT_TTL = float(os.environ.get("CANVAS_SINGLEFLIGHT_TTL", 0))
+CANVAS_SINGLEFLIGHT_MAX_ENTRIES = int(os.environ.get("CANVAS_SINGLEFLIGHT_MAX_ENTRIES", 256))
+
+_request_scope : ContextVar[dict | None] = ContextVar("canvas_request_scope", default=None)
+
+@contextmanager
+def canvas_request_scope():
+    """
+    Remember the result of every coalesced Canvas request made
+    inside this block (including in tasks it starts) until the
+    block exits, so each distinct resource is only fetched once.
+
+    Usage:
+        with canvas_request_scope():
+            units = await canvas_get_units(...)
+            groups = await canvas_get_assignment_groups(...)
+    """
+    token = _request_scope.set({})
+    try:
+        yield
+    finally:
+        _request_scope.reset(token)
+
+class SingleFlight:
+    """
+    Shares the result of identical concurrent (or recent) calls.
+
+    Args:
+        ttl (float, optional): How many seconds results are shared across requests. 0 disables this. Defaults to CANVAS_SINGLEFLIGHT_TTL.
+        max_entries (int, optional): Maximum number of recent results kept. Defaults to CANVAS_SINGLEFLIGHT_MAX_ENTRIES.
+    """
+
+    def __init__(
+        self,
+        ttl : float = CANVAS_SINGLEFLIGHT_TTL,
+        max_entries : int = CANVAS_SINGLEFLIGHT_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._in_flight : dict[str, asyncio.Task] = {}
+        self._recent : OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+        self.executed = 0
+        self.joined = 0
+        self.reused = 0
+
+    def _get_recent(self, key : str):
+        if self.ttl <= 0: return None
+        recent = self._recent.get(key)
+        if recent is None: return None
+        stored_at, result = recent
+        if time.monotonic() - stored_at > self.ttl:
+            del self._recent[key]
+            return None
+        return recent
+
+    def _store_recent(self, key : str, result):
+        if self.ttl <= 0: return
+        self._recent[key] = (time.monotonic(), result)
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_entries:
+            self._recent.popitem(last=False)
+
+    def _on_done(self, key : str, task : asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if task.cancelled(): return
+        # Retrieving the exception stops asyncio warning about it
+        # if every caller waiting for the task was cancelled.
+        if task.exception() is None:
+            self._store_recent(key, task.result())
+
+    async def do(self, key : str, function : Callable[[], Awaitable]):
+        """
+        Run ``function`` unless an identical call (with the same key)
+        is in flight or has a result which can be reused.
+
+        The call runs in its own task, so if the caller which
+        started it is cancelled, other callers still get the result.
+
+        Args:
+            key (str): Identifies the call. Must include the caller's access token (or its hash).
+            function (Callable[[], Awaitable]): Makes the call.
+
+        Returns:
+            The result of the call. It is shared between callers, so it must not be modified.
+        """
+        scope = _request_scope.get()
+        if scope is not None and key in scope:
+            self.reused += 1
+            return scope[key]
+
+        recent = self._get_recent(key)
+        if recent is not None:
+            self.reused += 1
+            return recent[1]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.joined += 1
+        else:
+            self.executed += 1
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+
+        result = await asyncio.shield(task)
+
+        if scope is not None: scope[key] = result
+        return result
+
+    def stats(self) -> dict:
+        """
+        Obtain how many calls were executed, joined a call
+        already in flight, or reused a previous result.
+        """
+        calls = self.executed + self.joined + self.reused
+        return {
+            "in_flight" : len(self._in_flight),
+            "executed" : self.executed,
+            "joined" : self.joined,
+            "reused" : self.reused,
+            "coalesced_ratio" : (self.joined + self.reused) / calls if calls else 0.0
+        }
+
+canvas_single_flight = SingleFlight()
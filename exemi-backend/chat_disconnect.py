@@ -0,0 +1,112 @@
+import asyncio
+import anyio
+from typing import AsyncIterator, Callable, TypeVar
+
+"""
+Stops generating a streamed chat reply when the client disconnects.
+
+When a student closed the chat mid-reply, the agent kept generating
+the rest of the reply (and running its tool calls) for nobody, using
+an LLM slot other students were queued for. Starlette already stops
+iterating a StreamingResponse when its client disconnects: it cancels
+the task sending the response, which raises ``CancelledError`` inside
+``chat_stream`` wherever it is waiting on the agent (or, with servers
+which report disconnects by failing the next send, closes the stream,
+raising ``GeneratorExit``). ``chat_stream`` lets the exception cancel
+the agent's stream, which aborts the request to Ollama (so Ollama stops
+generating), skips any pending tool calls and frees the LLM slot. It
+then saves the partial reply and records the cancellation here.
+
+Starlette cancels the response with an anyio cancel scope, which
+cancels every later ``await`` of the response's task too, so the
+agent's stream could not finish closing the request to Ollama and
+releasing its LLM slot. ``chat_stream`` therefore iterates the
+agent's stream in a task of its own (see ``iterate_in_task``), which
+is cancelled once and allowed to clean up.
+
+The generation time saved is estimated as the average duration of
+completed replies minus how long the cancelled reply had run.
+"""
+
+T = TypeVar("T")
+
+class StreamCancellationStats:
+    """
+    Counters of completed and cancelled chat reply streams.
+    """
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.mean_reply_seconds : float | None = None
+        self.reclaimed_seconds = 0.0
+
+    def record_completed(self, seconds : float):
+        self.completed += 1
+        if self.mean_reply_seconds is None:
+            self.mean_reply_seconds = seconds
+        else:
+            self.mean_reply_seconds = 0.9 * self.mean_reply_seconds + 0.1 * seconds
+
+    def record_cancelled(self, seconds : float):
+        self.cancelled += 1
+        if self.mean_reply_seconds is not None:
+            self.reclaimed_seconds += max(0.0, self.mean_reply_seconds - seconds)
+
+    def stats(self) -> dict:
+        return {
+            "completed" : self.completed,
+            "cancelled" : self.cancelled,
+            "mean_reply_seconds" : self.mean_reply_seconds,
+            "estimated_reclaimed_seconds" : self.reclaimed_seconds
+        }
+
+stream_cancellations = StreamCancellationStats()
+
+# Marks the end of a stream passed through iterate_in_task's queue
+_STREAM_END = object()
+
+async def iterate_in_task(
+    stream : AsyncIterator[T],
+    timeout : Callable[[], float | None] | None = None
+) -> AsyncIterator[T | None]:
+    """
+    Yield the items of a stream, which is iterated by a separate task.
+
+    If this iterator is cancelled or closed (e.g., because the client
+    disconnected), the task is cancelled, and its cleanup is awaited
+    even if the caller's task is still being cancelled.
+
+    Args:
+        stream (AsyncIterator[T]): The stream to iterate.
+        timeout (Callable[[], float | None] | None, optional):
+            Called before waiting for each item. If it returns a number of seconds
+            and no item arrives in time, None is yielded (e.g., to send buffered text,
+            see ``ChatStreamEvents.flush_timeout``). Waiting for an item never cancels
+            the stream itself. Defaults to None.
+    """
+    queue : asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def produce():
+        try:
+            async for item in stream:
+                await queue.put((item, None))
+            await queue.put((_STREAM_END, None))
+        except Exception as e:
+            await queue.put((_STREAM_END, e))
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            try:
+                item, error = await asyncio.wait_for(queue.get(), timeout() if timeout else None)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if item is _STREAM_END:
+                if error is not None: raise error
+                return
+            yield item
+    finally:
+        producer.cancel()
+        with anyio.CancelScope(shield=True):
+            await asyncio.gather(producer, return_exceptions=True)
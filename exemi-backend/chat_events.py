@@ -0,0 +1,133 @@
+import os
+import json
+import time
+from typing import Any, Literal
+from dotenv import load_dotenv
+from .llm_telemetry import LLMCallTelemetry
+
+"""
+Typed events for streamed chat replies.
+
+By default a chat reply is streamed as bare text. With the "ndjson"
+(one JSON object per line) or "sse" (server-sent events) stream
+formats, the reply is streamed as events instead, so the frontend
+can tell text apart from tool calls and measure the reply:
+
+- ``{"type": "delta", "text": ...}``: Reply text. Tokens are
+  coalesced into frames of LLM_STREAM_FRAME_SECONDS, since a
+  frame per token costs more in framing and syscalls than the
+  token itself. The first token is sent straight away, and the
+  buffered text is sent when its frame ends, even if no token
+  follows it (see ``ChatStreamEvents.flush_timeout``).
+- ``{"type": "tool_start", "name": ...}``: The LLM called a tool.
+- ``{"type": "tool_end", "name": ..., "seconds": ...}``: The tool
+  returned, ``seconds`` after it was called (including ``result``
+  if tool responses are included).
+- ``{"type": "error", "detail": ...}``: The reply failed.
+- ``{"type": "done", ...}``: The reply is complete. Includes the
+  time to build the prompt, to wait for an LLM slot, to the first
+  token and in total (seconds), and the prompt and reply token
+  counts and generation speed reported by Ollama (the reply's
+  telemetry, see llm_telemetry.py).
+"""
+
+load_dotenv()
+
+# Event stream settings. These can be overridden in the .env file.
+LLM_STREAM_FRAME_SECONDS = float(os.environ.get("LLM_STREAM_FRAME_SECONDS", 0.03))
+
+StreamFormat = Literal["text", "ndjson", "sse"]
+
+STREAM_MEDIA_TYPES : dict[StreamFormat, str] = {
+    "text" : "text/plain",
+    "ndjson" : "application/x-ndjson",
+    "sse" : "text/event-stream"
+}
+
+class ChatStreamEvents:
+    """
+    Formats the events of one streamed chat reply.
+
+    Each method returns the text to send to the client,
+    or None if there is nothing to send yet.
+
+    Args:
+        stream_format (StreamFormat): "ndjson" or "sse".
+        frame_seconds (float, optional): How long reply text is buffered before it is sent. Defaults to LLM_STREAM_FRAME_SECONDS.
+    """
+
+    def __init__(
+        self,
+        stream_format : StreamFormat,
+        frame_seconds : float = LLM_STREAM_FRAME_SECONDS
+    ):
+        self.stream_format = stream_format
+        self.frame_seconds = frame_seconds
+
+        self._text : list[str] = []
+        # When reply text was last sent
+        self._sent_at = float("-inf")
+        self._tools_started_at : dict[str, float] = {}
+
+    def format(self, event : dict[str, Any]) -> str:
+        data = json.dumps(event, ensure_ascii=False)
+        if self.stream_format == "sse":
+            return f"event: {event['type']}\ndata: {data}\n\n"
+        return data + "\n"
+
+    def flush(self) -> str:
+        """
+        Send the buffered reply text (if any).
+        """
+        if not self._text: return ""
+        text = "".join(self._text)
+        self._text.clear()
+        self._sent_at = time.monotonic()
+        return self.format({"type" : "delta", "text" : text})
+
+    def delta(self, text : str) -> str | None:
+        """
+        Add reply text. The text is sent straight away if no text
+        was sent during the last frame, otherwise it is buffered
+        until the frame ends.
+        """
+        self._text.append(text)
+        if time.monotonic() - self._sent_at < self.frame_seconds: return None
+        return self.flush()
+
+    def flush_timeout(self) -> float | None:
+        """
+        Seconds until the buffered reply text must be sent
+        (with ``flush``), or None if no text is buffered.
+        """
+        if not self._text: return None
+        return max(0.0, self._sent_at + self.frame_seconds - time.monotonic())
+
+    def tool_start(self, name : str) -> str:
+        self._tools_started_at[name] = time.monotonic()
+        return self.flush() + self.format({"type" : "tool_start", "name" : name})
+
+    def tool_end(self, name : str, result : str | None = None) -> str:
+        started_at = self._tools_started_at.pop(name, None)
+        event : dict[str, Any] = {
+            "type" : "tool_end",
+            "name" : name,
+            "seconds" : time.monotonic() - started_at if started_at is not None else None
+        }
+        if result is not None: event["result"] = result
+        return self.flush() + self.format(event)
+
+    def error(self, detail : str) -> str:
+        return self.flush() + self.format({"type" : "error", "detail" : detail})
+
+    def done(self, telemetry : LLMCallTelemetry) -> str:
+        return self.flush() + self.format({
+            "type" : "done",
+            "prompt_seconds" : telemetry.prompt_build_seconds,
+            "queue_seconds" : telemetry.queue_seconds,
+            "first_token_seconds" : telemetry.first_token_seconds,
+            "total_seconds" : telemetry.total_seconds,
+            "input_tokens" : telemetry.prompt_tokens,
+            "output_tokens" : telemetry.completion_tokens,
+            "tokens_per_second" : telemetry.tokens_per_second
+        })
@@ -2,17 +2,23 @@ import os
 import jwt
 from sqlalchemy.engine import URL
 from jwt.exceptions import ExpiredSignatureError
-import httpx
 from datetime import datetime, timezone, timedelta
 from sqlmodel import Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
 from dotenv import load_dotenv
 from datetime import timedelta
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from .canvas_api import find_canvas_provider
+from .query_profiler import query_profiler
 from .models import User, UserPublic, University, UniversityCreate, UniversityPublic, UniversityPublicWithAliases, UniversityAliasPublic
 
 load_dotenv()
 
+# Log every SQL statement to stdout (for debugging only)
+DB_ECHO = os.environ.get("DB_ECHO", "false").lower() == "true"
+
 # Establish a connection to the database.
 url = URL.create(
     "mariadb+mariadbconnector",
@@ -22,16 +28,41 @@ url = URL.create(
     database=os.environ["DB_NAME"],
 )
 
-engine = create_engine(url, echo=True)
+engine = create_engine(url, echo=DB_ECHO)
+
+# The routers read from the database through the same connection
+# details using the asyncio driver (aiomysql), so that queries do not
+# block the event loop. The synchronous engine above is still used by
+# scripts, the Canvas sync and the LLM tools which write to the database.
+async_url = url.set(drivername="mysql+aiomysql")
+async_engine = create_async_engine(async_url, echo=DB_ECHO, pool_pre_ping=True)
+
+# Count and time every statement (see query_profiler.py)
+query_profiler.attach(engine)
+query_profiler.attach(async_engine.sync_engine)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 def get_engine(): return engine
 
+def get_async_engine(): return async_engine
+
 def get_session():
     with Session(engine) as session:
         yield session
 
+async def get_async_session():
+    """
+    Yield an asynchronous connection with the database.
+
+    Objects are not expired after committing, so their attributes can
+    still be read afterwards. Relationships are never lazy-loaded by an
+    AsyncSession: any relationship a response needs must be loaded
+    explicitly, e.g., with ``selectinload``.
+    """
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
 def get_secret_key() -> str:
     key = os.environ["SECRET_KEY"]
     if key is None: raise Exception("HS256 encryption/decryption key not found!")
@@ -39,12 +70,26 @@ def get_secret_key() -> str:
 
 def get_oauth2_scheme(): return oauth2_scheme
 
-async def get_current_user(token : str = Depends(oauth2_scheme), session : Session = Depends(get_session)) -> User:
-    fail = HTTPException(
+def login_failure() -> HTTPException:
+    return HTTPException(
         status_code=401,
         detail="Please log in first",
         headers={"WWW-Authenticate":"Bearer"}
     )
+
+def get_token_username(token : str) -> str:
+    """
+    Decode the username from a login token.
+
+    Args:
+        token (str): The JSON web token sent by the client.
+
+    Raises:
+        HTTPException: Raises a 401 if the token has expired or does not contain a username.
+
+    Returns:
+        str: The username of the logged in user.
+    """
     try:
         json_web_token_data = jwt.decode(token, get_secret_key(), algorithms=["HS256"])
     except ExpiredSignatureError:
@@ -55,11 +100,30 @@ async def get_current_user(token : str = Depends(oauth2_scheme), session : Sessi
         )
 
     username = json_web_token_data.get("sub")
-    if username is None: raise fail
+    if username is None: raise login_failure()
+    return username
+
+def get_current_user(token : str = Depends(oauth2_scheme), session : Session = Depends(get_session)) -> User:
+    username = get_token_username(token)
     user = session.exec(
         select(User).where(User.username == username)
     ).first()
-    if not user: raise fail 
+    if not user: raise login_failure()
+    return user
+
+async def get_current_user_async(token : str = Depends(oauth2_scheme), session : AsyncSession = Depends(get_async_session)) -> User:
+    """
+    Asynchronous version of ``get_current_user`` for routes which
+    read from an AsyncSession. The user is loaded through the
+    route's own AsyncSession (FastAPI shares the dependency within
+    a request), so the route can pass it to queries on that session
+    and the lookup does not block the event loop.
+    """
+    username = get_token_username(token)
+    user = (await session.exec(
+        select(User).where(User.username == username)
+    )).first()
+    if not user: raise login_failure()
     return user
 
 async def is_magic_valid(provider : str, magic : str, fallback_providers : list[str] = []) -> str | None:
@@ -74,25 +138,10 @@ async def is_magic_valid(provider : str, magic : str, fallback_providers : list[
     Returns:
         provider (str | None): Name of the provider who was able to successfully verify the magic, if any, otherwise None.
     """
-    providers = [provider, *fallback_providers]
-
-    for i, provider in enumerate(providers):
-        is_last_provider = i == len(providers) - 1
-
-        async with httpx.AsyncClient(timeout=15) as client:
-            response = await client.get(f"https://{provider}.instructure.com/api/v1/users/self", params={
-            "access_token":magic,
-            })
-
-        if response.status_code == 200:
-            return provider
-        
-        # if is_last_provider:
-        #     if response.status_code == 200:
-        #         return provider
-        #     else: return None
+    providers = [p for p in [provider, *fallback_providers] if p]
+    if not providers: return None
 
-    return None
+    return await find_canvas_provider(magic=magic, providers=providers, timeout=15)
 
 async def encrypt_magic(
     magic : str,
@@ -0,0 +1,146 @@
+import os
+import re
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup
+from dotenv import load_dotenv
+
+"""
+Converts Canvas assignment descriptions (HTML) into plain text.
+
+Canvas descriptions can be tens of KB of HTML, and parsing them
+with BeautifulSoup whenever an assignment is put into a prompt
+meant parsing every description on every prompt. Instead, the
+Canvas sync converts each description once and stores:
+
+- ``readable_description``: the whole description as plain text.
+- ``prompt_description``: the plain text capped at
+  ``DESCRIPTION_PROMPT_MAX_CHARS`` characters, for LLM prompts.
+- ``description_hash``: a hash of the HTML (and the cap), so a
+  later sync only converts descriptions which have changed.
+
+Large batches (e.g., the first sync of a unit) are converted in
+a process pool, since parsing HTML is CPU-bound and would
+otherwise block the event loop.
+"""
+
+load_dotenv()
+
+# Conversion settings. These can be overridden in the .env file.
+DESCRIPTION_PROMPT_MAX_CHARS = int(os.environ.get("DESCRIPTION_PROMPT_MAX_CHARS", 2000))
+# Batches with at least this many descriptions are converted in a process pool.
+DESCRIPTION_PROCESS_POOL_MIN_BATCH = int(os.environ.get("DESCRIPTION_PROCESS_POOL_MIN_BATCH", 32))
+# Number of worker processes (defaults to the number of CPUs).
+DESCRIPTION_PROCESS_POOL_WORKERS = int(os.environ.get("DESCRIPTION_PROCESS_POOL_WORKERS", 0)) or os.cpu_count() or 1
+
+_spaces = re.compile(r"[ \t\r\f\v\xa0]+")
+_blank_lines = re.compile(r"\n{3,}")
+
+# Elements which start a new line of text
+BLOCK_TAGS = [
+    "p", "div", "br", "hr", "li", "tr", "table", "ul", "ol", "pre", "blockquote",
+    "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "header", "footer"
+]
+
+def html_to_text(html : str | None) -> str:
+    """
+    Strip the HTML tags from a description to obtain a more legible
+    result. Each block element starts a new line (list items start
+    with "- "), runs of spaces are collapsed, and at most one blank
+    line is kept in a row.
+
+    Args:
+        html (str | None): The HTML description.
+
+    Returns:
+        str: The readable description.
+    """
+    if not html: return ""
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup.find_all(BLOCK_TAGS):
+        tag.insert_before("\n")
+        if tag.name == "li": tag.insert(0, "- ")
+    for tag in soup.find_all(["td", "th"]):
+        tag.insert_before(" ")
+    text = soup.get_text()
+    lines = (_spaces.sub(" ", line).strip() for line in text.split("\n"))
+    return _blank_lines.sub("\n\n", "\n".join(lines)).strip()
+
+def truncate_text(text : str, max_chars : int = DESCRIPTION_PROMPT_MAX_CHARS) -> str:
+    """
+    Cap a text at ``max_chars`` characters, cutting at the last
+    whitespace (if there is one near the end) and adding an ellipsis.
+    """
+    if len(text) <= max_chars: return text
+    cut = text[:max_chars - 1]
+    space = cut.rfind(" ")
+    if space > max_chars * 0.8:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+def get_description_hash(html : str | None) -> str:
+    """
+    Hash a description (and the prompt length cap), so that a sync
+    can tell whether the description needs to be converted again.
+    """
+    content = f"{DESCRIPTION_PROMPT_MAX_CHARS}\n{html or ''}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def convert_description(html : str | None) -> tuple[str, str]:
+    """
+    Convert a description into its readable and prompt variants.
+
+    Returns:
+        tuple[str, str]: The readable description and the prompt description.
+    """
+    text = html_to_text(html)
+    return text, truncate_text(text)
+
+def convert_descriptions_batch(htmls : list[str | None]) -> list[tuple[str, str]]:
+    return [convert_description(html) for html in htmls]
+
+_process_pool : ProcessPoolExecutor | None = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=DESCRIPTION_PROCESS_POOL_WORKERS)
+    return _process_pool
+
+def shutdown_process_pool():
+    """
+    Stop the worker processes (if any were started).
+    """
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(cancel_futures=True)
+        _process_pool = None
+
+async def convert_descriptions(htmls : list[str | None]) -> list[tuple[str, str]]:
+    """
+    Convert many descriptions into their readable and prompt variants.
+
+    Batches smaller than DESCRIPTION_PROCESS_POOL_MIN_BATCH are converted
+    in this process. Larger batches are split into chunks which are
+    converted in parallel in the process pool.
+
+    Args:
+        htmls (list[str | None]): The HTML descriptions.
+
+    Returns:
+        list[tuple[str, str]]: The readable and prompt description of each HTML description, in order.
+    """
+    if len(htmls) < DESCRIPTION_PROCESS_POOL_MIN_BATCH:
+        return convert_descriptions_batch(htmls)
+
+    pool = get_process_pool()
+    loop = asyncio.get_running_loop()
+    chunk_size = -(-len(htmls) // (DESCRIPTION_PROCESS_POOL_WORKERS * 4))
+    chunks = [htmls[i:i + chunk_size] for i in range(0, len(htmls), chunk_size)]
+
+    results = await asyncio.gather(*[
+        loop.run_in_executor(pool, convert_descriptions_batch, chunk)
+        for chunk in chunks
+    ])
+    return [text for chunk in results for text in chunk]
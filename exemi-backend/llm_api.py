@@ -1,5 +1,8 @@
 import os
 import json
+import time
+import anyio
+import asyncio
 from datetime import datetime
 from pydantic import BaseModel
 from .dependencies import get_current_user, get_current_magic, get_session
@@ -7,11 +10,22 @@ from .models import User, TaskList, TaskAutofillCreate, TaskAutofillResponse, Ta
 from typing import AsyncGenerator, Callable, Any
 from sqlmodel import Session
 from fastapi import HTTPException, Depends, BackgroundTasks
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from langchain.agents import create_agent
+from langchain.agents.middleware import dynamic_prompt, wrap_model_call, ModelRequest, ModelResponse
+from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import BaseMessage, AIMessage
+from langchain_core.runnables import Runnable
 from langchain.tools import BaseTool
 from langchain_ollama import ChatOllama
-from .llm_tools import create_tools
+from .llm_tools import create_tools, AgentContext
+from .llm_scheduler import llm_scheduler, LLMPriority
+from .llm_telemetry import LLMCallTelemetry, save_llm_telemetry
+from .llm_pool import llm_pool
+from .llm_fake import LLM_BACKEND, create_fake_chat_model
+from .chat_events import ChatStreamEvents, StreamFormat
+from .chat_disconnect import stream_cancellations, iterate_in_task
 from .routers.llm_prompt import get_system_prompt, get_summarising_prompt, get_update_user_bio_prompt, prepare_task_generation, get_task_autofill_prompt_for_user
 from dotenv import load_dotenv
 import warnings
@@ -24,23 +38,102 @@ class CreateTasksForUserResult(BaseModel):
 
 
 LLM_MODEL = os.environ["LLM_MODEL"]
-LLM_API_URL = os.environ["LLM_API_URL"]
 
+# Requests are spread over the Ollama servers in
+# LLM_API_URLS (or LLM_API_URL), see llm_pool.py.
+# With LLM_BACKEND=fake, a scripted fake LLM is used
+# instead (for offline testing), see llm_fake.py.
 model = None
 try:
-    model = ChatOllama(
-        base_url=LLM_API_URL,
-        model=LLM_MODEL,
-        validate_model_on_init=True,
-        # streaming=True
-    )
+    if LLM_BACKEND == "fake":
+        model = create_fake_chat_model(LLM_MODEL)
+    else:
+        model = llm_pool.create_chat_model()
 except:
-    warnings.warn("Ollama server unreachable: AI functionality will not work")
+    warnings.warn("Could not create the LLM client: AI functionality will not work")
+
+@dynamic_prompt
+def get_agent_system_prompt(request : ModelRequest) -> str:
+    """
+    Use the system prompt given in the agent's runtime context.
+    """
+    return request.runtime.context.system_prompt
+
+@wrap_model_call
+async def hold_llm_slot(request : ModelRequest, handler : Callable) -> ModelResponse:
+    """
+    Wait for an LLM slot before each model call of the agent (see llm_scheduler.py).
+    The slot is not held while tools run, since tools may call the LLM themselves.
+    """
+    context : AgentContext = request.runtime.context
+    async with llm_scheduler.slot(context.user.id, "chat", check_capacity=False) as wait_seconds:
+        context.queue_seconds += wait_seconds
+        return await handler(request)
+
+def create_chat_agent(model : BaseChatModel):
+    """
+    Compile the chat agent's graph. This is slow (see
+    tests/test_llm_api.py), so it is only done once, on import.
+    """
+    return create_agent(
+        model=model,
+        tools=create_tools(),
+        middleware=[get_agent_system_prompt, hold_llm_slot],
+        context_schema=AgentContext
+    )
+
+# The chat agent is compiled once. The current user and their
+# system prompt are passed as runtime context (AgentContext) to
+# each call, and read by the tools and get_agent_system_prompt.
+agent = None
+if model:
+    agent = create_chat_agent(model)
+
+async def invoke_llm(
+    runnable : Runnable,
+    messages : list[dict],
+    priority : LLMPriority,
+    telemetry : LLMCallTelemetry
+) -> Any:
+    """
+    Call the LLM once, waiting for an LLM slot (see llm_scheduler.py),
+    and save the call's telemetry (see llm_telemetry.py).
+
+    Always use ainvoke: invoke would block the event loop (and
+    every other user's chat stream) until the LLM responds.
+
+    Args:
+        runnable (Runnable): The model, or a structured output model with include_raw=True.
+        messages (list[dict]): List of messages in OpenAI format.
+        priority (LLMPriority): The priority of the call.
+        telemetry (LLMCallTelemetry): The telemetry of the call, started before its prompt was built.
+
+    Returns:
+        Any: The runnable's response.
+    """
+    if telemetry.prompt_build_seconds is None:
+        telemetry.prompt_build_seconds = time.monotonic() - telemetry.started_at
+
+    async with llm_scheduler.slot(telemetry.user_id, priority) as wait_seconds:
+        telemetry.queue_seconds += wait_seconds
+        response = await runnable.ainvoke(messages)
+
+    telemetry.add_message(response["raw"] if isinstance(response, dict) else response)
+    await save_llm_telemetry(telemetry)
+    return response
+
+def get_structured_output(response : dict) -> Any:
+    """
+    Obtain the parsed output of a structured output model called with include_raw=True.
+    """
+    if response.get("parsing_error"): raise response["parsing_error"]
+    return response["parsed"]
 
 async def update_user_bio(
     new_information : str,
     previous_biography : str | None,
-    max_words : int = 300
+    max_words : int = 300,
+    user_id : int | None = None
 ) -> str:
     """
     Update the user's biography string to contain new information.
@@ -49,11 +142,14 @@ async def update_user_bio(
         new_information (str): The new information to include in the biography string.
         previous_biography (str | None): The user's past biography, if exists.
         max_words (int, optional): Biography word limit. Defaults to 300.
+        user_id (int | None, optional): The user the biography belongs to, to share LLM slots fairly between users. Defaults to None.
     
     Returns:
         str: The updated biography text.
     """
     if not model: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+
+    telemetry = LLMCallTelemetry("update_user_bio", user_id=user_id)
     
     prompt = get_update_user_bio_prompt(
         max_words=max_words,
@@ -62,12 +158,14 @@ async def update_user_bio(
     
     messages = [{"role":"system", "content":prompt}, {"role":"user","content":new_information}]
 
-    response : AIMessage = model.invoke(messages)
+    response : AIMessage = await invoke_llm(model, messages, "background", telemetry)
     return str(response.content)
 
 async def summarise(
     chat_message_log : list[dict],
-    max_words : int = 200
+    max_words : int = 200,
+    user_id : int | None = None,
+    conversation_id : int | None = None
 ) -> str:
     """
     Summarise a conversation between
@@ -76,15 +174,20 @@ async def summarise(
     Args:
         chat_message_log (list[dict]): List of messages to summarise.
         max_words (int): Conversation summary word limit. Defaults to 200.
+        user_id (int | None, optional): The user the conversation belongs to, to share LLM slots fairly between users. Defaults to None.
+        conversation_id (int | None, optional): The conversation being summarised, for telemetry. Defaults to None.
 
     Raises:
         HTTPException: If the LLM is offline, raises a 500.
+        HTTPException: If too many LLM requests are waiting, raises a 503.
 
     Returns:
         str: The conversation summary.
     """
     if not model: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
 
+    telemetry = LLMCallTelemetry("summarise", user_id=user_id, conversation_id=conversation_id)
+
     # Parse conversation message dict into a string
     messages_text = json.dumps(chat_message_log, ensure_ascii=False).encode("utf-8")
 
@@ -95,7 +198,7 @@ async def summarise(
         {"role":"user", "content": messages_text}
     ]
 
-    response : AIMessage = model.invoke(messages)
+    response : AIMessage = await invoke_llm(model, messages, "background", telemetry)
     return str(response.content)
 
 async def create_tasks_for_user(
@@ -103,7 +206,11 @@ async def create_tasks_for_user(
     user : User,
     session : Session
 ) -> CreateTasksForUserResult:
-    prep = prepare_task_generation(
+    telemetry = LLMCallTelemetry("create_tasks", user_id=user.id)
+
+    # Preparing the prompt queries the database through a sync Session
+    prep = await run_in_threadpool(
+        prepare_task_generation,
         username=username,
         requesting_user=user,
         session=session,
@@ -116,9 +223,10 @@ async def create_tasks_for_user(
 
     messages = [{"role":"system", "content":prep.prompt}]
 
-    model_structured = model.with_structured_output(TaskList)
+    model_structured = model.with_structured_output(TaskList, include_raw=True)
 
-    tasks = model_structured.invoke(messages)
+    response = await invoke_llm(model_structured, messages, "tasks", telemetry)
+    tasks : TaskList = get_structured_output(response)
 
     return CreateTasksForUserResult(tasks=tasks, llm_bypassed=False)
 
@@ -135,8 +243,11 @@ async def autofill_task_for_user(
     """
 
     if not model: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+
+    telemetry = LLMCallTelemetry("autofill", user_id=user.id)
     
-    prompt = get_task_autofill_prompt_for_user(
+    prompt = await run_in_threadpool(
+        get_task_autofill_prompt_for_user,
         task=task,
         username=username,
         user=user,
@@ -144,8 +255,9 @@ async def autofill_task_for_user(
     )
 
     messages = [{"role":"system", "content": prompt}]
-    model_structured = model.with_structured_output(TaskAutofillResponse)
-    task_fields : TaskAutofillResponse = model_structured.invoke(messages)
+    model_structured = model.with_structured_output(TaskAutofillResponse, include_raw=True)
+    response = await invoke_llm(model_structured, messages, "autofill", telemetry)
+    task_fields : TaskAutofillResponse = get_structured_output(response)
 
     task_create = TaskCreate(
         name=task.name,
@@ -163,7 +275,8 @@ async def chat(
     magic : str,
     session : Session,
     system_prompt : str | None = None,
-    unit_id : int | None = None
+    unit_id : int | None = None,
+    conversation_id : int | None = None
 ) -> list[BaseMessage]:
     """
     Call the LLM to respond to the user's message(s).
@@ -176,30 +289,30 @@ async def chat(
             If not given, uses the user's system prompt (routers/llm_prompt.get_system_prompt).
             Defaults to None.
         unit_id (int | None, optional): Which unit to focus on. If not given, provides information for all units. Defaults to None.
+        conversation_id (int | None, optional): The conversation being responded to, for telemetry. Defaults to None.
 
     Raises:
         HTTPException: If the LLM is offline, raises a 500.
+        HTTPException: If too many LLM requests are waiting, raises a 503.
     
     Returns:
         list[BaseMessage]: The LLM response messages.
     """
 
-    if not model: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+    if not model or not agent: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+    llm_scheduler.check_capacity("chat")
+
+    telemetry = LLMCallTelemetry("chat", user_id=user.id, conversation_id=conversation_id)
 
     if not system_prompt:
         system_prompt = await get_system_prompt(user=user, session=session, unit_id=unit_id)
+    telemetry.prompt_build_seconds = time.monotonic() - telemetry.started_at
 
-    tools : list[BaseTool] = create_tools(user=user, session=session)
-
-    agent = create_agent(
-        model=model,
-        system_prompt=system_prompt,
-        tools=tools
-    )
+    context = AgentContext(user=user, system_prompt=system_prompt)
 
     try:
 # pyright: reportArgumentType=false 
-        response = await agent.ainvoke({"messages": messages})
+        response = await agent.ainvoke({"messages": messages}, context=context)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating LLM response.\nDetail: {str(e)}")
     
@@ -208,6 +321,11 @@ async def chat(
         # response_text = str(response_messages[-1].content)
     except:
         raise HTTPException(status_code=500, detail=f"LLM message not found in response.\nLLM response: {response}")
+
+    for message in response_messages[len(messages):]:
+        if isinstance(message, AIMessage): telemetry.add_message(message)
+    telemetry.queue_seconds = context.queue_seconds
+    await save_llm_telemetry(telemetry)
     
     return response_messages
 
@@ -221,7 +339,9 @@ async def chat_stream(
     unit_id : int | None = None,
     end_function : Callable | None = None,
     end_function_kwargs : dict[str, Any] | None = None,
-    include_tool_responses : bool = False
+    include_tool_responses : bool = False,
+    stream_format : StreamFormat = "text",
+    conversation_id : int | None = None
 ) -> AsyncGenerator[str, None]:
     """
     Call the LLM to respond to the user's message(s).
@@ -248,27 +368,39 @@ async def chat_stream(
         end_function_kwargs (dict[str, Any], optional):
             Keyword arguments to use when calling end_function. Defaults to None.
             NOTE: A keyword argument "messages" (list[dict[str,str]]) is automatically added containing the LLM's response and any tool calls in OpenAI chat template format.
+            A keyword argument "telemetry" (LLMCallTelemetry) is also added, which end_function must save (see llm_telemetry.save_llm_telemetry).
+            Without an end_function, the telemetry is saved in a background task.
         include_tool_responses (bool, optional): Includes the LLM's tool call responses in the streamed response. The reponse is not included in the database.
+        stream_format (StreamFormat, optional):
+            "text" streams the bare response text. "ndjson" and "sse" stream typed events
+            (text deltas, tool calls and timings, see chat_events.py) instead. Defaults to "text".
+        conversation_id (int | None, optional): The conversation being responded to, for telemetry. Defaults to None.
+
+    NOTE: The stream cannot be rejected once the response has started, so
+    routes should call ``llm_scheduler.check_capacity("chat")`` before
+    returning the StreamingResponse.
+
+    NOTE: If the client disconnects, Starlette cancels (or closes) the stream.
+    Generation then stops, and the partial response is passed to end_function
+    straight away (see chat_disconnect.py).
     
     Raises:
         HTTPException: If the LLM is offline, raises a 500.
 
     Yields:
-        str: The next chunk of the LLM response.
+        str: The next chunk of the LLM response (or the next events).
     """
     
-    if not model: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+    if not model or not agent: raise HTTPException(status_code=500, detail="Error reaching LLM: Ollama server offline")
+
+    events = ChatStreamEvents(stream_format) if stream_format != "text" else None
+    telemetry = LLMCallTelemetry("chat_stream", user_id=user.id, conversation_id=conversation_id)
 
     if not system_prompt:
         system_prompt = await get_system_prompt(user=user, session=session, unit_id=unit_id)
+    telemetry.prompt_build_seconds = time.monotonic() - telemetry.started_at
 
-    tools : list[BaseTool] = create_tools(user=user, session=session)
-
-    agent = create_agent(
-        model=model,
-        system_prompt=system_prompt,
-        tools=tools
-    )
+    context = AgentContext(user=user, system_prompt=system_prompt)
     
     # We will store the tool and LLM responses in
     # a separate list using OpenAI format.
@@ -282,15 +414,35 @@ async def chat_stream(
     
     last_tool_name : str | None = None
 
+    # Whether the client disconnected before the response was complete
+    cancelled = False
+    stream = None
+
     if end_function_kwargs is None: end_function_kwargs = {}
 
     try:
 
-        async for token, metadata in agent.astream(
-            {"messages":messages},
-            stream_mode="messages"
-        ):
+        stream = iterate_in_task(
+            agent.astream(
+                {"messages":messages},
+                context=context,
+                stream_mode="messages"
+            ),
+            # Send buffered reply text when its frame ends
+            timeout=events.flush_timeout if events else None
+        )
+
+        async for item in stream:
+            if item is None:
+                yield events.flush()
+                continue
+
+            token, metadata = item
             node = metadata["langgraph_node"]
+
+            # The last chunk of each model call has Ollama's token counts
+            if node == "model": telemetry.add_message(token, count_tool_calls=False)
+
             content : list[dict] = token.content_blocks
 
             if not content: continue # Ignore empty chunks
@@ -314,6 +466,8 @@ async def chat_stream(
 
                     if tool_name:
                         last_tool_name = tool_name
+                        telemetry.tool_calls += 1
+                        if events: chunk = events.tool_start(tool_name)
                         # Make the tool name human readable
                         # "get_assignments_from_Canvas" -> "get assignments from Canvas"
                         tool_name = tool_name.replace("_", " ")
@@ -336,7 +490,12 @@ async def chat_stream(
                         # Add the tool call into the list of messages.
                         # response_messages.append({"role":"system", "content":system_prompt_amendment})
 
-                        if include_tool_responses:
+                        if events:
+                            chunk = events.tool_end(
+                                getattr(token, "name", None) or last_tool_name or "",
+                                result=chunk if include_tool_responses else None
+                            )
+                        elif include_tool_responses:
                             chunk = f"\n\nI have obtained the following information:\n\n---\n\n{chunk}\n\n---\n\n**Please wait while I reason with this information...**\n\n"
                         else:
                             chunk = None
@@ -344,12 +503,40 @@ async def chat_stream(
                     elif node == "model":
                         # Only include LLM text in the final message.
                         chunks.append(chunk)
+                        telemetry.first_token()
+                        if events: chunk = events.delta(chunk)
 
             if chunk is not None:
                 yield chunk
+
+        telemetry.queue_seconds = context.queue_seconds
+        telemetry.finish()
+        stream_cancellations.record_completed(telemetry.total_seconds)
+        if events:
+            yield events.done(telemetry)
+
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client disconnected. Letting the exception propagate
+        # cancels the agent's stream and so stops generation.
+        cancelled = True
+        telemetry.finish()
+        stream_cancellations.record_cancelled(telemetry.total_seconds)
+        raise
+
+    except Exception as e:
+        # Event streams report errors as an event, since the
+        # response status has already been sent.
+        if not events: raise
+        yield events.error(str(e))
     
     finally:
+        # Stop the agent if the stream was closed before it finished
+        if stream is not None:
+            with anyio.CancelScope(shield=True):
+                await stream.aclose()
+
         # Add the LLM response to the DB even if an exception is encountered
+        telemetry.queue_seconds = context.queue_seconds
 
         if end_function is not None:
             response_text = "".join(chunks).strip()
@@ -358,5 +545,15 @@ async def chat_stream(
                 response_messages.append({"role":"assistant", "content":response_text})
 
             end_function_kwargs["messages"] = response_messages
-
+            end_function_kwargs["telemetry"] = telemetry
+        else:
+            end_function, end_function_kwargs = save_llm_telemetry, {"telemetry" : telemetry}
+
+        if cancelled:
+            # Starlette does not always run the response's background
+            # tasks after a disconnect, so save the partial response now
+            # (shielded, as the request's tasks are being cancelled).
+            with anyio.CancelScope(shield=True):
+                await BackgroundTask(end_function, **end_function_kwargs)()
+        else:
             background_tasks.add_task(end_function, **end_function_kwargs)
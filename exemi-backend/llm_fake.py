@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import time
+import asyncio
+import itertools
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Sequence
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from dotenv import load_dotenv
+
+"""
+A fake LLM for running the backend without an Ollama server.
+
+With ``LLM_BACKEND=fake``, llm_api uses a ``ScriptedChatModel``
+instead of Ollama, so that chats, task generation and summaries can
+be load tested and regression tested offline (e.g., on a CPU-only
+machine). The fake model is deterministic. It replies to the last
+user message with the first matching rule of its script:
+
+- A ``"response"`` rule replies with text. The text is a template,
+  formatted with the user's ``message`` and the named groups of the
+  rule's ``"match"`` regex.
+- A ``"tool"`` rule calls one of the LLM tools (llm_tools.py) with
+  ``"args"`` (templates formatted the same way). The real tool runs,
+  and the model then replies with the rule's ``"tool_response"``
+  template, formatted with the tool's ``result``.
+
+Rules from the JSON file LLM_FAKE_SCRIPT (a list of rules) are tried
+before DEFAULT_FAKE_SCRIPT. When the model must call a tool (e.g.,
+structured output of a ``TaskList`` or ``TaskAutofillResponse``),
+it fills the tool's JSON schema with placeholder values instead.
+
+Replies are streamed word by word at LLM_FAKE_TOKENS_PER_SECOND after
+LLM_FAKE_FIRST_TOKEN_SECONDS, and report Ollama's token counts and
+timings (counting words as tokens), so telemetry works as usual.
+"""
+
+load_dotenv()
+
+# Fake LLM settings. These can be overridden in the .env file.
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")
+LLM_FAKE_SCRIPT = os.environ.get("LLM_FAKE_SCRIPT")
+LLM_FAKE_TOKENS_PER_SECOND = float(os.environ.get("LLM_FAKE_TOKENS_PER_SECOND", 30))
+LLM_FAKE_FIRST_TOKEN_SECONDS = float(os.environ.get("LLM_FAKE_FIRST_TOKEN_SECONDS", 0.5))
+LLM_FAKE_RESPONSE_WORDS = int(os.environ.get("LLM_FAKE_RESPONSE_WORDS", 60))
+
+FILLER_WORDS = (
+    "break the assignment into small tasks and start with the one due first "
+    "so that each study session has a clear goal you can finish"
+).split()
+
+DEFAULT_FAKE_SCRIPT : list[dict[str, Any]] = [
+    {
+        "match" : r"\b(remember|my name is)\b",
+        "tool" : "add_information_to_student_biography",
+        "args" : {"information" : "{message}"},
+        "tool_response" : "I will remember that. {result}"
+    },
+    {
+        "match" : r"\bcreate (?:a )?task for assignment (?P<assignment_id>\d+)",
+        "tool" : "create_assignment_task_for_student",
+        "args" : {
+            "assignment_id" : "{assignment_id}",
+            "name" : "Assignment {assignment_id}: Plan the first draft",
+            "description" : "Read the assignment brief and outline the first draft.",
+            "duration_mins" : "30",
+            "due_at" : "{tomorrow}"
+        },
+        "tool_response" : "{result}"
+    },
+    {
+        "match" : r"\bdelete (?:the )?task (?P<task_name>.+)",
+        "tool" : "delete_assignment_task_for_student",
+        "args" : {"task_name" : "{task_name}"},
+        "tool_response" : "{result}"
+    },
+    {
+        "match" : "",
+        "response" : "You said: {message}"
+    }
+]
+
+def load_fake_script(path : str | None = LLM_FAKE_SCRIPT) -> list[dict[str, Any]]:
+    """
+    Obtain the rules of the JSON file at ``path`` (if any), followed by DEFAULT_FAKE_SCRIPT.
+    """
+    if not path: return list(DEFAULT_FAKE_SCRIPT)
+    with open(path) as f:
+        return json.load(f) + DEFAULT_FAKE_SCRIPT
+
+def get_placeholder_value(schema : dict, definitions : dict, name : str = "", index : int = 0) -> Any:
+    """
+    Obtain a valid placeholder value for a JSON schema, e.g., to fill the
+    arguments of a tool call. Optional values are None, lists have three items.
+    """
+    if "$ref" in schema:
+        return get_placeholder_value(definitions[schema["$ref"].split("/")[-1]], definitions, name, index)
+    if "default" in schema: return schema["default"]
+    if "enum" in schema: return schema["enum"][0]
+    if "anyOf" in schema:
+        options = schema["anyOf"]
+        if any(option.get("type") == "null" for option in options): return None
+        return get_placeholder_value(options[0], definitions, name, index)
+
+    match schema.get("type"):
+        case "object":
+            properties : dict = schema.get("properties", {})
+            required = schema.get("required", list(properties))
+            return {
+                key : get_placeholder_value(value, definitions, key, index)
+                for key, value in properties.items() if key in required
+            }
+        case "array":
+            return [get_placeholder_value(schema.get("items", {}), definitions, name, i) for i in range(3)]
+        case "string":
+            if schema.get("format") in ("date-time", "date"):
+                day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=index + 1)
+                return day.date().isoformat() if schema["format"] == "date" else day.isoformat()
+            return f"Placeholder {name.replace('_', ' ')} {index + 1}"
+        case "integer":
+            return 30 if "min" in name else index + 1
+        case "number":
+            return float(index + 1)
+        case "boolean":
+            return False
+    return None
+
+def split_tokens(text : str) -> list[str]:
+    """
+    Split text into tokens (words with their leading whitespace).
+    """
+    return re.findall(r"\s*\S+", text)
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    A deterministic chat model which replies according to a script
+    (see the module docstring), at a configurable speed.
+
+    Args:
+        model (str, optional): The model name reported in responses. Defaults to "fake".
+        script (list[dict[str, Any]], optional): The rules the model follows. Defaults to load_fake_script().
+        tokens_per_second (float, optional): Speed at which replies are generated. Defaults to LLM_FAKE_TOKENS_PER_SECOND.
+        first_token_seconds (float, optional): Time before the first token of each reply. Defaults to LLM_FAKE_FIRST_TOKEN_SECONDS.
+        response_words (int, optional): Minimum length of text replies, padded with filler words. Defaults to LLM_FAKE_RESPONSE_WORDS.
+    """
+
+    model : str = "fake"
+    script : list[dict[str, Any]] = []
+    tokens_per_second : float = LLM_FAKE_TOKENS_PER_SECOND
+    first_token_seconds : float = LLM_FAKE_FIRST_TOKEN_SECONDS
+    response_words : int = LLM_FAKE_RESPONSE_WORDS
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-fake"
+
+    def bind_tools(self, tools : Sequence[Any], *, tool_choice : str | None = None, **kwargs : Any):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_choice=tool_choice, **kwargs)
+
+    def respond(
+        self,
+        messages : list[BaseMessage],
+        tools : list[dict] | None = None,
+        tool_choice : str | None = None
+    ) -> AIMessage:
+        """
+        Obtain the model's (complete) reply to a list of messages.
+        """
+        functions = {tool["function"]["name"] : tool["function"] for tool in tools or []}
+
+        # Structured output (or a forced tool call): fill in the tool's schema
+        if functions and tool_choice not in (None, "auto", "none"):
+            function = functions.get(tool_choice) or next(iter(functions.values()))
+            parameters = function.get("parameters", {})
+            args = get_placeholder_value(parameters, parameters.get("$defs", {}))
+            return self.tool_call_message(messages, function["name"], args)
+
+        user_messages = [message for message in messages if isinstance(message, HumanMessage)]
+        message = str(user_messages[-1].content if user_messages else messages[-1].content)
+        fields = {
+            "message" : message,
+            "tomorrow" : (datetime.now(timezone.utc) + timedelta(days=1)).date().isoformat()
+        }
+
+        for rule in self.script or load_fake_script():
+            found = re.search(rule.get("match", ""), message, flags=re.IGNORECASE)
+            if not found: continue
+            fields.update({key : value.strip() for key, value in found.groupdict().items() if value})
+
+            if "tool" in rule:
+                if rule["tool"] not in functions: continue
+                # Reply to the result of the tool call
+                if isinstance(messages[-1], ToolMessage):
+                    fields["result"] = str(messages[-1].content)
+                    return AIMessage(content=self.pad(rule.get("tool_response", "{result}").format(**fields)))
+                args = {key : str(value).format(**fields) for key, value in rule.get("args", {}).items()}
+                return self.tool_call_message(messages, rule["tool"], args)
+
+            return AIMessage(content=self.pad(rule.get("response", "").format(**fields)))
+
+        return AIMessage(content=self.pad(""))
+
+    def tool_call_message(self, messages : list[BaseMessage], name : str, args : dict) -> AIMessage:
+        return AIMessage(content="", tool_calls=[{"name" : name, "args" : args, "id" : f"call_{len(messages)}"}])
+
+    def pad(self, text : str) -> str:
+        """
+        Pad a reply with filler words up to response_words words.
+        """
+        words = len(text.split())
+        if words >= self.response_words: return text
+        filler = itertools.islice(itertools.cycle(FILLER_WORDS), self.response_words - words)
+        return f"{text}\n\n{' '.join(filler).capitalize()}.".strip()
+
+    def count_tokens(self, message : AIMessage) -> int:
+        if message.tool_calls: return len(json.dumps([call["args"] for call in message.tool_calls]).split())
+        return len(split_tokens(str(message.content)))
+
+    def response_metadata(self, messages : list[BaseMessage], reply : AIMessage) -> dict:
+        """
+        Token counts and timings in the format Ollama reports them.
+        """
+        prompt_tokens = sum(len(str(message.content).split()) for message in messages)
+        eval_count = self.count_tokens(reply)
+        eval_seconds = eval_count / self.tokens_per_second
+        return {
+            "model" : self.model,
+            "model_name" : self.model,
+            "done" : True,
+            "done_reason" : "stop",
+            "prompt_eval_count" : prompt_tokens,
+            "prompt_eval_duration" : int(self.first_token_seconds * 1e9),
+            "eval_count" : eval_count,
+            "eval_duration" : int(eval_seconds * 1e9),
+            "total_duration" : int((self.first_token_seconds + eval_seconds) * 1e9)
+        }
+
+    def usage_metadata(self, metadata : dict) -> dict:
+        return {
+            "input_tokens" : metadata["prompt_eval_count"],
+            "output_tokens" : metadata["eval_count"],
+            "total_tokens" : metadata["prompt_eval_count"] + metadata["eval_count"]
+        }
+
+    def _reply(self, messages : list[BaseMessage], **kwargs : Any) -> tuple[AIMessage, dict]:
+        reply = self.respond(messages, kwargs.get("tools"), kwargs.get("tool_choice"))
+        metadata = self.response_metadata(messages, reply)
+        reply.response_metadata = metadata
+        reply.usage_metadata = self.usage_metadata(metadata)
+        return reply, metadata
+
+    def _generate(self, messages : list[BaseMessage], stop : list[str] | None = None, run_manager = None, **kwargs : Any) -> ChatResult:
+        reply, metadata = self._reply(messages, **kwargs)
+        time.sleep(metadata["total_duration"] / 1e9)
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    async def _agenerate(self, messages : list[BaseMessage], stop : list[str] | None = None, run_manager = None, **kwargs : Any) -> ChatResult:
+        reply, metadata = self._reply(messages, **kwargs)
+        await asyncio.sleep(metadata["total_duration"] / 1e9)
+        return ChatResult(generations=[ChatGeneration(message=reply)])
+
+    async def _astream(
+        self,
+        messages : list[BaseMessage],
+        stop : list[str] | None = None,
+        run_manager = None,
+        **kwargs : Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        reply, metadata = self._reply(messages, **kwargs)
+        await asyncio.sleep(self.first_token_seconds)
+
+        if reply.tool_calls:
+            await asyncio.sleep(metadata["eval_duration"] / 1e9)
+            chunk = AIMessageChunk(content="", tool_call_chunks=[
+                {"name" : call["name"], "args" : json.dumps(call["args"]), "id" : call["id"], "index" : i}
+                for i, call in enumerate(reply.tool_calls)
+            ])
+            yield ChatGenerationChunk(message=chunk)
+        else:
+            for i, token in enumerate(split_tokens(str(reply.content))):
+                if i: await asyncio.sleep(1 / self.tokens_per_second)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+        # Like Ollama, the last chunk has the token counts
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            response_metadata=metadata,
+            usage_metadata=self.usage_metadata(metadata),
+            chunk_position="last"
+        ))
+
+def create_fake_chat_model(model : str) -> ScriptedChatModel:
+    """
+    Create a fake chat model following LLM_FAKE_SCRIPT (see the module docstring).
+    """
+    return ScriptedChatModel(model=model, script=load_fake_script())
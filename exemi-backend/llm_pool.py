@@ -0,0 +1,276 @@
+import os
+import time
+import asyncio
+import logging
+import httpx
+from typing import Any, AsyncIterator
+from pydantic import PrivateAttr
+from ollama import ResponseError
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult, ChatGenerationChunk
+from langchain_ollama import ChatOllama
+from dotenv import load_dotenv
+
+"""
+Spreads LLM requests over several Ollama servers.
+
+LLM_API_URLS lists the Ollama servers (comma-separated). It defaults
+to LLM_API_URL, so a single server needs no extra configuration.
+Each request is sent to the server with the fewest outstanding
+requests, preferring servers which already have LLM_MODEL loaded
+(so the model stays warm on them) and then the fastest one.
+
+Every LLM_PROBE_INTERVAL seconds, each server is asked which models
+it has loaded (``GET /api/ps``), which also measures its latency.
+A server which fails a probe, or LLM_ENDPOINT_FAILURES requests in
+a row, is only used when every other server is also down. If a
+request fails because its server is unreachable or returns a server
+error, it is retried on the next server, unless it has already
+streamed part of its response.
+
+Only the asynchronous model calls (``ainvoke``/``astream``, which
+llm_api uses throughout) go through the pool.
+"""
+
+load_dotenv()
+
+LLM_MODEL = os.environ["LLM_MODEL"]
+LLM_API_URLS = [
+    url.strip() for url in (os.environ.get("LLM_API_URLS") or os.environ["LLM_API_URL"]).split(",")
+    if url.strip()
+]
+
+# Pool settings. These can be overridden in the .env file.
+LLM_PROBE_INTERVAL = float(os.environ.get("LLM_PROBE_INTERVAL", 15))
+LLM_PROBE_TIMEOUT = float(os.environ.get("LLM_PROBE_TIMEOUT", 5))
+LLM_ENDPOINT_FAILURES = int(os.environ.get("LLM_ENDPOINT_FAILURES", 2))
+
+logger = logging.getLogger(__name__)
+
+def is_endpoint_error(e : Exception) -> bool:
+    """
+    Whether an LLM request failed because of its server (so it may
+    succeed on another server) rather than because of the request.
+    """
+    if isinstance(e, (ConnectionError, httpx.TransportError)): return True
+    if isinstance(e, ResponseError): return e.status_code >= 500
+    return False
+
+class LLMEndpoint:
+    """
+    An Ollama server and its health.
+
+    Attributes:
+        url (str): The server's base URL.
+        model (ChatOllama): The chat model bound to the server.
+        healthy (bool): Whether the server passed its last probe and has not failed since.
+        model_loaded (bool): Whether LLM_MODEL was loaded on the server at the last probe.
+        latency (float | None): Moving average of the probe latency in seconds.
+        outstanding (int): Requests currently sent to the server.
+    """
+    def __init__(self, url : str, model : ChatOllama):
+        self.url = url
+        self.model = model
+        self.healthy = True
+        self.model_loaded = False
+        self.latency : float | None = None
+        self.outstanding = 0
+        self.failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.last_error : str | None = None
+
+    def record_success(self):
+        self.requests += 1
+        self.failures = 0
+        self.healthy = True
+
+    def record_failure(self, e : Exception, failure_threshold : int):
+        self.requests += 1
+        self.errors += 1
+        self.failures += 1
+        self.last_error = str(e)
+        if self.failures >= failure_threshold:
+            self.healthy = False
+
+class LLMPool:
+    """
+    A set of Ollama servers which serve the same model.
+
+    Args:
+        urls (list[str]): The servers' base URLs.
+        model (str): The model to use. Defaults to LLM_MODEL.
+        probe_interval (float, optional): Seconds between health probes. Defaults to LLM_PROBE_INTERVAL.
+        probe_timeout (float, optional): Seconds before a probe fails. Defaults to LLM_PROBE_TIMEOUT.
+        failure_threshold (int, optional): Failed requests in a row before a server is marked unhealthy. Defaults to LLM_ENDPOINT_FAILURES.
+        **model_kwargs: Other ChatOllama arguments (e.g., temperature).
+    """
+
+    def __init__(
+        self,
+        urls : list[str],
+        model : str = LLM_MODEL,
+        probe_interval : float = LLM_PROBE_INTERVAL,
+        probe_timeout : float = LLM_PROBE_TIMEOUT,
+        failure_threshold : int = LLM_ENDPOINT_FAILURES,
+        **model_kwargs : Any
+    ):
+        self.model = model
+        self.model_kwargs = model_kwargs
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.endpoints = [
+            LLMEndpoint(url, ChatOllama(base_url=url, model=model, **model_kwargs))
+            for url in urls
+        ]
+        self._probe_task : asyncio.Task | None = None
+
+    def get_endpoints_to_try(self) -> list[LLMEndpoint]:
+        """
+        Order the servers in which to try a request: healthy servers with
+        the fewest outstanding requests first (preferring servers with the
+        model loaded, then lower latency), followed by unhealthy servers.
+        """
+        def key(endpoint : LLMEndpoint):
+            latency = endpoint.latency if endpoint.latency is not None else float("inf")
+            return (not endpoint.healthy, endpoint.outstanding, not endpoint.model_loaded, latency)
+        return sorted(self.endpoints, key=key)
+
+    def create_chat_model(self) -> "PooledChatOllama":
+        """
+        Create a chat model which sends its requests to this pool.
+        """
+        chat_model = PooledChatOllama(base_url=self.endpoints[0].url, model=self.model, **self.model_kwargs)
+        chat_model._pool = self
+        return chat_model
+
+    async def probe(self, client : httpx.AsyncClient, endpoint : LLMEndpoint):
+        """
+        Check whether a server is reachable and has the model loaded.
+        """
+        started = time.monotonic()
+        try:
+            response = await client.get(f"{endpoint.url.rstrip('/')}/api/ps")
+            response.raise_for_status()
+            loaded = response.json().get("models", [])
+        except Exception as e:
+            if endpoint.healthy: logger.warning("LLM server %s is unreachable: %s", endpoint.url, e)
+            endpoint.healthy = False
+            endpoint.last_error = str(e)
+            return
+
+        latency = time.monotonic() - started
+        endpoint.latency = latency if endpoint.latency is None else 0.7 * endpoint.latency + 0.3 * latency
+        endpoint.model_loaded = any(self.model in (model.get("name"), model.get("model")) for model in loaded)
+        endpoint.healthy = True
+        endpoint.failures = 0
+
+    async def probe_all(self):
+        async with httpx.AsyncClient(timeout=self.probe_timeout) as client:
+            await asyncio.gather(*[self.probe(client, endpoint) for endpoint in self.endpoints])
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await self.probe_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not probe the LLM servers")
+            await asyncio.sleep(self.probe_interval)
+
+    def start(self):
+        """
+        Start probing the servers (call from the app's lifespan).
+        """
+        if self._probe_task is None:
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is None: return
+        self._probe_task.cancel()
+        await asyncio.gather(self._probe_task, return_exceptions=True)
+        self._probe_task = None
+
+    def stats(self) -> dict:
+        return {
+            "model" : self.model,
+            "endpoints" : [
+                {
+                    "url" : endpoint.url,
+                    "healthy" : endpoint.healthy,
+                    "model_loaded" : endpoint.model_loaded,
+                    "latency_seconds" : endpoint.latency,
+                    "outstanding" : endpoint.outstanding,
+                    "requests" : endpoint.requests,
+                    "errors" : endpoint.errors,
+                    "last_error" : endpoint.last_error
+                }
+                for endpoint in self.endpoints
+            ]
+        }
+
+class PooledChatOllama(ChatOllama):
+    """
+    ChatOllama which sends each request to a server of an LLMPool
+    (see ``LLMPool.create_chat_model``). Tool binding and structured
+    output work as with ChatOllama, since they only add arguments
+    which are passed on to the chosen server.
+    """
+    _pool : LLMPool = PrivateAttr()
+
+    async def _agenerate(
+        self,
+        messages : list[BaseMessage],
+        stop : list[str] | None = None,
+        run_manager : Any = None,
+        **kwargs : Any
+    ) -> ChatResult:
+        error : Exception | None = None
+        for endpoint in self._pool.get_endpoints_to_try():
+            endpoint.outstanding += 1
+            try:
+                result = await endpoint.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as e:
+                if not is_endpoint_error(e): raise
+                endpoint.record_failure(e, self._pool.failure_threshold)
+                logger.warning("LLM server %s failed, trying the next server: %s", endpoint.url, e)
+                error = e
+                continue
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.record_success()
+            return result
+        raise error or ConnectionError("No LLM servers are configured")
+
+    async def _astream(
+        self,
+        messages : list[BaseMessage],
+        stop : list[str] | None = None,
+        run_manager : Any = None,
+        **kwargs : Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        error : Exception | None = None
+        for endpoint in self._pool.get_endpoints_to_try():
+            streamed = False
+            endpoint.outstanding += 1
+            try:
+                async for chunk in endpoint.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    streamed = True
+                    yield chunk
+            except Exception as e:
+                if not is_endpoint_error(e): raise
+                endpoint.record_failure(e, self._pool.failure_threshold)
+                # Part of the response was already sent, so it cannot be retried
+                if streamed: raise
+                logger.warning("LLM server %s failed, trying the next server: %s", endpoint.url, e)
+                error = e
+                continue
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.record_success()
+            return
+        raise error or ConnectionError("No LLM servers are configured")
+
+llm_pool = LLMPool(LLM_API_URLS)
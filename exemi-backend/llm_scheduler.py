@@ -0,0 +1,210 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Literal
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+"""
+Admission control for requests to the LLM server.
+
+Ollama only generates LLM_MAX_CONCURRENCY responses at a time
+(OLLAMA_NUM_PARALLEL) and queues the rest in arrival order, so a
+few task generation requests could delay every student's chat
+reply by tens of seconds. Every LLM request now waits for one of
+LLM_MAX_CONCURRENCY slots, and free slots are handed out:
+
+- by priority: chat replies first, then task autofill, then task
+  generation, then background work (summaries and biographies);
+- within a priority, round-robin between users, so that one user
+  with many queued requests cannot starve the others.
+
+When LLM_MAX_QUEUE requests are already waiting, new requests are
+rejected with a 503 and a Retry-After header.
+
+NOTE: The scheduler is held in memory, so each worker process
+schedules its own requests. If the API runs in several processes,
+divide the LLM server's parallel slots between them.
+"""
+
+load_dotenv()
+
+# Scheduler settings. These can be overridden in the .env file.
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", 64))
+LLM_RETRY_AFTER = int(os.environ.get("LLM_RETRY_AFTER", 10))
+
+LLMPriority = Literal["chat", "autofill", "tasks", "background"]
+
+# From highest to lowest priority
+LLM_PRIORITIES : tuple[LLMPriority, ...] = ("chat", "autofill", "tasks", "background")
+
+class LLMPriorityStats:
+    """
+    Counters of the requests of one priority.
+    """
+    def __init__(self):
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+class LLMScheduler:
+    """
+    Limits the number of concurrent LLM requests and decides
+    which waiting request is admitted when a slot is freed.
+
+    Args:
+        max_concurrency (int, optional): Number of LLM requests handled at once. Defaults to LLM_MAX_CONCURRENCY.
+        max_queue (int, optional): Number of waiting requests before new requests are rejected. Defaults to LLM_MAX_QUEUE.
+        retry_after (int, optional): Seconds after which rejected clients are told to retry. Defaults to LLM_RETRY_AFTER.
+    """
+
+    def __init__(
+        self,
+        max_concurrency : int = LLM_MAX_CONCURRENCY,
+        max_queue : int = LLM_MAX_QUEUE,
+        retry_after : int = LLM_RETRY_AFTER
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+
+        self._active = 0
+        self._queued = 0
+        # The waiting requests of each priority, grouped by user.
+        # Users are served in the order of the OrderedDict, and moved
+        # to its end once served, so that users take turns.
+        self._waiting : dict[LLMPriority, OrderedDict[int | None, deque[asyncio.Future]]] = {
+            priority : OrderedDict() for priority in LLM_PRIORITIES
+        }
+        self._stats : dict[LLMPriority, LLMPriorityStats] = {
+            priority : LLMPriorityStats() for priority in LLM_PRIORITIES
+        }
+
+    def check_capacity(self, priority : LLMPriority):
+        """
+        Reject a request if the queue is full. Call this before
+        starting a streaming response, since a request cannot be
+        rejected once the response has started.
+
+        Raises:
+            HTTPException: Raises a 503 (with a Retry-After header) if LLM_MAX_QUEUE requests are waiting.
+        """
+        if self._queued < self.max_queue: return
+        self._stats[priority].rejected += 1
+        raise HTTPException(
+            status_code=503,
+            detail="The assistant is busy. Please try again in a moment.",
+            headers={"Retry-After" : str(self.retry_after)}
+        )
+
+    async def acquire(
+        self,
+        user_id : int | None,
+        priority : LLMPriority,
+        check_capacity : bool = True
+    ) -> float:
+        """
+        Wait for a free LLM slot. Call ``release`` once the LLM has responded.
+
+        Args:
+            user_id (int | None): The user the request is made for (None for system requests).
+            priority (LLMPriority): The priority of the request.
+            check_capacity (bool, optional): Whether to reject the request if the queue is full. Defaults to True.
+
+        Raises:
+            HTTPException: Raises a 503 if check_capacity is True and the queue is full.
+
+        Returns:
+            float: How many seconds the request waited for the slot.
+        """
+        started = time.monotonic()
+
+        if self._active < self.max_concurrency and not self._queued:
+            self._active += 1
+        else:
+            if check_capacity: self.check_capacity(priority)
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiting[priority].setdefault(user_id, deque()).append(waiter)
+            self._queued += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.cancelled():
+                    self._remove_waiter(priority, user_id, waiter)
+                else:
+                    # The slot was handed over just before the cancellation
+                    self.release()
+                raise
+
+        wait_seconds = time.monotonic() - started
+        stats = self._stats[priority]
+        stats.admitted += 1
+        stats.wait_seconds += wait_seconds
+        stats.max_wait_seconds = max(stats.max_wait_seconds, wait_seconds)
+        return wait_seconds
+
+    def release(self):
+        """
+        Free an LLM slot, handing it over to the next waiting request (if any).
+        """
+        for priority in LLM_PRIORITIES:
+            users = self._waiting[priority]
+            while users:
+                user_id, waiters = next(iter(users.items()))
+                waiter = waiters.popleft()
+                if waiters: users.move_to_end(user_id)
+                else: del users[user_id]
+                self._queued -= 1
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._active -= 1
+
+    def _remove_waiter(self, priority : LLMPriority, user_id : int | None, waiter : asyncio.Future):
+        waiters = self._waiting[priority].get(user_id)
+        if not waiters or waiter not in waiters: return
+        waiters.remove(waiter)
+        if not waiters: del self._waiting[priority][user_id]
+        self._queued -= 1
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        user_id : int | None,
+        priority : LLMPriority,
+        check_capacity : bool = True
+    ) -> AsyncIterator[float]:
+        """
+        Hold an LLM slot for the duration of the ``async with`` block (see ``acquire``).
+        The block receives how many seconds the request waited for the slot.
+        """
+        wait_seconds = await self.acquire(user_id, priority, check_capacity)
+        try:
+            yield wait_seconds
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency" : self.max_concurrency,
+            "active" : self._active,
+            "queued" : self._queued,
+            "max_queue" : self.max_queue,
+            "priorities" : {
+                priority : {
+                    "queued" : sum(len(waiters) for waiters in self._waiting[priority].values()),
+                    "admitted" : stats.admitted,
+                    "rejected" : stats.rejected,
+                    "mean_wait_seconds" : stats.wait_seconds / stats.admitted if stats.admitted else 0.0,
+                    "max_wait_seconds" : stats.max_wait_seconds
+                }
+                for priority, stats in self._stats.items()
+            }
+        }
+
+llm_scheduler = LLMScheduler()
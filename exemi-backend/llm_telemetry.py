@@ -0,0 +1,252 @@
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Literal
+from zoneinfo import ZoneInfo
+from langchain_core.messages import BaseMessage
+from sqlalchemy import Select, and_, case, func, select
+from sqlalchemy.sql.elements import ColumnElement
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .models import LLMTelemetry
+from .dependencies import get_async_engine
+
+"""
+Records how long each LLM call took and how many tokens it used.
+
+``chat``, ``chat_stream``, ``create_tasks_for_user``,
+``autofill_task_for_user``, ``summarise`` and ``update_user_bio``
+each measure their LLM call with an ``LLMCallTelemetry`` and save
+it as an ``LLMTelemetry`` row, linked to the user and (for chats)
+the conversation and the assistant message. The token counts and
+prompt/generation times are the ones reported by Ollama. Admins can
+see the total, median and 95th percentile of each measure by endpoint
+and by day (see ``aggregate_llm_telemetry`` and ``GET /llm_telemetry``),
+e.g., to check whether longer prompts are slowing replies down. These
+are computed by the database (with window functions), so the rows are
+never loaded into Python.
+"""
+
+LLMEndpointName = Literal["chat", "chat_stream", "create_tasks", "autofill", "summarise", "update_user_bio"]
+
+# Days are grouped by the students' timezone
+TELEMETRY_TIMEZONE = ZoneInfo("Australia/Sydney")
+
+# The measures summarised by aggregate_llm_telemetry
+TELEMETRY_MEASURES = [
+    "total_seconds", "first_token_seconds", "queue_seconds", "prompt_build_seconds",
+    "prompt_tokens", "completion_tokens", "tool_calls"
+]
+
+logger = logging.getLogger(__name__)
+
+class LLMCallTelemetry:
+    """
+    Measures one LLM call, which may consist of
+    several model calls (e.g., an agent's tool loop).
+
+    Args:
+        endpoint (LLMEndpointName): The function which calls the LLM.
+        user_id (int | None, optional): The user the call is made for. Defaults to None.
+        conversation_id (int | None, optional): The conversation the call responds to. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        endpoint : LLMEndpointName,
+        user_id : int | None = None,
+        conversation_id : int | None = None
+    ):
+        self.endpoint = endpoint
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.created_at = datetime.now(timezone.utc)
+        self.started_at = time.monotonic()
+        self.finished_at : float | None = None
+        self.first_token_at : float | None = None
+
+        self.model : str | None = None
+        self.prompt_tokens : int | None = None
+        self.completion_tokens : int | None = None
+        self.prompt_build_seconds : float | None = None
+        self.queue_seconds = 0.0
+        self.prompt_eval_seconds : float | None = None
+        self.eval_seconds : float | None = None
+        self.tool_calls = 0
+
+    def first_token(self):
+        if self.first_token_at is None: self.first_token_at = time.monotonic()
+
+    def finish(self):
+        if self.finished_at is None: self.finished_at = time.monotonic()
+
+    @property
+    def total_seconds(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def first_token_seconds(self) -> float | None:
+        if self.first_token_at is None: return None
+        return self.first_token_at - self.started_at
+
+    def add_message(self, message : BaseMessage, count_tool_calls : bool = True):
+        """
+        Add the token counts and timings Ollama reported for a model
+        call, from its response (or the last chunk of its stream).
+
+        Args:
+            message (BaseMessage): The response message or chunk.
+            count_tool_calls (bool, optional): Whether to count the message's tool calls. Defaults to True.
+        """
+        metadata = message.response_metadata
+        self.model = metadata.get("model_name") or metadata.get("model") or self.model
+
+        def add(total : int | float | None, value : int | float | None):
+            if value is None: return total
+            return (total or 0) + value
+
+        self.prompt_tokens = add(self.prompt_tokens, metadata.get("prompt_eval_count"))
+        self.completion_tokens = add(self.completion_tokens, metadata.get("eval_count"))
+        if metadata.get("prompt_eval_duration") is not None:
+            self.prompt_eval_seconds = add(self.prompt_eval_seconds, metadata["prompt_eval_duration"] / 1e9)
+        if metadata.get("eval_duration") is not None:
+            self.eval_seconds = add(self.eval_seconds, metadata["eval_duration"] / 1e9)
+
+        if count_tool_calls:
+            self.tool_calls += len(getattr(message, "tool_calls", None) or [])
+
+    @property
+    def tokens_per_second(self) -> float | None:
+        if not self.completion_tokens or not self.eval_seconds: return None
+        return self.completion_tokens / self.eval_seconds
+
+    def to_model(self, message_id : int | None = None) -> LLMTelemetry:
+        self.finish()
+        return LLMTelemetry(
+            created_at=self.created_at,
+            endpoint=self.endpoint,
+            model=self.model,
+            user_id=self.user_id,
+            conversation_id=self.conversation_id,
+            message_id=message_id,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+            prompt_build_seconds=self.prompt_build_seconds,
+            queue_seconds=self.queue_seconds,
+            prompt_eval_seconds=self.prompt_eval_seconds,
+            eval_seconds=self.eval_seconds,
+            first_token_seconds=self.first_token_seconds,
+            total_seconds=self.total_seconds,
+            tool_calls=self.tool_calls
+        )
+
+async def save_llm_telemetry(telemetry : LLMCallTelemetry, message_id : int | None = None):
+    """
+    Save the telemetry of an LLM call. Errors are logged rather
+    than raised, so that telemetry never fails an LLM call.
+    """
+    try:
+        async with AsyncSession(get_async_engine()) as session:
+            session.add(telemetry.to_model(message_id=message_id))
+            await session.commit()
+    except Exception:
+        logger.exception("Could not save the telemetry of an LLM call (%s)", telemetry.endpoint)
+
+def telemetry_day(since : datetime, until : datetime) -> ColumnElement[str]:
+    """
+    Obtain an SQL expression for the day (YYYY-MM-DD in TELEMETRY_TIMEZONE)
+    each LLMTelemetry row between two times was created on. It compares
+    created_at (UTC) with the start of each day, so that the database
+    needs no timezone tables.
+    """
+    first_day = since.astimezone(TELEMETRY_TIMEZONE).date()
+    last_day = until.astimezone(TELEMETRY_TIMEZONE).date()
+    days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+
+    def day_start(day) -> datetime:
+        return datetime(day.year, day.month, day.day, tzinfo=TELEMETRY_TIMEZONE).astimezone(timezone.utc)
+
+    return case(
+        *[(LLMTelemetry.created_at >= day_start(day), day.isoformat()) for day in reversed(days)],
+        else_=first_day.isoformat()
+    )
+
+def summarise_llm_telemetry_query(groups : dict[str, ColumnElement], since : datetime) -> Select:
+    """
+    Obtain a query which summarises the telemetry created since a time by some groups.
+
+    Each row has the group's columns, the number of calls ("calls"), and the sum
+    ("<measure>_sum"), median ("<measure>_p50") and 95th percentile ("<measure>_p95")
+    of each measure in TELEMETRY_MEASURES. The percentiles are nearest rank: the
+    smallest value whose rank (among the group's values which are not NULL)
+    is at least 50% (or 95%) of their count.
+
+    Args:
+        groups (dict[str, ColumnElement]): The name and SQL expression of each column to group by.
+        since (datetime): The earliest telemetry to include.
+    """
+    partition = list(groups.values())
+    ranked_columns = [expression.label(name) for name, expression in groups.items()]
+    for measure in TELEMETRY_MEASURES:
+        value = getattr(LLMTelemetry, measure)
+        ranked_columns += [
+            value.label(measure),
+            # NULLs are ranked last, so the values are ranked 1 to their count
+            func.row_number().over(
+                partition_by=partition,
+                order_by=(case((value.is_(None), 1), else_=0), value)
+            ).label(f"{measure}_rank"),
+            func.count(value).over(partition_by=partition).label(f"{measure}_count")
+        ]
+    ranked = select(*ranked_columns).where(LLMTelemetry.created_at >= since).subquery()
+
+    group_columns = [ranked.c[name] for name in groups]
+    columns = group_columns + [func.count().label("calls")]
+    for measure in TELEMETRY_MEASURES:
+        value, rank, count = ranked.c[measure], ranked.c[f"{measure}_rank"], ranked.c[f"{measure}_count"]
+        columns.append(func.sum(value).label(f"{measure}_sum"))
+        for q in (50, 95):
+            columns.append(
+                func.min(case((and_(value.is_not(None), rank * 100 >= count * q), value))).label(f"{measure}_p{q}")
+            )
+    return select(*columns).group_by(*group_columns).order_by(*group_columns)
+
+async def aggregate_llm_telemetry(session : AsyncSession, since : datetime) -> dict:
+    """
+    Summarise the telemetry created since a time by endpoint and by day (and endpoint).
+
+    Args:
+        session (AsyncSession): The database session.
+        since (datetime): The earliest telemetry to include.
+
+    Returns:
+        dict:
+            "by_endpoint" maps each endpoint, and "by_day" each day (YYYY-MM-DD)
+            and endpoint, to the number of calls and the sum, median ("p50") and
+            95th percentile ("p95") of each measure in TELEMETRY_MEASURES.
+    """
+    def number(value : int | float | Decimal | None) -> int | float | None:
+        # MariaDB sums integer columns as DECIMAL
+        if isinstance(value, Decimal): return int(value) if value == value.to_integral_value() else float(value)
+        return value
+
+    def summarise(row) -> dict:
+        summary : dict = {"calls" : row.calls}
+        for measure in TELEMETRY_MEASURES:
+            summary[measure] = {
+                statistic : number(row._mapping[f"{measure}_{statistic}"])
+                for statistic in ("sum", "p50", "p95")
+            }
+        return summary
+
+    day = telemetry_day(since, datetime.now(timezone.utc))
+    by_endpoint = await session.execute(summarise_llm_telemetry_query({"endpoint" : LLMTelemetry.endpoint}, since))
+    by_day = await session.execute(summarise_llm_telemetry_query({"day" : day, "endpoint" : LLMTelemetry.endpoint}, since))
+
+    summary : dict = {
+        "by_endpoint" : {row.endpoint : summarise(row) for row in by_endpoint},
+        "by_day" : {}
+    }
+    for row in by_day:
+        summary["by_day"].setdefault(row.day, {})[row.endpoint] = summarise(row)
+    return summary
@@ -1,331 +1,377 @@
 from datetime import datetime
-from langchain.tools import tool, BaseTool
+from pydantic import BaseModel
+from langchain.tools import tool, BaseTool, ToolRuntime
 from .routers.reminders import create_reminder, delete_reminder
 from .routers.tasks import create_task_for_self, update_task, delete_task
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from .models import User, UserBiographyCreate, UserBiography, ReminderCreate
 from .models import Task, TaskPublic, TaskCreate, TaskUpdate, UsersAssignments
 from .date_utils import parse_timestamp
-from .dependencies import get_engine
+from .dependencies import get_engine, get_async_engine
 from fastapi import HTTPException
 
-def create_tools(
-    user : User,
-    session : Session
-) -> list[BaseTool]:
-    def _resolve_task_id_for_user(
-        task_id: int | None,
-        task_name: str | None,
-        session: Session,
-    ) -> tuple[int | None, str | None]:
-        """
-        Resolve a task ID from explicit ID or exact task name for the current user.
-        Returns (task_id, error_message). If error_message is not None, the caller should abort.
-        """
-        if task_id is not None:
-            return task_id, None
-
-        if not task_name:
-            return None, "Error: missing task identifier. Provide task_id or task_name."
-
-        candidates = session.exec(
-            select(Task)
-            .where(Task.user_id == user.id)
-            .where(Task.name == task_name)
-            .where(Task.completed == False)
-            .order_by(Task.due_at)
-        ).all()
-
-        if len(candidates) == 0:
-            return None, f'Error: no incomplete task found with name "{task_name}".'
-        if len(candidates) > 1:
-            return None, (
-                f'Error: multiple incomplete tasks found with name "{task_name}". '
-                "Please provide task_id."
-            )
+"""
+LLM tools which manage database entities for the current user.
+
+The tools are created once, so that the chat agent (see llm_api.py)
+can be compiled once. The current user is not captured when the
+tools are created: each call reads it from the agent's runtime
+context (``AgentContext``), which is passed to ``agent.ainvoke``
+or ``agent.astream``.
+
+The task tools read from the database through their own
+AsyncSession, so that they do not block the event loop while
+the agent runs. Writes reuse the synchronous task routes
+through ``AsyncSession.run_sync``. The session is not shared
+through the runtime context, since the agent may run several
+tool calls of one reply at once, and a session must not be
+used by several tasks at once.
+"""
+
+class AgentContext(BaseModel):
+    """
+    Runtime context of a chat agent call.
 
-        return candidates[0].id, None
+    Attributes:
+        user (User): The current logged in user.
+        system_prompt (str): The user's system prompt.
+        queue_seconds (float): How long the agent's model calls have waited for an LLM slot.
+    """
+    user : User
+    system_prompt : str
+    queue_seconds : float = 0
 
+async def _resolve_task_id_for_user(
+    task_id: int | None,
+    task_name: str | None,
+    user : User,
+    session: AsyncSession,
+) -> tuple[int | None, str | None]:
+    """
+    Resolve a task ID from explicit ID or exact task name for the current user.
+    Returns (task_id, error_message). If error_message is not None, the caller should abort.
     """
-    Create LLM tools to manage database
-    entities for the current user.
+    if task_id is not None:
+        return task_id, None
+
+    if not task_name:
+        return None, "Error: missing task identifier. Provide task_id or task_name."
+
+    candidates = (await session.exec(
+        select(Task)
+        .where(Task.user_id == user.id)
+        .where(Task.name == task_name)
+        .where(Task.completed == False)
+        .order_by(Task.due_at)
+    )).all()
+
+    if len(candidates) == 0:
+        return None, f'Error: no incomplete task found with name "{task_name}".'
+    if len(candidates) > 1:
+        return None, (
+            f'Error: multiple incomplete tasks found with name "{task_name}". '
+            "Please provide task_id."
+        )
 
-    Args:
-        user (User): The current logged in user.
-        session (Session): Connection to the SQL database.
+    return candidates[0].id, None
+
+# @tool
+# async def get_assignments_from_Canvas() -> str:
+#     """
+#     Retrieve a markdown-formatted list of the student's incomplete assignments.
+
+#     Returns:
+#         str: List of the student's incomplete assignments.
+#     """
+
+#     return str(get_assignments_list_json(user=user, session=session))
+
+@tool
+async def add_information_to_student_biography(
+    information : str,
+    runtime : ToolRuntime[AgentContext]
+) -> str:
+    """
+    When the user discloses peronsal information
+    such as their learning goals, strengths,
+    or challenges, use this tool to remember this
+    information for later. DO NOT use this tool to
+    store the user's units, assignments, or assignment
+    tasks; focus only on PERSONAL information. DO use
+    this tool to remember the user's name, comorbidities,
+    learning disorders, preferred study venues,
+    effective study strategies, etc.
 
     Returns:
-        list[BaseTool]: The LLM tools.
+        str: Memory success message.
     """
 
-    # @tool
-    # async def get_assignments_from_Canvas() -> str:
-    #     """
-    #     Retrieve a markdown-formatted list of the student's incomplete assignments.
-
-    #     Returns:
-    #         str: List of the student's incomplete assignments.
-    #     """
-
-    #     return str(get_assignments_list_json(user=user, session=session))
-    
-    @tool
-    async def add_information_to_student_biography(information : str) -> str:
-        """
-        When the user discloses peronsal information
-        such as their learning goals, strengths,
-        or challenges, use this tool to remember this
-        information for later. DO NOT use this tool to
-        store the user's units, assignments, or assignment
-        tasks; focus only on PERSONAL information. DO use
-        this tool to remember the user's name, comorbidities,
-        learning disorders, preferred study venues,
-        effective study strategies, etc.
-
-        Returns:
-            str: Memory success message.
-        """
-        
-        from .routers.users import update_user_biography
-        
-        with Session(get_engine()) as tool_session:
-            await update_user_biography(
-                UserBiographyCreate(
-                    content=information
-                ),
-                max_words=300,
-                user=user,
-                session=tool_session
-            )
+    from .routers.users import update_user_biography
+
+    user = runtime.context.user
 
-        return "Student biography successfully updated."
-
-    @tool
-    def create_assignment_task_for_student(
-        assignment_id : int,
-        name : str,
-        description : str,
-        duration_mins : int,
-        due_at : str | None = None,
-        due_date : str | None = None
-    ) -> str:
-        """
-        Create a task representing a small chunk
-        of one of the student's assignments and
-        assign this task to the student to complete
-        on a specific date.
-
-        Args:
-            assignment_id (int): The ID number of the student's assignment which this task references.
-            name (str): The name of the task in the format "<Shortened assignment name>: <Task name>".
-            description (str): Summary of what steps are needed to complete the task.
-            duration_mins (int): An estimation of how many minutes the student will need to complete this task.
-            due_at (str | None): Which date the student must work on this task in ISO 8601 format (YYYY-MM-DD).
-            due_date (str | None): Deprecated alias of `due_at` for backward compatibility.
-
-        Returns:
-            str: Task creation success or failure message.
-        """
-        
-        # Check the assignment given exists and that the user has it
-        user_assignment = session.exec(
-            select(UsersAssignments)
-            .where(UsersAssignments.user_id == user.id)
-            .where(UsersAssignments.assignment_id == assignment_id)
-        ).first()
-
-        if not user_assignment:
-            return f"Error creating task: the student does not have the assignment with ID {assignment_id}."
-
-        due_value = due_at or due_date
-        if not due_value:
-            return "Error creating task: missing due date. Use due_at in YYYY-MM-DD format."
-
-        # Convert due date into an Australian timestamp
-        try:
-            due_at_timestamp = datetime.fromisoformat(due_value)
-        except ValueError:
-            return f"Error creating task: your due date {due_value} was not in the format YYYY-MM-DD."
-        
-        due_at_timestamp = parse_timestamp(due_at_timestamp)
-        if not due_at_timestamp:
-            return f"Error creating task: your due date {due_value} was not in the format YYYY-MM-DD."
-
-        data = TaskCreate(
-            name = name,
-            assignment_id = assignment_id,
-            description = description,
-            due_at = due_at_timestamp,
-            duration_mins = duration_mins
+    with Session(get_engine()) as tool_session:
+        await update_user_biography(
+            UserBiographyCreate(
+                content=information
+            ),
+            max_words=300,
+            user=user,
+            session=tool_session
         )
 
-        try:
-            with Session(get_engine()) as tool_session:
-                create_task_for_self(
+    return "Student biography successfully updated."
+
+@tool
+async def create_assignment_task_for_student(
+    assignment_id : int,
+    name : str,
+    description : str,
+    duration_mins : int,
+    runtime : ToolRuntime[AgentContext],
+    due_at : str | None = None,
+    due_date : str | None = None
+) -> str:
+    """
+    Create a task representing a small chunk
+    of one of the student's assignments and
+    assign this task to the student to complete
+    on a specific date.
+
+    Args:
+        assignment_id (int): The ID number of the student's assignment which this task references.
+        name (str): The name of the task in the format "<Shortened assignment name>: <Task name>".
+        description (str): Summary of what steps are needed to complete the task.
+        duration_mins (int): An estimation of how many minutes the student will need to complete this task.
+        due_at (str | None): Which date the student must work on this task in ISO 8601 format (YYYY-MM-DD).
+        due_date (str | None): Deprecated alias of `due_at` for backward compatibility.
+
+    Returns:
+        str: Task creation success or failure message.
+    """
+    user = runtime.context.user
+
+    due_value = due_at or due_date
+    if not due_value:
+        return "Error creating task: missing due date. Use due_at in YYYY-MM-DD format."
+
+    # Convert due date into an Australian timestamp
+    try:
+        due_at_timestamp = datetime.fromisoformat(due_value)
+    except ValueError:
+        return f"Error creating task: your due date {due_value} was not in the format YYYY-MM-DD."
+
+    due_at_timestamp = parse_timestamp(due_at_timestamp)
+    if not due_at_timestamp:
+        return f"Error creating task: your due date {due_value} was not in the format YYYY-MM-DD."
+
+    data = TaskCreate(
+        name = name,
+        assignment_id = assignment_id,
+        description = description,
+        due_at = due_at_timestamp,
+        duration_mins = duration_mins
+    )
+
+    try:
+        # One session checks the assignment and creates the task
+        async with AsyncSession(get_async_engine(), expire_on_commit=False) as tool_session:
+            # Check the assignment given exists and that the user has it
+            user_assignment = (await tool_session.exec(
+                select(UsersAssignments)
+                .where(UsersAssignments.user_id == user.id)
+                .where(UsersAssignments.assignment_id == assignment_id)
+            )).first()
+
+            if not user_assignment:
+                return f"Error creating task: the student does not have the assignment with ID {assignment_id}."
+
+            await tool_session.run_sync(
+                lambda sync_session: create_task_for_self(
                     data=data,
                     user=user,
-                    session=tool_session
+                    session=sync_session
                 )
-            return "Task created successfully!"
-        # Invalid task errors will throw a HTTPException
-        except HTTPException as e:
-            return f"Error creating task: {e.detail}"
-        except Exception:
-            return "Error creating task: database error. Do NOT try again."
-
-    @tool
-    def update_assignment_task_for_student(
-        task_id : int | None = None,
-        task_name : str | None = None,
-        name : str | None = None,
-        description : str | None = None,
-        duration_mins : int | None = None,
-        due_at : str | None = None
-    ) -> str:
-        """
-        Update one of the student's assignment
-        tasks by replacing one or more of its
-        fields with new values.
-
-        Args:
-            task_id (int | None): ID of the task to modify.
-            task_name (str | None): Exact task name to resolve task ID when `task_id` is unknown.
-            name (str | None, optional): New name for the task in the format "<Shortened assignment name>: <Task name>". Defaults to None.
-            description (str | None, optional): New summary of what steps are needed to complete the task. Defaults to None.
-            duration_mins (int | None, optional): New estimation of how many minutes the student will need to complete this task. Defaults to None.
-            due_at (str | None, optional): New date the student must work on this task in ISO 8601 format (YYYY-MM-DD). Defaults to None.
-
-        Returns:
-            str: Task update success or failure message.
-        """
-        
-        new_data = TaskUpdate(
-            name=name,
-            description=description,
-            duration_mins=duration_mins,
-            due_at=due_at
-        )
+            )
+        return "Task created successfully!"
+    # Invalid task errors will throw a HTTPException
+    except HTTPException as e:
+        return f"Error creating task: {e.detail}"
+    except Exception:
+        return "Error creating task: database error. Do NOT try again."
+
+@tool
+async def update_assignment_task_for_student(
+    runtime : ToolRuntime[AgentContext],
+    task_id : int | None = None,
+    task_name : str | None = None,
+    name : str | None = None,
+    description : str | None = None,
+    duration_mins : int | None = None,
+    due_at : str | None = None
+) -> str:
+    """
+    Update one of the student's assignment
+    tasks by replacing one or more of its
+    fields with new values.
 
-        try:
-            with Session(get_engine()) as tool_session:
-                resolved_task_id, resolve_error = _resolve_task_id_for_user(
-                    task_id=task_id,
-                    task_name=task_name,
-                    session=tool_session,
-                )
-                if resolve_error:
-                    return f"Error updating task: {resolve_error}"
-                if resolved_task_id is None:
-                    return "Error updating task: task ID resolution failed."
+    Args:
+        task_id (int | None): ID of the task to modify.
+        task_name (str | None): Exact task name to resolve task ID when `task_id` is unknown.
+        name (str | None, optional): New name for the task in the format "<Shortened assignment name>: <Task name>". Defaults to None.
+        description (str | None, optional): New summary of what steps are needed to complete the task. Defaults to None.
+        duration_mins (int | None, optional): New estimation of how many minutes the student will need to complete this task. Defaults to None.
+        due_at (str | None, optional): New date the student must work on this task in ISO 8601 format (YYYY-MM-DD). Defaults to None.
 
-                update_task(
+    Returns:
+        str: Task update success or failure message.
+    """
+    user = runtime.context.user
+
+    new_data = TaskUpdate(
+        name=name,
+        description=description,
+        duration_mins=duration_mins,
+        due_at=due_at
+    )
+
+    try:
+        async with AsyncSession(get_async_engine(), expire_on_commit=False) as tool_session:
+            resolved_task_id, resolve_error = await _resolve_task_id_for_user(
+                task_id=task_id,
+                task_name=task_name,
+                user=user,
+                session=tool_session,
+            )
+            if resolve_error:
+                return f"Error updating task: {resolve_error}"
+            if resolved_task_id is None:
+                return "Error updating task: task ID resolution failed."
+
+            await tool_session.run_sync(
+                lambda sync_session: update_task(
                     id=resolved_task_id,
                     new_data=new_data,
                     user=user,
-                    session=tool_session
+                    session=sync_session
                 )
-            return "Task updated successfully!"
-        except HTTPException as e:
-            return f"Error updating task: {e.detail}"
-        except Exception as e:
-            return f"Error updating task: {str(e)}"
-
-    @tool
-    def delete_assignment_task_for_student(
-        task_id : int | None = None,
-        task_name : str | None = None
-    ) -> str:
-        """
-        Delete one of the student's assignment tasks.
-
-        Args:
-            task_id (int | None): ID of the task to delete.
-            task_name (str | None): Exact task name to resolve task ID when `task_id` is unknown.
-
-        Returns:
-            str: Task deletion success or failure message.
-        """
-        try:
-            with Session(get_engine()) as tool_session:
-                resolved_task_id, resolve_error = _resolve_task_id_for_user(
-                    task_id=task_id,
-                    task_name=task_name,
-                    session=tool_session,
-                )
-                if resolve_error:
-                    return f"Error deleting task: {resolve_error}"
-                if resolved_task_id is None:
-                    return "Error deleting task: task ID resolution failed."
+            )
+        return "Task updated successfully!"
+    except HTTPException as e:
+        return f"Error updating task: {e.detail}"
+    except Exception as e:
+        return f"Error updating task: {str(e)}"
+
+@tool
+async def delete_assignment_task_for_student(
+    runtime : ToolRuntime[AgentContext],
+    task_id : int | None = None,
+    task_name : str | None = None
+) -> str:
+    """
+    Delete one of the student's assignment tasks.
 
-                delete_task(
+    Args:
+        task_id (int | None): ID of the task to delete.
+        task_name (str | None): Exact task name to resolve task ID when `task_id` is unknown.
+
+    Returns:
+        str: Task deletion success or failure message.
+    """
+    user = runtime.context.user
+    try:
+        async with AsyncSession(get_async_engine(), expire_on_commit=False) as tool_session:
+            resolved_task_id, resolve_error = await _resolve_task_id_for_user(
+                task_id=task_id,
+                task_name=task_name,
+                user=user,
+                session=tool_session,
+            )
+            if resolve_error:
+                return f"Error deleting task: {resolve_error}"
+            if resolved_task_id is None:
+                return "Error deleting task: task ID resolution failed."
+
+            await tool_session.run_sync(
+                lambda sync_session: delete_task(
                     id=resolved_task_id,
                     user=user,
-                    session=tool_session
+                    session=sync_session
                 )
-            return "Task deleted successfully!"
-        except HTTPException as e:
-            return f"Error deleting task: {e.detail}"
-        except Exception:
-            return "Error deleting task. Do NOT try again."
-
-    # @tool
-    # def set_reminder(task_name : str, due_date : str, description : str) -> str:
-    #     """
-    #     Create a reminder for the student to complete a task.
-    #     The dates should be provided in ISO 8601 format (YYYY-MM-DD).
-        
-    #     Args:
-    #         task_name (str): The name of the task to complete.
-    #         due_date (str): The date to remind the student in ISO 8601 format (YYYY-MM-DD).
-    #         description (str): What task the student needs to do. 
-        
-    #     Returns:
-    #         str: Reminder creation success or failure message. 
-    #     """
-        
-    #     # Convert due date into an Australian timestamp
-    #     try:
-    #         due_at = datetime.fromisoformat(due_date)
-    #     except ValueError:
-    #         return "Error creating reminder, please do NOT try again"
-
-    #     due_at = parse_timestamp(due_at)
-
-    #     if not due_at: return "Error creating reminder, please do NOT try again"
-
-    #     data = ReminderCreate(assignment_name=task_name, due_at=due_at, description=description)
-
-    #     try:
-    #         # Use an isolated DB session for tool-side writes.
-    #         # LangChain tool execution can re-enter request code paths, and
-    #         # sharing the request-scoped session can trigger transaction-state
-    #         # conflicts when commit() is called from inside a tool.
-    #         with Session(get_engine()) as tool_session:
-    #             create_reminder(data, user=user, session=tool_session)
-    #         return "Reminder created successfully!"
-    #     except Exception:
-    #         return "Error creating reminder, please do NOT try again"
-    
-    # @tool
-    # def remove_reminder(id : int) -> str:
-    #     """
-    #     Remove one of the student's active reminders.
-    #     Use this tool when the student has completed
-    #     the task you reminded them to do.
-
-    #     Args:
-    #         id (int): The ID of the reminder to remove.
-
-    #     Returns:
-    #         str: Reminder deletion success or failure message.
-    #     """
-    #     try:
-    #         with Session(get_engine()) as tool_session:
-    #             delete_task(id=id, user=user, session=tool_session)
-    #         return "Reminder deleted successfully!"
-    #     except Exception:
-    #         return "Error deleting reminder, please do NOT try again"
+            )
+        return "Task deleted successfully!"
+    except HTTPException as e:
+        return f"Error deleting task: {e.detail}"
+    except Exception:
+        return "Error deleting task. Do NOT try again."
+
+# @tool
+# def set_reminder(task_name : str, due_date : str, description : str) -> str:
+#     """
+#     Create a reminder for the student to complete a task.
+#     The dates should be provided in ISO 8601 format (YYYY-MM-DD).
+
+#     Args:
+#         task_name (str): The name of the task to complete.
+#         due_date (str): The date to remind the student in ISO 8601 format (YYYY-MM-DD).
+#         description (str): What task the student needs to do. 
+
+#     Returns:
+#         str: Reminder creation success or failure message. 
+#     """
+
+#     # Convert due date into an Australian timestamp
+#     try:
+#         due_at = datetime.fromisoformat(due_date)
+#     except ValueError:
+#         return "Error creating reminder, please do NOT try again"
+
+#     due_at = parse_timestamp(due_at)
+
+#     if not due_at: return "Error creating reminder, please do NOT try again"
+
+#     data = ReminderCreate(assignment_name=task_name, due_at=due_at, description=description)
+
+#     try:
+#         # Use an isolated DB session for tool-side writes.
+#         # LangChain tool execution can re-enter request code paths, and
+#         # sharing the request-scoped session can trigger transaction-state
+#         # conflicts when commit() is called from inside a tool.
+#         with Session(get_engine()) as tool_session:
+#             create_reminder(data, user=user, session=tool_session)
+#         return "Reminder created successfully!"
+#     except Exception:
+#         return "Error creating reminder, please do NOT try again"
+
+# @tool
+# def remove_reminder(id : int) -> str:
+#     """
+#     Remove one of the student's active reminders.
+#     Use this tool when the student has completed
+#     the task you reminded them to do.
+
+#     Args:
+#         id (int): The ID of the reminder to remove.
+
+#     Returns:
+#         str: Reminder deletion success or failure message.
+#     """
+#     try:
+#         with Session(get_engine()) as tool_session:
+#             delete_task(id=id, user=user, session=tool_session)
+#         return "Reminder deleted successfully!"
+#     except Exception:
+#         return "Error deleting reminder, please do NOT try again"
+
+def create_tools() -> list[BaseTool]:
+    """
+    Obtain the LLM tools. The tools read the current
+    user from the agent's runtime context (``AgentContext``).
 
+    Returns:
+        list[BaseTool]: The LLM tools.
+    """
     return [
         create_assignment_task_for_student,
         update_assignment_task_for_student,
@@ -1,4 +1,11 @@
-from .dependencies import get_session, get_engine
+from .dependencies import get_session, get_engine, get_async_engine, get_current_user
+from .query_profiler import query_profiler, QueryProfilerMiddleware
+from .models import User
+from .canvas_api import canvas_clients
+from .html_text import shutdown_process_pool
+from .summary_worker import summary_worker, SUMMARY_WORKER_ENABLED
+from .llm_pool import llm_pool
+from .llm_fake import LLM_BACKEND
 from contextlib import asynccontextmanager
 from fastapi import Depends, FastAPI, HTTPException, Query
 # from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -22,8 +29,15 @@ def create_db_and_tables(engine = get_engine()):
 async def lifespan(app : FastAPI):
     # Startup
     create_db_and_tables()
+    if LLM_BACKEND != "fake": llm_pool.start()
+    if SUMMARY_WORKER_ENABLED: summary_worker.start()
     yield
     # Shutdown
+    await summary_worker.stop()
+    await llm_pool.stop()
+    await canvas_clients.aclose()
+    await get_async_engine().dispose()
+    shutdown_process_pool()
 
 app = FastAPI(
     lifespan = lifespan,
@@ -58,10 +72,33 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Count the SQL statements sent while handling each request
+# (including while streaming the response) for each route
+app.add_middleware(QueryProfilerMiddleware, profiler=query_profiler)
+
 @app.get("/")
 def read_root():
     return "Exemi API is running :)"
 
+@app.get("/db/query_stats", response_model=dict)
+async def get_query_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain how many SQL statements each route sends (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict:
+            The total number of statements and slow statements, and for each route the number of requests,
+            the average and maximum statements per request, time spent in the database, and the number of
+            requests which repeated a statement often enough to be an N+1 query (with the repeated statements).
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return query_profiler.stats()
+
 # def get_session():
 #     with Session(engine) as session:
 #         yield session
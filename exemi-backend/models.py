@@ -2,8 +2,8 @@ from pydantic import BaseModel, computed_field, field_validator
 from sqlalchemy.orm import object_session
 from sqlmodel import SQLModel, Field, Relationship, Column, select
 from datetime import datetime, timezone
+from sqlalchemy import UniqueConstraint
 from sqlalchemy.dialects.mysql import TEXT
-from bs4 import BeautifulSoup
 import re
 
 # Force timestamps to be UTC formatted
@@ -58,6 +58,10 @@ class UsersUnitsBase(SQLModel):
     colour : str | None = Field(max_length=6, default=None)
 
 class UsersUnits(UsersUnitsBase, table=True):
+    # When the user's submissions for the unit were last downloaded from
+    # Canvas, and a digest of what was downloaded (see docs/canvas-sync.md).
+    synced_at : datetime | None = Field(default=None)
+    assignments_digest : str | None = Field(default=None, max_length=64)
     user : "User" = Relationship(back_populates="units")
     unit : "Unit" = Relationship(back_populates="users")
     @property
@@ -212,7 +216,10 @@ class TermBase(SQLModel):
     canvas_id : int = Field()
 
 class Term(TermBase, table=True):
+    __table_args__ = (UniqueConstraint("university_name", "canvas_id"),)
     id : int | None = Field(primary_key=True,default=None)
+    # Hash of the Canvas data last written to this row (see bulk_upsert.py)
+    content_hash : str | None = Field(default=None, max_length=64)
     units : list["Unit"] = Relationship(back_populates="term")
 
 class TermCreate(TermBase): pass
@@ -254,7 +261,14 @@ class UnitBase(SQLModel):
             return self.name
 
 class Unit(UnitBase, table=True):
+    __table_args__ = (UniqueConstraint("term_id", "canvas_id"),)
     id : int | None = Field(primary_key=True, default=None)
+    # Hash of the Canvas data last written to this row (see bulk_upsert.py)
+    content_hash : str | None = Field(default=None, max_length=64)
+    # When the unit's assignment groups and assignments were last downloaded
+    # from Canvas (by any student), and a digest of what was downloaded.
+    synced_at : datetime | None = Field(default=None)
+    assignments_digest : str | None = Field(default=None, max_length=64)
     assignment_groups : list["AssignmentGroup"] = Relationship(back_populates="unit")
     term : Term = Relationship(back_populates="units")
     users : list[UsersUnits] = Relationship(back_populates="unit")
@@ -289,14 +303,16 @@ class AssignmentGroupBase(SQLModel):
 
 class AssignmentGroup(AssignmentGroupBase, table=True):
     __tablename__ = "assignment_group"
+    __table_args__ = (UniqueConstraint("unit_id", "canvas_id"),)
     id : int | None = Field(primary_key=True, default=None)
+    # Hash of the Canvas data last written to this row (see bulk_upsert.py)
+    content_hash : str | None = Field(default=None, max_length=64)
+    # Sum of the points of the group's assignments, computed
+    # during the Canvas sync (see get_grade_contribution).
+    total_points : float = Field(default=0)
     unit : Unit = Relationship(back_populates="assignment_groups")
     assignments : list["Assignment"] = Relationship(back_populates="group")
 
-    @property
-    def total_points(self) -> float:
-        return sum(a.points or 0 for a in self.assignments)
-
 class AssignmentGroupCreate(AssignmentGroupBase): pass
 
 class AssignmentGroupUpdate(SQLModel):
@@ -323,52 +339,59 @@ class AssignmentBase(SQLModel):
     is_group : bool = Field()
 
 class Assignment(AssignmentBase, table=True):
+    __table_args__ = (UniqueConstraint("group_id", "canvas_id"),)
     id : int | None = Field(primary_key=True, default=None)
+    # Hash of the Canvas data last written to this row (see bulk_upsert.py)
+    content_hash : str | None = Field(default=None, max_length=64)
+    # Contribution to the unit's final grade (0 to 1),
+    # computed during the Canvas sync (see get_grade_contribution).
+    grade_contribution : float = Field(default=0)
+    # By default, Canvas assignment descriptions consist of HTML elements.
+    # The Canvas sync strips the HTML tags to obtain a more legible
+    # description, and a shorter variant for LLM prompts, whenever the
+    # description changes (see html_text.py).
+    readable_description : str = Field(sa_column=Column(TEXT), default="")
+    prompt_description : str = Field(sa_column=Column(TEXT), default="")
+    description_hash : str | None = Field(default=None, max_length=64)
     group : AssignmentGroup | None = Relationship(back_populates="assignments")
     users : list[UsersAssignments] = Relationship(back_populates="assignment")
     tasks : list["Task"] = Relationship(back_populates="assignment")
 
-    @property
-    def readable_description(self) -> str:
-        """
-        By default, Canvas assignment descriptions
-        consist of HTML elements. This property
-        strips the HTML tags from the assignment
-        description to obtain a more legible result.
-
-        Returns:
-            str: The readable assignment description.
-        """
-        return BeautifulSoup(
-            self.description or "", "html.parser"
-        ).get_text()
-
-    @property
-    def grade_contribution(self) -> float:
-        """
-        Calculates the assignment's contribution to the unit's final
-        grade as a percentage from 0 to 1.
+def get_grade_contribution(
+    points : float,
+    total_points : float,
+    group_weight : float,
+    apply_assignment_group_weights : bool
+) -> float:
+    """
+    Calculates an assignment's contribution to the unit's final
+    grade as a percentage from 0 to 1.
 
-        If the assignment's unit does not apply assignment group
-        weights, the assignment's grade contribution is given by
-        the simple formula:
+    If the assignment's unit does not apply assignment group
+    weights, the assignment's grade contribution is given by
+    the simple formula:
 
-        assignment.contribution = (assignment.points / 100)
+    assignment.contribution = (assignment.points / 100)
 
-        Otherwise, the assignment's contribution is given by this formula:
+    Otherwise, the assignment's contribution is given by this formula:
 
-        assignment.contribution = (assignment.points / assignment.group.total_points) * (assignment.group.group_weight / 100)
+    assignment.contribution = (assignment.points / assignment.group.total_points) * (assignment.group.group_weight / 100)
 
-        Returns:
-            float: Grade contribution.
-        """
+    Args:
+        points (float): The assignment's points.
+        total_points (float): The sum of the points of every assignment in the assignment's group.
+        group_weight (float): The weight of the assignment's group (0 to 100).
+        apply_assignment_group_weights (bool): Whether the unit weights its final grade by assignment group.
 
-        if not self.group.unit.apply_assignment_group_weights:
-            return (self.points / 100)
+    Returns:
+        float: Grade contribution.
+    """
+    if not apply_assignment_group_weights:
+        return (points or 0) / 100
 
-        if not self.group or not self.group.total_points:
-            return 0.0
-        return ((self.points or 0) / self.group.total_points) * (self.group.group_weight / 100)
+    if not total_points:
+        return 0.0
+    return ((points or 0) / total_points) * ((group_weight or 0) / 100)
 
 class AssignmentCreate(AssignmentBase): pass
 
@@ -467,6 +490,30 @@ class MessageUpdate(SQLModel):
 class ConversationPublicWithMessages(ConversationPublic):
     messages : list[Message] = []
 
+class LLMTelemetry(SQLModel, table=True):
+    """
+    Performance of one LLM call (see llm_telemetry.py).
+    Agent calls with tool calls add up all their model calls.
+    """
+    id : int | None = Field(primary_key=True, default=None)
+    created_at : datetime = Field(index=True)
+    # The function which called the LLM (e.g., "chat_stream" or "summarise")
+    endpoint : str = Field(max_length=64, index=True)
+    model : str | None = Field(default=None, max_length=255)
+    user_id : int | None = Field(default=None, foreign_key='user.id', ondelete="CASCADE")
+    conversation_id : int | None = Field(default=None, foreign_key='conversation.id', ondelete="SET NULL")
+    # The assistant message the call created, if it was saved
+    message_id : int | None = Field(default=None, foreign_key='message.id', ondelete="SET NULL")
+    prompt_tokens : int | None = Field(default=None)
+    completion_tokens : int | None = Field(default=None)
+    prompt_build_seconds : float | None = Field(default=None)
+    queue_seconds : float = Field(default=0)
+    prompt_eval_seconds : float | None = Field(default=None)
+    eval_seconds : float | None = Field(default=None)
+    first_token_seconds : float | None = Field(default=None)
+    total_seconds : float
+    tool_calls : int = Field(default=0)
+
 class TaskBase(SQLModel):
     name : str = Field(max_length=255)
     description : str = Field(default="", sa_column=Column(TEXT))
@@ -17,6 +17,20 @@ class CanvasUnit(BaseModel):
     # Weight final grade based on assignment group percentages
     apply_assignment_group_weights : bool
 
+class CanvasSubmission(BaseModel):
+    # If multiple submissions have been made, this is the attempt number.
+    attempt : int | None
+    late : bool
+    # If true, this assignment will not count towards the user's grade
+    excused : bool | None
+    # The raw score for the assignment submission.
+    # score : float | None
+    # The timestamp when the assignment was submitted, if an actual submission has been made.
+    submitted_at : datetime | None
+    # The current status of the submission.
+    # Legal values: "submitted", "unsubmitted", "graded", "pending", "pending_review"
+    workflow_state : str # Literal["submitted", "unsubmitted", "graded", "pending", "pending_review"]
+
 class CanvasAssignment(BaseModel):
     id : int
     name : str
@@ -31,24 +45,18 @@ class CanvasAssignment(BaseModel):
     grade_group_students_individually : bool
     # If true, the assignment's points don't count towards final mark
     omit_from_final_grade : bool
-
-class CanvasSubmission(BaseModel):
-    # If multiple submissions have been made, this is the attempt number.
-    attempt : int | None
-    late : bool
-    # If true, this assignment will not count towards the user's grade
-    excused : bool | None
-    # The raw score for the assignment submission.
-    # score : float | None
-    # The timestamp when the assignment was submitted, if an actual submission has been made.
-    submitted_at : datetime | None
-    # The current status of the submission.
-    # Legal values: "submitted", "unsubmitted", "graded", "pending", "pending_review"
-    workflow_state : str # Literal["submitted", "unsubmitted", "graded", "pending", "pending_review"]
+    # Only included if the submission is requested
+    # (e.g., when listing assignments within assignment groups).
+    submission : CanvasSubmission | None = None
 
 class CanvasAssignmentWithSubmission(CanvasAssignment):
     submission : CanvasSubmission
 
+class CanvasSubmissionWithAssignment(CanvasSubmission):
+    # Submissions listed per student (rather than
+    # per assignment) include their assignment ID.
+    assignment_id : int
+
 class CanvasAssignmentGroup(BaseModel):
     id : int
     name : str
@@ -0,0 +1,191 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Literal
+from zoneinfo import ZoneInfo
+from dotenv import load_dotenv
+
+"""
+Cache of the sections of each student's system prompt.
+
+The system prompt used to be rebuilt from the database on every
+chat turn (biography, units, assignments, tasks and previous
+conversation summaries), although these rarely change between
+turns. Each section is now cached under (user ID, unit ID, section)
+and only rebuilt when:
+
+- the data it is built from changes, i.e., the code which changes
+  the data calls ``prompt_cache.invalidate`` (the Canvas sync, task
+  CRUD, biography updates and conversation changes), or
+- the day changes (in PROMPT_CACHE_TIMEZONE), since sections such
+  as the assignments list contain the number of days remaining, or
+- the section is older than PROMPT_CACHE_TTL seconds, which bounds
+  how stale a section can get if the data is changed without
+  invalidating the cache (e.g., a manual database edit, or a
+  Canvas sync of a shared unit by another student).
+
+NOTE: The cache is held in memory, so each worker process has its
+own cache and only sees the invalidations made by that process.
+"""
+
+load_dotenv()
+
+# Cache settings. These can be overridden in the .env file.
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get("PROMPT_CACHE_MAX_ENTRIES", 4096))
+PROMPT_CACHE_TTL = float(os.environ.get("PROMPT_CACHE_TTL", 60 * 60 * 6))
+PROMPT_CACHE_TIMEZONE = os.environ.get("PROMPT_CACHE_TIMEZONE", "Australia/Sydney")
+
+PromptSection = Literal["biography", "units", "unit_name", "assignments", "tasks", "history"]
+
+class PromptCacheEntry:
+    """
+    A cached prompt section.
+
+    Attributes:
+        text (str): The section text.
+        day (date): The day the section was built on.
+        stored_at (float): When the section was cached (UNIX time).
+    """
+    def __init__(self, text : str, day : date, stored_at : float):
+        self.text = text
+        self.day = day
+        self.stored_at = stored_at
+
+class PromptSectionCache:
+    """
+    LRU cache of system prompt sections, keyed by
+    (user ID, unit ID, section), which expire at the
+    end of the day they were built on.
+
+    Args:
+        max_entries (int, optional): Maximum number of sections held in memory. Defaults to PROMPT_CACHE_MAX_ENTRIES.
+        ttl (float, optional): How many seconds a section may be cached for. Defaults to PROMPT_CACHE_TTL.
+        timezone_name (str, optional): The timezone which decides when a day ends. Defaults to PROMPT_CACHE_TIMEZONE.
+    """
+
+    def __init__(
+        self,
+        max_entries : int = PROMPT_CACHE_MAX_ENTRIES,
+        ttl : float = PROMPT_CACHE_TTL,
+        timezone_name : str = PROMPT_CACHE_TIMEZONE
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timezone = ZoneInfo(timezone_name)
+        self._entries : OrderedDict[tuple[int, int | None, str], PromptCacheEntry] = OrderedDict()
+        # Incremented by each invalidation, so that a section which was
+        # being built while it was invalidated is not cached (see ``set``).
+        self._versions : dict[int, int] = {}
+        self._global_version = 0
+        # Sync routes run in worker threads
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def today(self) -> date:
+        return datetime.now(self.timezone).date()
+
+    def version(self, user_id : int) -> tuple[int, int]:
+        """
+        Obtain the current version of a user's sections. Pass it
+        to ``set`` along with a section built after calling this.
+        """
+        with self._lock:
+            return self._global_version, self._versions.get(user_id, 0)
+
+    def get(self, user_id : int, unit_id : int | None, section : PromptSection) -> str | None:
+        """
+        Obtain a cached section if it exists and was built today.
+        """
+        key = (user_id, unit_id, section)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                entry.day != self.today() or time.time() - entry.stored_at > self.ttl
+            ):
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.text
+
+    def set(
+        self,
+        user_id : int,
+        unit_id : int | None,
+        section : PromptSection,
+        text : str,
+        version : tuple[int, int] | None = None
+    ):
+        """
+        Cache a section.
+
+        Args:
+            user_id (int): The student the section was built for.
+            unit_id (int | None): The unit the section was built for, if any.
+            section (PromptSection): The name of the section.
+            text (str): The section text.
+            version (tuple[int, int] | None, optional):
+                The user's version (see ``version``) from before the section was built.
+                If the user's sections were invalidated since, the section is not cached.
+        """
+        key = (user_id, unit_id, section)
+        with self._lock:
+            if version is not None and version != (self._global_version, self._versions.get(user_id, 0)):
+                return
+            self._entries[key] = PromptCacheEntry(text, self.today(), time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id : int | None, *sections : PromptSection):
+        """
+        Remove cached sections (for every unit).
+
+        Args:
+            user_id (int | None): The student whose sections to remove, or None to remove the sections of every student.
+            *sections (PromptSection): The sections to remove. If none are given, every section is removed.
+        """
+        with self._lock:
+            if user_id is None:
+                self._global_version += 1
+            else:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+            for key in list(self._entries.keys()):
+                key_user_id, _, key_section = key
+                if user_id is not None and key_user_id != user_id: continue
+                if sections and key_section not in sections: continue
+                del self._entries[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._global_version += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries" : len(self._entries),
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hit_ratio" : self.hits / requests if requests else 0.0,
+                "invalidations" : self.invalidations,
+                "evictions" : self.evictions
+            }
+
+prompt_cache = PromptSectionCache()
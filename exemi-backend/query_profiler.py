@@ -0,0 +1,324 @@
+import os
+import re
+import time
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from dotenv import load_dotenv
+
+"""
+Counts and times the SQL statements sent to the database.
+
+The profiler listens to the engines' cursor events, so every
+statement is counted however it was issued (ORM queries, lazy
+loads, properties which query through ``object_session``, etc.).
+
+- Each API request is profiled in its own ``QueryStats`` (see
+  ``profile_queries``), and the totals are kept for each route.
+- A statement which is repeated many times with the same shape
+  (i.e., only its parameters differ) within one request is
+  reported as a possible N+1 query, e.g., a property which
+  queries the database once per serialised object.
+- Statements slower than ``DB_SLOW_QUERY_SECONDS`` are logged.
+- ``assert_query_budget`` fails if a block of code (such as a
+  test calling an endpoint) sends more statements than allowed.
+"""
+
+load_dotenv()
+
+# Profiler settings. These can be overridden in the .env file.
+DB_SLOW_QUERY_SECONDS = float(os.environ.get("DB_SLOW_QUERY_SECONDS", 0.5))
+DB_N_PLUS_ONE_THRESHOLD = int(os.environ.get("DB_N_PLUS_ONE_THRESHOLD", 5))
+DB_PROFILE_MAX_ROUTES = int(os.environ.get("DB_PROFILE_MAX_ROUTES", 256))
+
+logger = logging.getLogger(__name__)
+
+_whitespace = re.compile(r"\s+")
+_parameter_list = re.compile(r"IN \([^()]*\)", re.IGNORECASE)
+
+def get_statement_shape(statement : str) -> str:
+    """
+    Obtain the shape of a SQL statement, i.e., the statement with
+    its whitespace normalised and every ``IN (...)`` parameter list
+    collapsed, so that statements which only differ in their
+    parameters have the same shape.
+    """
+    shape = _whitespace.sub(" ", statement).strip()
+    return _parameter_list.sub("IN (...)", shape)
+
+class QueryStats:
+    """
+    The statements sent to the database while profiling a block of code.
+
+    Attributes:
+        queries (int): How many statements were sent.
+        seconds (float): How long the statements took in total.
+        slow (int): How many statements took longer than the slow query threshold.
+        shapes (Counter[str]): How many times each statement shape was sent.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.shapes : Counter[str] = Counter()
+        # Sync sessions run in worker threads, so
+        # several threads may record statements at once.
+        self._lock = threading.Lock()
+
+    def record(self, shape : str, seconds : float, slow : bool):
+        with self._lock:
+            self.queries += 1
+            self.seconds += seconds
+            self.slow += slow
+            self.shapes[shape] += 1
+
+    def repeated(self, threshold : int = DB_N_PLUS_ONE_THRESHOLD) -> dict[str, int]:
+        """
+        Obtain the statement shapes which were sent at least
+        ``threshold`` times, i.e., possible N+1 queries.
+        """
+        return {shape : count for shape, count in self.shapes.most_common() if count >= threshold}
+
+_request_stats : ContextVar[QueryStats | None] = ContextVar("query_stats", default=None)
+
+@contextmanager
+def profile_queries():
+    """
+    Record every statement sent inside this block (including
+    in tasks and worker threads it starts) in a new QueryStats.
+
+    Usage:
+        with profile_queries() as stats:
+            build_system_prompt(user=user, session=session)
+        print(stats.queries)
+    """
+    stats = QueryStats()
+    token = _request_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _request_stats.reset(token)
+
+class QueryProfiler:
+    """
+    Records the statements sent through the engines it is
+    attached to, and keeps per-route totals of profiled requests.
+
+    Args:
+        slow_query_seconds (float, optional): Statements slower than this are logged. Defaults to DB_SLOW_QUERY_SECONDS.
+        n_plus_one_threshold (int, optional): How many times a statement shape may be repeated in a request before it is reported. Defaults to DB_N_PLUS_ONE_THRESHOLD.
+        max_routes (int, optional): Maximum number of routes to keep totals for. Defaults to DB_PROFILE_MAX_ROUTES.
+    """
+
+    def __init__(
+        self,
+        slow_query_seconds : float = DB_SLOW_QUERY_SECONDS,
+        n_plus_one_threshold : int = DB_N_PLUS_ONE_THRESHOLD,
+        max_routes : int = DB_PROFILE_MAX_ROUTES
+    ):
+        self.slow_query_seconds = slow_query_seconds
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.max_routes = max_routes
+
+        self.queries = 0
+        self.slow_queries = 0
+        self._routes : OrderedDict[str, dict] = OrderedDict()
+        self._watchers : list[QueryStats] = []
+        self._lock = threading.Lock()
+
+    def attach(self, engine : Engine):
+        """
+        Profile every statement sent through an engine.
+        For an AsyncEngine, attach its ``sync_engine``.
+        """
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        started_at = connection.info["query_started_at"].pop()
+        self.record_query(statement, time.perf_counter() - started_at)
+
+    def _handle_error(self, exception_context):
+        started_at = exception_context.connection.info.get("query_started_at") if exception_context.connection else None
+        if started_at: started_at.pop()
+
+    def record_query(self, statement : str, seconds : float):
+        """
+        Record a statement in the current request's
+        QueryStats (if any) and in every active watcher.
+        """
+        shape = get_statement_shape(statement)
+        slow = seconds >= self.slow_query_seconds
+
+        with self._lock:
+            self.queries += 1
+            self.slow_queries += slow
+
+        if slow:
+            logger.warning("Slow query (%.3fs): %s", seconds, shape[:1000])
+
+        stats = _request_stats.get()
+        if stats is not None: stats.record(shape, seconds, slow)
+        for watcher in list(self._watchers):
+            watcher.record(shape, seconds, slow)
+
+    def record_request(self, route : str, stats : QueryStats):
+        """
+        Add a profiled request to the totals of its route,
+        and report any statements repeated often enough to
+        be an N+1 query.
+
+        Args:
+            route (str): The method and path template of the route, e.g., "GET /tasks/{username}".
+            stats (QueryStats): The statements sent while handling the request.
+        """
+        repeated = stats.repeated(self.n_plus_one_threshold)
+        if repeated:
+            shape, count = next(iter(repeated.items()))
+            logger.warning("Possible N+1 query in %s (%d times): %s", route, count, shape[:1000])
+
+        with self._lock:
+            totals = self._routes.get(route)
+            if totals is None:
+                totals = {
+                    "requests" : 0,
+                    "queries" : 0,
+                    "seconds" : 0.0,
+                    "max_queries" : 0,
+                    "slow_queries" : 0,
+                    "n_plus_one_requests" : 0,
+                    "repeated" : {}
+                }
+                self._routes[route] = totals
+            self._routes.move_to_end(route)
+
+            totals["requests"] += 1
+            totals["queries"] += stats.queries
+            totals["seconds"] += stats.seconds
+            totals["max_queries"] = max(totals["max_queries"], stats.queries)
+            totals["slow_queries"] += stats.slow
+            if repeated:
+                totals["n_plus_one_requests"] += 1
+                # Keep the most repeated shapes of the latest flagged request
+                totals["repeated"] = dict(list(repeated.items())[:3])
+
+            while len(self._routes) > self.max_routes:
+                self._routes.popitem(last=False)
+
+    @contextmanager
+    def watch(self):
+        """
+        Record every statement sent through the attached engines
+        while this block runs, from any task or thread.
+        """
+        stats = QueryStats()
+        self._watchers.append(stats)
+        try:
+            yield stats
+        finally:
+            self._watchers.remove(stats)
+
+    def stats(self) -> dict:
+        """
+        Obtain the total number of statements and the totals of each route.
+        """
+        with self._lock:
+            routes = {
+                route : {
+                    **totals,
+                    "average_queries" : totals["queries"] / totals["requests"],
+                    "average_seconds" : totals["seconds"] / totals["requests"]
+                }
+                for route, totals in self._routes.items()
+            }
+            return {
+                "queries" : self.queries,
+                "slow_queries" : self.slow_queries,
+                "routes" : routes
+            }
+
+query_profiler = QueryProfiler()
+
+class QueryProfilerMiddleware:
+    """
+    ASGI middleware which profiles the statements sent while
+    handling each HTTP request (see ``profile_queries``) and adds
+    them to the totals of the request's route.
+
+    The request is recorded once the last chunk of the response
+    body has been sent (or the request fails), so the statements
+    sent while a StreamingResponse generates its body are counted.
+    It is plain ASGI middleware rather than ``@app.middleware("http")``,
+    which ends as soon as the response headers are ready and hides
+    client disconnects from ``Request.is_disconnected``.
+
+    Usage:
+        app.add_middleware(QueryProfilerMiddleware, profiler=query_profiler)
+    """
+
+    def __init__(self, app, profiler : QueryProfiler = query_profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        recorded = False
+
+        with profile_queries() as stats:
+            def record():
+                nonlocal recorded
+                if recorded: return
+                recorded = True
+                # The router adds the matched route to the scope
+                route = scope.get("route")
+                route_path = route.path if route is not None else "(unmatched)"
+                self.profiler.record_request(f"{scope['method']} {route_path}", stats)
+
+            async def send_and_record(message):
+                await send(message)
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    record()
+
+            try:
+                await self.app(scope, receive, send_and_record)
+            finally:
+                record()
+
+@contextmanager
+def assert_query_budget(max_queries : int, max_repeated : int | None = None):
+    """
+    Fail if the code inside this block sends more statements than
+    allowed. Intended for tests, e.g., to guard an endpoint against
+    queries which are repeated for each object it returns.
+
+    Usage:
+        with assert_query_budget(5, max_repeated=1):
+            client.get("/tasks/self")
+
+    Args:
+        max_queries (int): Maximum number of statements.
+        max_repeated (int | None, optional): Maximum number of times any one statement shape may be sent. Defaults to no limit.
+
+    Raises:
+        AssertionError: If either budget was exceeded.
+    """
+    with query_profiler.watch() as stats:
+        yield stats
+
+    shapes = "\n".join(f"{count} x {shape}" for shape, count in stats.shapes.most_common(5))
+    if stats.queries > max_queries:
+        raise AssertionError(f"Sent {stats.queries} queries (budget {max_queries}). Most frequent:\n{shapes}")
+    if max_repeated is not None and stats.shapes and max(stats.shapes.values()) > max_repeated:
+        raise AssertionError(f"A query was repeated more than {max_repeated} times. Most frequent:\n{shapes}")
@@ -1,26 +1,56 @@
 from pydantic import TypeAdapter
 from ..models import User, UserUpdate, UserPublic, UsersUnits, UsersAssignments, UniversityAliasPublic, UsersUnitsPublic
 from ..models import Term, TermCreate, TermPublic, TermUpdate
-from ..models import Unit, UnitCreate, UnitPublicWithTerm, UnitUpdate
-from ..models import Assignment, AssignmentCreate, AssignmentPublicWithGroup, AssignmentUpdate
+from ..models import Unit, UnitCreate, UnitPublic, UnitPublicWithTerm, UnitUpdate
+from ..models import Assignment, AssignmentCreate, AssignmentPublicWithGroup, AssignmentUpdate, get_grade_contribution
 from ..models import AssignmentGroup, AssignmentGroupCreate, AssignmentGroupPublicWithUnit, AssignmentGroupUpdate
-from ..models_canvas import CanvasTerm, CanvasUnit, CanvasAssignment, CanvasSubmission, CanvasAssignmentWithSubmission, CanvasAssignmentGroup
+from ..models_canvas import CanvasTerm, CanvasUnit, CanvasAssignment, CanvasSubmission, CanvasAssignmentWithSubmission, CanvasAssignmentGroup, CanvasSubmissionWithAssignment
 from sqlmodel import Session, select
+from sqlalchemy import delete, tuple_
+from sqlalchemy.orm import selectinload
 from fastapi import APIRouter, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
 from ..dependencies import get_session, get_current_user, get_current_magic
-from ..canvas_api import query_canvas
+from ..canvas_api import query_canvas, query_canvas_all, query_canvas_pages
+from ..canvas_cache import canvas_cache
+from ..canvas_singleflight import canvas_single_flight
+from ..canvas_providers import provider_resolver
+from ..canvas_ratelimit import canvas_rate_limiter
+from ..date_utils import parse_timestamp
+from ..bulk_upsert import bulk_upsert
+from ..html_text import get_description_hash, convert_descriptions
+from ..routers.curriculum import forget_assignments_payloads
+from ..prompt_cache import prompt_cache
 from pydantic import BaseModel
-from typing import Literal
+from typing import AsyncGenerator, Awaitable, Callable, Literal, TypeVar
+from datetime import datetime, timedelta, timezone
 import asyncio
+import hashlib
 import json
+import os
 import re
 
 router = APIRouter()
 
+T = TypeVar("T")
+
+# How often (in seconds) an incremental sync downloads the assignments
+# and submissions of units in concluded terms. This can be overridden in the .env file.
+CANVAS_CONCLUDED_SYNC_INTERVAL = float(os.environ.get("CANVAS_CONCLUDED_SYNC_INTERVAL", 60 * 60 * 24))
+# How long (in seconds) the assignment groups and assignments of a unit
+# synced by any student stay fresh before an incremental sync downloads
+# them again. This can be overridden in the .env file.
+CANVAS_COURSE_SYNC_INTERVAL = float(os.environ.get("CANVAS_COURSE_SYNC_INTERVAL", 60 * 15))
+# How far back (in seconds) before a student's last sync an incremental
+# sync asks Canvas for changed submissions, to allow for clock skew between
+# Canvas and this server. This can be overridden in the .env file.
+CANVAS_SUBMISSIONS_OVERLAP = float(os.environ.get("CANVAS_SUBMISSIONS_OVERLAP", 60))
+
 canvas_terms_adapter = TypeAdapter(list[CanvasTerm])
 canvas_units_adapter = TypeAdapter(list[CanvasUnit])
 canvas_assignment_group_adapter = TypeAdapter(list[CanvasAssignmentGroup])
 canvas_assignment_adapter = TypeAdapter(list[CanvasAssignmentWithSubmission])
+canvas_submission_adapter = TypeAdapter(list[CanvasSubmissionWithAssignment])
 
 class CanvasTermsResult(BaseModel):
     terms : list[CanvasTerm]
@@ -34,6 +64,109 @@ class CanvasAssignmentGroupsResult(BaseModel):
 class CanvasAssignmentsResult(BaseModel):
     assignments : list[CanvasAssignmentWithSubmission]
     university_name : str
+class CanvasSubmissionsResult(BaseModel):
+    submissions : list[CanvasSubmissionWithAssignment]
+    university_name : str
+
+def get_canvas_list_request(
+    path : str,
+    params : dict,
+    adapter : TypeAdapter,
+    user : User,
+    magic : str
+) -> dict:
+    """
+    Obtain the arguments of ``query_canvas_pages`` (or ``query_canvas_all``)
+    to download a Canvas list resource with the user's Canvas token.
+    """
+    user_public = UserPublic.model_validate(user)
+    return {
+        "path" : path,
+        "magic" : magic,
+        "provider" : user_public.actual_university_name,
+        "fallback_providers" : user_public.fallback_university_names,
+        "adapter" : adapter,
+        "params" : params
+    }
+
+async def gather_or_cancel(*awaitables : Awaitable[T]) -> list[T]:
+    """
+    Like ``asyncio.gather``, but if any awaitable fails, the others are
+    cancelled (and awaited) before the error is raised, so that they do
+    not keep writing to a session which is about to be rolled back.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def run_in_session(session : Session, function : Callable[..., T], /, *args, **kwargs) -> T:
+    """
+    Run sync database work in the threadpool, so that it does not
+    block the event loop while the sync awaits Canvas.
+
+    A Session must only be used by one thread at a time, so the calls
+    made with the same session (e.g., by the units which ``gather_or_cancel``
+    syncs concurrently) are run one at a time. A call which is cancelled
+    still waits for its thread to finish, so the session is never rolled
+    back while a statement is running.
+    """
+    lock : asyncio.Lock = session.info.setdefault("threadpool_lock", asyncio.Lock())
+    async with lock:
+        return await run_in_threadpool(function, *args, **kwargs)
+
+@router.get("/canvas/cache", response_model=dict)
+async def get_canvas_cache_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the hit-ratio counters of the Canvas response cache (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict:
+            The number of cached entries, hits (304 Not Modified), changed responses, misses, and evictions,
+            and the number of Canvas requests which were coalesced with an identical request ("single_flight").
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return {**canvas_cache.stats(), "single_flight" : canvas_single_flight.stats()}
+
+@router.get("/canvas/providers", response_model=dict)
+async def get_canvas_provider_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the circuit breaker state of each Canvas provider (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The number of tokens with a remembered provider, and the state and consecutive failures of each provider's circuit breaker.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return provider_resolver.stats()
+
+@router.get("/canvas/rate_limits", response_model=dict)
+async def get_canvas_rate_limit_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the Canvas rate limit budget of each access token (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: For each token (keyed by a prefix of its hash), the remaining budget and average request cost reported by Canvas, the current concurrency limit, in-flight and queued requests, and the number of throttled requests.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return canvas_rate_limiter.stats()
 
 @router.get("/canvas/terms", response_model=CanvasTermsResult)#tuple[list[CanvasTerm], str])
 async def canvas_get_terms(
@@ -42,23 +175,21 @@ async def canvas_get_terms(
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic)
 ) -> CanvasTermsResult:#tuple[list[CanvasTerm], str]:
-    result : CanvasUnitsResult = await canvas_get_units(
+    # Obtain every term object from every unit the user is currently
+    # enrolled in, one page of units at a time (removing duplicates).
+    terms_by_id : dict[int, CanvasTerm] = {}
+
+    async for page in canvas_get_unit_pages(
         user=user,
         magic=magic,
         exclude_complete_units=exclude_complete_units,
         exclude_organisation_units=exclude_organisation_units
-    )
-    units : list[CanvasUnit] = result.units
-    active_university_name : str = result.university_name
-    
-    # Obtain every term object from every unit the user is currently enrolled in.
-    raw_terms = [unit.term for unit in units]
-    
-    # Remove all duplicates and sort by ID.
-    terms = sorted(
-        {term.id: term for term in raw_terms}.values(),
-        key=lambda term: term.id
-    )
+    ):
+        active_university_name : str = page.university_name
+        terms_by_id.update({unit.term.id : unit.term for unit in page.units})
+
+    # Sort by ID.
+    terms = sorted(terms_by_id.values(), key=lambda term: term.id)
 
     return CanvasTermsResult(terms=terms, university_name=active_university_name)
 
@@ -103,6 +234,10 @@ def update_user_active_university_name(
     being used to retrieve their Canvas
     information.
     """
+    if user.active_university_name != active_university_name:
+        # The university decides the Canvas URLs in the prompt
+        prompt_cache.invalidate(user.id, "units", "assignments")
+
     data = {"active_university_name" : active_university_name}
     user.sqlmodel_update(data)
     session.add(user)
@@ -120,7 +255,12 @@ async def commit_canvas_terms(
     Sync Canvas terms into DB:
     - Create if missing
     - Update if existing
+
+    Returns:
+        list[TermPublic]: The terms which were created or updated.
     """
+    # Load the user's universities for the Canvas requests (see get_canvas_list_request)
+    await run_in_session(session, UserPublic.model_validate, user)
 
     result : CanvasTermsResult = await canvas_get_terms(
         exclude_organisation_units=True,
@@ -132,58 +272,61 @@ async def commit_canvas_terms(
     canvas_terms : list[CanvasTerm] = result.terms
     active_university_name : str = result.university_name
 
-    update_user_active_university_name(
+    await run_in_session(
+        session,
+        update_user_active_university_name,
         active_university_name=active_university_name,
         user=user,
         session=session
     )
     
     if not canvas_terms: return []
-    
-    canvas_ids = [t.id for t in canvas_terms]
-    
-    # Obtain all terms we want to update with new information
-    existing_terms = session.exec(
-        select(Term)
-        .where(Term.canvas_id.in_(canvas_ids))
-        .where(Term.university_name == user.university_name)
-    ).all()
-    
-    # Map all existing terms by their Canvas ID
-    existing_terms_by_canvas_id : dict[int, Term] = {t.canvas_id: t for t in existing_terms}
-    
-    # Create a list of the new terms
-    modified_terms: list[Term] = []
 
-    for canvas_term in canvas_terms:
-        data = parse_canvas_term(canvas_term)
-        if not data: continue
+    def save_terms() -> list[TermPublic]:
+        modified_terms = upsert_canvas_terms(canvas_terms, user=user, session=session)
 
-        data["university_name"] = user.university_name
+        # Serialise the terms before committing so
+        # they do not need to be reloaded one by one.
+        modified_terms = [TermPublic.model_validate(t) for t in modified_terms]
+        session.commit()
+        return modified_terms
 
-        existing_term = existing_terms_by_canvas_id.get(
-            canvas_term.id
-        )
+    return await run_in_session(session, save_terms)
 
-        if existing_term:
-            update_data = TermUpdate.model_validate(data).model_dump(exclude_unset=True)
-            
-            existing_term.sqlmodel_update(update_data)
+def upsert_canvas_terms(
+    canvas_terms : list[CanvasTerm],
+    user : User,
+    session : Session,
+    returning : Literal["changed", "all"] = "changed"
+) -> list[Term]:
+    """
+    Create or update terms of the user's university (without committing).
+    Terms which lack a start or end date are ignored (see ``parse_canvas_term``).
 
-            modified_terms.append(existing_term)
-        else:
-            new_term = Term.model_validate(
-                TermCreate.model_validate(data)
-            )
-            session.add(new_term)
-            modified_terms.append(new_term)
+    Args:
+        canvas_terms (list[CanvasTerm]): The terms to sync.
+        returning (Literal["changed", "all"], optional): Which terms to return (see ``bulk_upsert``). Defaults to "changed".
 
-    session.commit()
+    Returns:
+        list[Term]: The created or updated terms (or every synced term).
+    """
+    rows : list[dict] = []
 
-    for term in modified_terms:
-        session.refresh(term)
+    for canvas_term in canvas_terms:
+        data = parse_canvas_term(canvas_term)
+        if not data: continue
 
-    return modified_terms
+        data["university_name"] = user.university_name
+        rows.append(TermCreate.model_validate(data).model_dump())
+
+    return bulk_upsert(
+        session=session,
+        model=Term,
+        rows=rows,
+        key_columns=["university_name", "canvas_id"],
+        update_columns=["name", "start_at", "end_at"],
+        returning=returning
+    )
     
 @router.get("/canvas/units", response_model=CanvasUnitsResult)#tuple[list[CanvasUnit], str])
 async def canvas_get_units(
@@ -192,28 +335,40 @@ async def canvas_get_units(
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic)
 ) -> CanvasUnitsResult:#tuple[list[CanvasUnit], str]:
-    user_public = UserPublic.model_validate(user)
+    units, active_university_name = await query_canvas_all(
+        **get_canvas_units_request(exclude_complete_units, user, magic)
+    )
+    units = filter_canvas_units(units, exclude_organisation_units)
 
+    return CanvasUnitsResult(units=units, university_name=active_university_name)
+
+async def canvas_get_unit_pages(
+    exclude_complete_units : bool,
+    exclude_organisation_units : bool,
+    user : User,
+    magic : str
+) -> AsyncGenerator[CanvasUnitsResult, None]:
+    """
+    Obtain the user's Canvas units one page at a time (see ``query_canvas_pages``),
+    so that a sync only holds one page of units in memory at once.
+    """
+    async for units, active_university_name in query_canvas_pages(
+        **get_canvas_units_request(exclude_complete_units, user, magic)
+    ):
+        units = filter_canvas_units(units, exclude_organisation_units)
+        yield CanvasUnitsResult(units=units, university_name=active_university_name)
+
+def get_canvas_units_request(exclude_complete_units : bool, user : User, magic : str) -> dict:
     params = {"include":"term"}
     if exclude_complete_units: params["enrollment_state"] = "active"
-    raw_units, active_university_name = await query_canvas(
-        path="courses",
-        magic=magic,
-        provider=user_public.actual_university_name,
-        fallback_providers=user_public.fallback_university_names,
-        max_items=50,
-        params=params
-    )
+    return get_canvas_list_request("courses", params, canvas_units_adapter, user, magic)
 
-    # return raw_units
-    units = canvas_units_adapter.validate_json(raw_units)
-    
+def filter_canvas_units(units : list[CanvasUnit], exclude_organisation_units : bool) -> list[CanvasUnit]:
     # Internally, Swinburne Organisation units have term ID 1
     # ("Default Term"), so we can exclude them with this check:
     if exclude_organisation_units:
         units = [unit for unit in units if unit.enrollment_term_id != 1]
-
-    return CanvasUnitsResult(units=units, university_name=active_university_name)
+    return units
 
 @router.get("/canvas/units/colours", response_model=dict[int, str])
 async def canvas_get_unit_colours(
@@ -276,13 +431,10 @@ async def commit_canvas_units(
     magic : str = Depends(get_current_magic)
 ):
     """
-    Sync Canvas units into DB:
+    Sync Canvas units (and their terms) into DB:
     - Create if missing
     - Update if existing
 
-    Preconditions (call these functions first):
-    - POST /canvas/terms
-
     Raises:
         HTTPException:
             If NO units are detected from the user's Canvas
@@ -291,221 +443,220 @@ async def commit_canvas_units(
             log the user out of the system by raising a
             HTTPException, and force the user to regenerate
             a Canvas token to (hopefully) fix the issue.
+
+    Returns:
+        list[UnitPublicWithTerm]: Every unit the user is enrolled in (whether or not it changed).
     """
 
-    result : CanvasUnitsResult = await canvas_get_units(
+    canvas_unit_colours : dict[int,str] | None = None
+    canvas_unit_nicknames : dict[int,str] = {}
+    synced_units : list[UnitPublicWithTerm] = []
+    canvas_unit_count = 0
+
+    # The database work runs in the threadpool (see run_in_session).
+    # Load the user's universities for the Canvas requests first (see get_canvas_list_request).
+    await run_in_session(session, UserPublic.model_validate, user)
+
+    # Sync the units one page at a time, along with their terms, so that
+    # the units are only downloaded once and one page is held in memory.
+    async for page in canvas_get_unit_pages(
         exclude_organisation_units=True,
         exclude_complete_units=True,
         user=user,
         magic=magic
-    )
+    ):
+        canvas_units : list[CanvasUnit] = page.units
+        if not canvas_units: continue
+        canvas_unit_count += len(canvas_units)
+
+        if canvas_unit_colours is None:
+            active_university_name : str = page.university_name
+
+            canvas_unit_colours = await canvas_get_unit_colours(
+                user=user,
+                magic=magic,
+                university_name=active_university_name
+            )
 
-    canvas_units : list[CanvasUnit] = result.units
-    active_university_name : str = result.university_name
+            await run_in_session(
+                session,
+                update_user_active_university_name,
+                active_university_name=active_university_name,
+                user=user,
+                session=session
+            )
+
+        for unit in canvas_units:
+            if unit.original_name is not None:
+                canvas_unit_nicknames[unit.id] = unit.name
+
+        synced_units.extend(await run_in_session(
+            session,
+            upsert_canvas_units,
+            canvas_units=canvas_units,
+            user=user,
+            session=session
+        ))
 
     # If the system was NOT able to pick up any
     # units from the user's Canvas page, assume
     # something has gone wrong and raise an exception.
     # Also wipe the user's magic hash.
-    if not canvas_units:
+    if not canvas_unit_count:
 
-        user.sqlmodel_update(
-            {"magic_hash" : None}
-        )
-        session.add(user)
-        session.commit()
+        def forget_magic():
+            user.sqlmodel_update(
+                {"magic_hash" : None}
+            )
+            session.add(user)
+            session.commit()
+
+        await run_in_session(session, forget_magic)
 
         raise HTTPException(status_code=500, detail="Please log in again. If you have trouble accessing the system, please contact Alexander Small.")
         return []
 
-
-    canvas_unit_colours : dict[int,str] = await canvas_get_unit_colours(
-        user=user,
-        magic=magic,
-        university_name=active_university_name
+    await run_in_session(
+        session,
+        enrol_user_in_units,
+        units=synced_units,
+        nickname_map=canvas_unit_nicknames,
+        colour_map=canvas_unit_colours,
+        session=session,
+        user=user
     )
 
-    canvas_unit_nicknames : dict[int,str] = {}
-    for unit in canvas_units:
-        if unit.original_name is not None:
-            canvas_unit_nicknames[unit.id] = unit.name
-    
-    update_user_active_university_name(
-        active_university_name=active_university_name,
-        user=user,
-        session=session
-    )
+    return synced_units
 
-    canvas_ids = [t.id for t in canvas_units]
-    
-    # Obtain all units we want to update with new information
-    existing_units = session.exec(
-        select(Unit)
-        .join(Term)
-        .where(Unit.canvas_id.in_(canvas_ids))
-        .where(Term.university_name == user.university_name)
-    ).all()
+def upsert_canvas_units(
+    canvas_units : list[CanvasUnit],
+    user : User,
+    session : Session
+) -> list[UnitPublicWithTerm]:
+    """
+    Create or update one page of the user's units and their terms (without committing).
 
-    # Obtain a list of unique term Canvas IDs
-    # for all of the Canvas unit objects.
-    existing_term_ids = [u.term.id for u in canvas_units]
-    existing_term_ids = list(set(existing_term_ids))
+    Returns:
+        list[UnitPublicWithTerm]: Every unit in the page (whether or not it changed).
+    """
+    # Every term is needed (not just the changed ones) for its units
+    terms = upsert_canvas_terms(
+        list({u.term.id : u.term for u in canvas_units}.values()),
+        user=user,
+        session=session,
+        returning="all"
+    )
+    terms_by_canvas_id : dict[int, Term] = {t.canvas_id: t for t in terms}
 
-    # Obtain all unique existing terms from the units.
-    existing_terms = session.exec(
-        select(Term)
-        .where(Term.canvas_id.in_(existing_term_ids))
-    ).all()
+    rows : list[dict] = []
 
-    # Map all existing units by their Canvas ID
-    existing_units_by_canvas_id : dict[int, Unit] = {t.canvas_id: t for t in existing_units}
-    existing_terms_by_canvas_id : dict[int, Term] = {t.canvas_id: t for t in existing_terms}
-    
-    # Create a list of the new units
-    modified_units: list[Unit] = []
-    
     for canvas_unit in canvas_units:
         data = parse_canvas_unit(canvas_unit)
         if not data: continue
 
-        existing_term = existing_terms_by_canvas_id.get(
-            canvas_unit.term.id
-        )
+        term = terms_by_canvas_id.get(canvas_unit.term.id)
 
-        if not existing_term:
-            print("Term not found for unit {canvas_unit.name}")
+        if not term:
+            print(f"Term not found for unit {canvas_unit.name}")
             continue
             #raise HTTPException(status_code=404, detail=f"Term not found for unit {canvas_unit.name}")
 
-        data["term_id"] = existing_term.id
-
-        existing_unit = existing_units_by_canvas_id.get(
-            canvas_unit.id
-        )
-
-        if existing_unit:
-            update_data = UnitUpdate.model_validate(data).model_dump(exclude_unset=True)
-            
-            existing_unit.sqlmodel_update(update_data)
-
-            modified_units.append(existing_unit)
-
-        else:
-
-            new_unit = Unit.model_validate(
-                UnitCreate.model_validate(data)
-            )
-            session.add(new_unit)
-            modified_units.append(new_unit)
-
-    session.commit()
-
-    for unit in modified_units:
-        session.refresh(unit)
+        data["term_id"] = term.id
+        rows.append(UnitCreate.model_validate(data).model_dump())
 
-    enrol_user_in_units(
-        units=modified_units,
-        nickname_map=canvas_unit_nicknames,
-        colour_map=canvas_unit_colours,
+    # Every unit is needed (not just the changed ones) to enrol the user
+    page_units = bulk_upsert(
         session=session,
-        user=user
+        model=Unit,
+        rows=rows,
+        key_columns=["term_id", "canvas_id"],
+        update_columns=["name", "apply_assignment_group_weights"],
+        options=[selectinload(Unit.term)],
+        returning="all"
     )
 
-    return modified_units
+    # Serialise the units before committing so
+    # they do not need to be reloaded one by one.
+    return [UnitPublicWithTerm.model_validate(u) for u in page_units]
 
 def enrol_user_in_units(
-    units : list[Unit],
+    units : list[UnitPublic],
     nickname_map : dict[int,str],
     colour_map : dict[int,str],
     session : Session,
     user : User
 ):
-    session.refresh(user)
-
-# ---- Track which assignments user SHOULD have ----
-    valid_unit_ids = {u.id for u in units}
-
-    # ---- Existing junction rows ----
-    existing_rows = session.exec(
-            select(UsersUnits).where(UsersUnits.user_id == user.id)
-    ).all()
+    """
+    Enrol the user in their Canvas units (with their Canvas
+    nicknames and colours), and unenrol them from any
+    units they are no longer taking.
+    """
+    rows = [
+        {
+            "user_id" : user.id,
+            "unit_id" : unit.id,
+            "nickname" : nickname_map.get(unit.canvas_id),
+            "colour" : colour_map.get(unit.canvas_id)
+        }
+        for unit in units if unit.id
+    ]
 
-    existing_by_unit = {
-        u.unit_id: u for u in existing_rows
-    }
+    bulk_upsert(
+        session=session,
+        model=UsersUnits,
+        rows=rows,
+        key_columns=["unit_id", "user_id"],
+        update_columns=["nickname", "colour"],
+        hash_column=None,
+        returning=None
+    )
 
-    # ---- Create / Update ----
-    for unit in units:
-        # canvas_assignment = canvas_by_id.get(assignment.canvas_id)
-        # if not canvas_assignment:
-        #     continue
-
-        # update = parse_canvas_submission(
-        #     canvas_assignment.submission
-        # )
-        
-        if not unit.id: continue
-        u = existing_by_unit.get(unit.id)
-        
-        unit_nickname = nickname_map.get(unit.canvas_id)
-        unit_colour = colour_map.get(unit.canvas_id)
-        
-        update = {
-            "nickname" : unit_nickname,
-            "colour" : unit_colour
-        }
+    # ---- Remove stale units ----
+    session.execute(
+        delete(UsersUnits)
+        .where(UsersUnits.user_id == user.id)
+        .where(UsersUnits.unit_id.not_in([row["unit_id"] for row in rows]))
+    )
 
-        if not u:
-            u = UsersUnits(
-                user_id=user.id,
-                unit_id=unit.id,
-                **update
-            )
-            session.add(u)
-        else:
-            u.sqlmodel_update(update)
-
-    # ---- Remove stale assignments ----
-    for unit_id, u in existing_by_unit.items():
-        if unit_id not in valid_unit_ids:
-            session.delete(u)
-
-    # for unit in units:
-    #     if unit not in user.units:
-    #         user.units.append(unit)
-    # 
-    # # Unenrol the user from any units
-    # # they are no longer taking
-    # for existing_unit in list(user.units):
-    #     if existing_unit not in units:
-    #         user.units.remove(existing_unit)
-    
-    # session.add(user)
     session.commit()
+    prompt_cache.invalidate(user.id, "units", "unit_name", "assignments")
  
 @router.get("/canvas/units/{unit_id}/assignment_groups", response_model = CanvasAssignmentGroupsResult)#tuple[list[CanvasAssignmentGroup], str])
 async def canvas_get_assignment_groups(
     unit_id : int,
+    include_submissions : bool = True,
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic),
 ) -> CanvasAssignmentGroupsResult:#tuple[list[CanvasAssignmentGroup], str]:
-    user_public = UserPublic.model_validate(user)
-
-    path = f"courses/{unit_id}/assignment_groups"
-    params = {"include":["submission", "assignments"]}
-
-    raw_assignment_groups, active_university_name = await query_canvas(
-        path=path,
-        magic=magic,
-        provider=user_public.actual_university_name,
-        fallback_providers=user_public.fallback_university_names,
-        max_items=50,
-        params=params
+    assignment_groups, active_university_name = await query_canvas_all(
+        **get_canvas_assignment_groups_request(unit_id, include_submissions, user, magic)
     )
-    
-    assignment_groups = canvas_assignment_group_adapter.validate_json(raw_assignment_groups)
+
     return CanvasAssignmentGroupsResult(assignment_groups=assignment_groups, university_name=active_university_name)
 
+async def canvas_get_assignment_group_pages(
+    unit_id : int,
+    include_submissions : bool,
+    user : User,
+    magic : str
+) -> AsyncGenerator[CanvasAssignmentGroupsResult, None]:
+    """
+    Obtain the assignment groups (with their assignments) of a Canvas unit one page
+    at a time (see ``query_canvas_pages``), so that a sync only holds one page of
+    assignment groups in memory at once.
+    """
+    async for assignment_groups, active_university_name in query_canvas_pages(
+        **get_canvas_assignment_groups_request(unit_id, include_submissions, user, magic)
+    ):
+        yield CanvasAssignmentGroupsResult(assignment_groups=assignment_groups, university_name=active_university_name)
+
+def get_canvas_assignment_groups_request(unit_id : int, include_submissions : bool, user : User, magic : str) -> dict:
+    # NOTE: Canvas only reads every value of a list parameter if its
+    # name ends in "[]"; otherwise only the last value is used.
+    params = {"include[]":["assignments"]}
+    if include_submissions: params["include[]"].append("submission")
+    return get_canvas_list_request(f"courses/{unit_id}/assignment_groups", params, canvas_assignment_group_adapter, user, magic)
+
 
 @router.get("/canvas/units/{unit_id}/assignments", response_model=CanvasAssignmentsResult)#tuple[list[CanvasAssignmentWithSubmission], str])
 async def canvas_get_assignments(
@@ -513,23 +664,60 @@ async def canvas_get_assignments(
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic)
 ) -> CanvasAssignmentsResult:#tuple[list[CanvasAssignmentWithSubmission], str]:
-    user_public = UserPublic.model_validate(user)
+    assignments, active_university_name = await query_canvas_all(
+        **get_canvas_list_request(
+            f"courses/{unit_id}/assignments",
+            {"include":"submission"},
+            canvas_assignment_adapter,
+            user,
+            magic
+        )
+    )
 
-    path = f"courses/{unit_id}/assignments"
-    params = {"include":"submission"}
-    
-    raw_assignments, active_university_name = await query_canvas(
-        path=path,
-        magic=magic,
-        provider=user_public.actual_university_name,
-        fallback_providers=user_public.fallback_university_names,
-        max_items=50,
-        params=params
+    return CanvasAssignmentsResult(assignments=assignments, university_name=active_university_name)
+
+@router.get("/canvas/units/{unit_id}/submissions", response_model=CanvasSubmissionsResult)
+async def canvas_get_submissions(
+    unit_id : int,
+    user : User = Depends(get_current_user),
+    magic : str = Depends(get_current_magic)
+) -> CanvasSubmissionsResult:
+    """
+    Obtain the current user's submissions for every assignment in a Canvas unit.
+    """
+    submissions, active_university_name = await query_canvas_all(
+        **get_canvas_submissions_request(unit_id, user, magic)
     )
 
-    assignments = canvas_assignment_adapter.validate_json(raw_assignments)
+    return CanvasSubmissionsResult(submissions=submissions, university_name=active_university_name)
 
-    return CanvasAssignmentsResult(assignments=assignments, university_name=active_university_name)
+async def canvas_get_submission_pages(
+    unit_id : int,
+    user : User,
+    magic : str,
+    filters : dict | None = None
+) -> AsyncGenerator[CanvasSubmissionsResult, None]:
+    """
+    Obtain the current user's submissions in a Canvas unit one page at a time
+    (see ``query_canvas_pages``), so that a sync only holds one page of
+    submissions in memory at once.
+
+    Args:
+        filters (dict | None, optional): Extra Canvas query parameters, e.g., ``{"graded_since": ...}``. Defaults to none.
+    """
+    async for submissions, active_university_name in query_canvas_pages(
+        **get_canvas_submissions_request(unit_id, user, magic, filters)
+    ):
+        yield CanvasSubmissionsResult(submissions=submissions, university_name=active_university_name)
+
+def get_canvas_submissions_request(unit_id : int, user : User, magic : str, filters : dict | None = None) -> dict:
+    return get_canvas_list_request(
+        f"courses/{unit_id}/students/submissions",
+        {"student_ids[]":"self", **(filters or {})},
+        canvas_submission_adapter,
+        user,
+        magic
+    )
 
 @router.get("/canvas/assignments", response_model = CanvasAssignmentsResult)#tuple[list[CanvasAssignmentWithSubmission], str])
 async def canvas_get_all_assignments(
@@ -589,8 +777,167 @@ def parse_canvas_assignment(data : CanvasAssignment) -> dict | None:
         "is_group" : is_group
     }
 
+async def set_assignment_description_texts(
+    rows : list[dict],
+    session : Session
+):
+    """
+    Add the plain-text descriptions (see html_text.py) to assignment
+    rows which are about to be upserted.
+
+    A description is only converted if its HTML has changed since it
+    was last stored (i.e., its description hash differs). Otherwise,
+    the stored texts are reused, since the row may still be rewritten
+    if anything else about the assignment has changed.
+
+    Args:
+        rows (list[dict]): The assignment rows, with their group_id, canvas_id and description.
+        session (Session): SQLModel connection with the database.
+    """
+    if not rows: return
+
+    for row in rows:
+        row["description_hash"] = get_description_hash(row["description"])
+
+    # Only the texts of unchanged descriptions are needed
+    stored = await run_in_session(session, lambda: session.exec(
+        select(
+            Assignment.group_id,
+            Assignment.canvas_id,
+            Assignment.description_hash,
+            Assignment.readable_description,
+            Assignment.prompt_description
+        )
+        .where(tuple_(Assignment.group_id, Assignment.canvas_id).in_(
+            [(row["group_id"], row["canvas_id"]) for row in rows]
+        ))
+        .where(Assignment.description_hash.in_({row["description_hash"] for row in rows}))
+    ).all())
+    stored_texts = {(r[0], r[1]) : r[2:] for r in stored}
+
+    changed_rows : list[dict] = []
+
+    for row in rows:
+        stored_hash, readable_description, prompt_description = stored_texts.get(
+            (row["group_id"], row["canvas_id"]), (None, "", "")
+        )
+        if stored_hash == row["description_hash"]:
+            row["readable_description"] = readable_description
+            row["prompt_description"] = prompt_description
+        else:
+            changed_rows.append(row)
+
+    texts = await convert_descriptions([row["description"] for row in changed_rows])
+
+    for row, (readable_description, prompt_description) in zip(changed_rows, texts):
+        row["readable_description"] = readable_description
+        row["prompt_description"] = prompt_description
+
+class SyncDigest:
+    """
+    Hashes Canvas objects (and any other values the synced rows are
+    computed from) one page at a time, so that a sync can tell
+    whether anything has changed since the last sync.
+    """
+    def __init__(self, *extra):
+        self._hash = hashlib.sha256()
+        for value in extra:
+            self._hash.update(repr(value).encode("utf-8"))
+
+    def add(self, adapter : TypeAdapter, items : list):
+        self._hash.update(adapter.dump_json(items))
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+def is_sync_due(
+    unit : Unit,
+    synced_at : datetime | None,
+    digest : str | None,
+    now : datetime,
+    interval : float,
+    concluded_interval : float = CANVAS_CONCLUDED_SYNC_INTERVAL
+) -> bool:
+    """
+    Decide whether a sync should download data for a unit.
+
+    Args:
+        unit (Unit): The unit to sync.
+        synced_at (datetime | None): When the data was last downloaded, if ever.
+        digest (str | None): The digest of the data last downloaded, if any.
+        now (datetime): The time of the current sync.
+        interval (float):
+            How many seconds the last download stays fresh for.
+        concluded_interval (float, optional):
+            Units in terms which have ended (concluded units) rarely change, so
+            they stay fresh for at least this many seconds. Defaults to
+            CANVAS_CONCLUDED_SYNC_INTERVAL.
+
+    Returns:
+        bool: True if the data should be downloaded again.
+    """
+    if synced_at is None or digest is None: return True
+    if parse_timestamp(unit.term.end_at, "UTC") <= now:
+        interval = max(interval, concluded_interval)
+    return (now - parse_timestamp(synced_at, "UTC")).total_seconds() >= interval
+
+def get_user_units_to_sync(
+    user : User,
+    session : Session
+) -> tuple[dict[int, UsersUnits], list[Unit]]:
+    """
+    Obtain the user's units (with their terms, which ``is_sync_due``
+    reads) and their watermarks with one query each. Committing
+    expires the loaded rows, so this is called again before each
+    pass of the assignment sync rather than reloading each row.
+    The user's universities, which the Canvas requests read (see
+    ``get_canvas_list_request``), are reloaded here too.
+
+    Returns:
+        user_units_by_unit_id (dict[int, UsersUnits]): The user's enrolments, keyed by unit ID.
+        units (list[Unit]): The user's units.
+    """
+    UserPublic.model_validate(user)
+
+    user_units = session.exec(
+        select(UsersUnits)
+        .where(UsersUnits.user_id == user.id)
+    ).all()
+
+    user_units_by_unit_id = {u.unit_id: u for u in user_units}
+
+    units = session.exec(
+        select(Unit)
+        .where(Unit.id.in_(list(user_units_by_unit_id.keys())))
+        .options(selectinload(Unit.term))
+    ).all()
+
+    return user_units_by_unit_id, units
+
+def record_unit_syncs(
+    user_units_by_unit_id : dict[int, UsersUnits],
+    digests : dict[int, str | None],
+    now : datetime,
+    session : Session
+):
+    """
+    Store the sync watermark of each unit whose submissions were synced
+    for the user: the time of the sync, and the unit's assignments digest
+    which the user's submissions were matched against (see
+    ``get_submissions_watermark``).
+    """
+    for unit_id, digest in digests.items():
+        user_unit = user_units_by_unit_id.get(unit_id)
+        if not user_unit: continue
+        user_unit.synced_at = now
+        user_unit.assignments_digest = digest
+        session.add(user_unit)
+    session.commit()
+    forget_assignments_payloads(session)
+
 @router.post("/canvas/assignments", response_model=list[AssignmentPublicWithGroup])
 async def commit_canvas_groups_and_assignments(
+    mode: Literal["full", "incremental"] = "full",
     session: Session = Depends(get_session),
     user: User = Depends(get_current_user),
     magic: str = Depends(get_current_magic),
@@ -600,176 +947,441 @@ async def commit_canvas_groups_and_assignments(
     - Create if missing
     - Update if existing
 
+    The sync is split into two passes (see docs/canvas-sync.md):
+    1. A course-level pass, which syncs the assignment groups and
+       assignments of each unit. These are shared by every student
+       in the unit, so a unit is skipped if any student synced it
+       within the last CANVAS_COURSE_SYNC_INTERVAL seconds.
+    2. A per-user pass, which syncs the user's submissions.
+
+    In "incremental" mode, the per-user pass only downloads the
+    submissions which were submitted or graded since the user's last
+    sync, and units in concluded terms are only downloaded every
+    CANVAS_CONCLUDED_SYNC_INTERVAL seconds. "full" mode downloads
+    every submission of every unit.
+
     Preconditions (call these functions first):
     - POST /canvas/units
     - POST /canvas/terms
+
+    Args:
+        mode (Literal["full", "incremental"], optional): Whether to sync every unit or only changed units. Defaults to "full".
+
+    Returns:
+        list[AssignmentPublicWithGroup]: The assignments which were created or updated by the course-level pass.
     """
     
-    user_units = session.exec(
-        select(UsersUnits)
-        .join(User)
-        .where(User.id == user.id)
-    ).all()
+    # The database work runs in the threadpool (see run_in_session)
+    _, units = await run_in_session(session, get_user_units_to_sync, user, session)
 
-    unit_ids = [u.unit_id for u in user_units]
+    now = datetime.now(timezone.utc)
 
-    units = session.exec(
-        select(Unit)
-        .where(Unit.id.in_(unit_ids))
-    ).all()
+    modified_assignments = await commit_canvas_course_assignments(
+        units=units,
+        mode=mode,
+        now=now,
+        session=session,
+        user=user,
+        magic=magic
+    )
 
-    # --------------------------------------------------
-    # 1. Fetch Canvas groups WITH assignments
-    # --------------------------------------------------
-    all_canvas_groups: list[tuple[int, CanvasAssignmentGroup]] = []
+    # The course-level pass committed, which expired the units
+    user_units_by_unit_id, units = await run_in_session(session, get_user_units_to_sync, user, session)
 
-    tasks = [
-        canvas_get_assignment_groups(
-            unit_id=unit.canvas_id,
+    await commit_canvas_submissions(
+        units=units,
+        user_units_by_unit_id=user_units_by_unit_id,
+        mode=mode,
+        now=now,
+        session=session,
+        user=user,
+        magic=magic
+    )
+
+    return modified_assignments
+
+async def commit_canvas_course_assignments(
+    units : list[Unit],
+    mode : Literal["full", "incremental"],
+    now : datetime,
+    session : Session,
+    user : User,
+    magic : str
+) -> list[AssignmentPublicWithGroup]:
+    """
+    Course-level pass of the assignment sync: sync the assignment
+    groups and assignments of each unit, which are shared by every
+    student in the unit.
+
+    Each unit stores when it was last synced and a digest of its
+    assignment groups, so a unit is only downloaded if nobody has
+    synced it within the last CANVAS_COURSE_SYNC_INTERVAL seconds.
+    In "incremental" mode, units in concluded terms stay fresh for
+    CANVAS_CONCLUDED_SYNC_INTERVAL seconds instead. The units are
+    synced one page of assignment groups at a time, and rows which
+    have not changed are not rewritten (see ``bulk_upsert``).
+
+    Returns:
+        list[AssignmentPublicWithGroup]: The assignments which were created or updated.
+    """
+    # Another student's download is as fresh as this user's in
+    # either mode, since the assignments are shared by the unit.
+    units = [
+        unit for unit in units
+        if is_sync_due(
+            unit,
+            unit.synced_at,
+            unit.assignments_digest,
+            now,
+            CANVAS_COURSE_SYNC_INTERVAL,
+            concluded_interval=CANVAS_CONCLUDED_SYNC_INTERVAL if mode == "incremental" else 0
+        )
+    ]
+
+    results : list[tuple[str, list[AssignmentPublicWithGroup], str]] = await gather_or_cancel(*[
+        commit_canvas_unit_assignments(
+            unit_id=unit.id,
+            canvas_unit_id=unit.canvas_id,
+            apply_assignment_group_weights=unit.apply_assignment_group_weights,
+            session=session,
             user=user,
-            magic=magic,
+            magic=magic
         )
         for unit in units
-    ]
+    ])
+
+    modified_assignments : list[AssignmentPublicWithGroup] = []
+    changed = False
+
+    # Commit once, along with each unit's watermark
+    for unit, (digest, unit_assignments, _) in zip(units, results):
+        modified_assignments.extend(unit_assignments)
+        changed = changed or bool(unit_assignments) or digest != unit.assignments_digest
+        unit.synced_at = now
+        unit.assignments_digest = digest
+        session.add(unit)
+
+    def save_units():
+        if results:
+            update_user_active_university_name(
+                active_university_name=results[0][2],
+                user=user,
+                session=session
+            )
 
-    result : list[CanvasAssignmentGroupsResult] = await asyncio.gather(*tasks)
+        session.commit()
+        forget_assignments_payloads(session)
 
-    for unit, groups in zip(units, [r.assignment_groups for r in result]):
-        all_canvas_groups.extend((unit.id, g) for g in groups)
-    
-    if result:
-        active_university_name = result[0].university_name
-        update_user_active_university_name(
-            active_university_name=active_university_name,
-            user=user,
+    await run_in_session(session, save_units)
+
+    # The assignments are shared by every student in the units
+    if changed:
+        prompt_cache.invalidate(None, "assignments")
+
+    return modified_assignments
+
+async def commit_canvas_unit_assignments(
+    unit_id : int,
+    canvas_unit_id : int,
+    apply_assignment_group_weights : bool,
+    session : Session,
+    user : User,
+    magic : str
+) -> tuple[str, list[AssignmentPublicWithGroup], str]:
+    """
+    Sync the assignment groups and assignments of one unit (without committing),
+    one page of assignment groups at a time (see ``query_canvas_pages``), so that
+    only one page of Canvas data is held in memory at once.
+
+    Returns:
+        digest (str): The digest of the unit's assignment groups (see ``SyncDigest``).
+        modified_assignments (list[AssignmentPublicWithGroup]): The assignments which were created or updated.
+        active_university_name (str): The name of the university which the data was downloaded from.
+    """
+    # The grade contributions also depend on whether the unit
+    # weights its assignment groups, so include it in the digest.
+    digest = SyncDigest(apply_assignment_group_weights)
+    modified_assignments : list[AssignmentPublicWithGroup] = []
+
+    async for page in canvas_get_assignment_group_pages(
+        unit_id=canvas_unit_id,
+        include_submissions=False,
+        user=user,
+        magic=magic
+    ):
+        active_university_name : str = page.university_name
+        digest.add(canvas_assignment_group_adapter, page.assignment_groups)
+
+        modified_assignments.extend(await upsert_canvas_assignment_groups(
+            unit_id=unit_id,
+            apply_assignment_group_weights=apply_assignment_group_weights,
+            canvas_groups=page.assignment_groups,
             session=session
-        )
+        ))
 
-    if not all_canvas_groups:
-        return []
+    return digest.hexdigest(), modified_assignments, active_university_name
 
-    # --------------------------------------------------
-    # 2. Bulk fetch existing AssignmentGroups
-    # --------------------------------------------------
-    group_canvas_ids = [g.id for _, g in all_canvas_groups]
-
-    existing_groups = session.exec(
-        select(AssignmentGroup)
-        .join(Unit)
-        .join(Term)
-        .where(AssignmentGroup.canvas_id.in_(group_canvas_ids))
-        .where(Term.university_name == user.university_name)
-    ).all()
+async def upsert_canvas_assignment_groups(
+    unit_id : int,
+    apply_assignment_group_weights : bool,
+    canvas_groups : list[CanvasAssignmentGroup],
+    session : Session
+) -> list[AssignmentPublicWithGroup]:
+    """
+    Create or update assignment groups of a unit and their assignments (without committing).
 
-    existing_groups_by_key = {
-        (g.unit_id, g.canvas_id): g for g in existing_groups
-    }
+    Each group's total points and each assignment's grade contribution
+    are computed here (once per sync) and stored, rather than computed
+    from every assignment in the group whenever an assignment is read.
+    They are part of the rows' content hashes, so they are only
+    rewritten if a group's assignments, points or weights have changed.
 
-    modified_groups: list[AssignmentGroup] = []
+    Returns:
+        list[AssignmentPublicWithGroup]: The assignments which were created or updated.
+    """
+    group_rows : list[dict] = []
+    assignment_data_lookup : dict[int, list[dict]] = {}
 
-    # --------------------------------------------------
-    # 3. Upsert AssignmentGroups
-    # --------------------------------------------------
-    for unit_id, cg in all_canvas_groups:
+    for cg in canvas_groups:
         data = parse_canvas_assignment_group(cg)
         if not data:
             continue
         data["unit_id"] = unit_id
+        assignments_data = [a for a in map(parse_canvas_assignment, cg.assignments) if a]
+        assignment_data_lookup[cg.id] = assignments_data
 
-        key = (unit_id, cg.id)
-        existing = existing_groups_by_key.get(key)
+        row = AssignmentGroupCreate.model_validate(data).model_dump()
+        row["total_points"] = sum(a["points"] for a in assignments_data)
+        group_rows.append(row)
 
-        if existing:
-            update = AssignmentGroupUpdate.model_validate(data).model_dump(exclude_unset=True)
-            existing.sqlmodel_update(update)
-            modified_groups.append(existing)
-        else:
-            new = AssignmentGroup.model_validate(AssignmentGroupCreate.model_validate(data))
-            session.add(new)
-            modified_groups.append(new)
+    # Every group's ID is needed (not just the changed ones) for its assignments
+    groups = await run_in_session(
+        session,
+        bulk_upsert,
+        session=session,
+        model=AssignmentGroup,
+        rows=group_rows,
+        key_columns=["unit_id", "canvas_id"],
+        update_columns=["name", "group_weight", "total_points"],
+        returning="all"
+    )
 
-    session.flush()  # Needed so new groups get IDs
+    assignment_rows : list[dict] = []
+
+    for group in groups:
+        for data in assignment_data_lookup.get(group.canvas_id, []):
+            data["group_id"] = group.id
+            row = AssignmentCreate.model_validate(data).model_dump()
+            row["grade_contribution"] = get_grade_contribution(
+                points=row["points"],
+                total_points=group.total_points,
+                group_weight=group.group_weight,
+                apply_assignment_group_weights=apply_assignment_group_weights
+            )
+            assignment_rows.append(row)
+
+    await set_assignment_description_texts(assignment_rows, session)
+
+    def save_assignments() -> list[AssignmentPublicWithGroup]:
+        modified_assignments = bulk_upsert(
+            session=session,
+            model=Assignment,
+            rows=assignment_rows,
+            key_columns=["group_id", "canvas_id"],
+            update_columns=[
+                "name", "description", "due_at", "points", "is_group", "grade_contribution",
+                "readable_description", "prompt_description", "description_hash"
+            ],
+            options=[selectinload(Assignment.group)]
+        )
 
-    # Map canvas group → DB group_id
-    group_id_lookup = {
-        (g.unit_id, g.canvas_id): g.id for g in modified_groups
-    }
+        # Serialise the assignments before committing so
+        # they do not need to be reloaded one by one.
+        return [AssignmentPublicWithGroup.model_validate(a) for a in modified_assignments]
 
-    # --------------------------------------------------
-    # 4. Collect all assignments
-    # --------------------------------------------------
-    all_canvas_assignments: list[tuple[int, CanvasAssignment]] = []
+    return await run_in_session(session, save_assignments)
 
-    for unit_id, cg in all_canvas_groups:
-        group_id = group_id_lookup.get((unit_id, cg.id))
-        if not group_id:
-            continue
-        for a in cg.assignments:
-            all_canvas_assignments.append((group_id, a))
+async def commit_canvas_submissions(
+    units : list[Unit],
+    user_units_by_unit_id : dict[int, UsersUnits],
+    mode : Literal["full", "incremental"],
+    now : datetime,
+    session : Session,
+    user : User,
+    magic : str
+):
+    """
+    Per-user pass of the assignment sync: sync the user's
+    submissions for the assignments of each unit, one page
+    of submissions at a time.
+
+    In "incremental" mode, only the submissions which were submitted or
+    graded since the user's last sync of a unit are downloaded (see
+    ``get_submissions_watermark``). Every submission is downloaded for
+    units which the user has not synced yet, whose assignments have
+    changed since (Canvas does not report the new, unsubmitted
+    submissions of new assignments as changed), or in "full" mode.
+
+    The user's prompts are only invalidated if their
+    submissions have changed.
+
+    Preconditions:
+    - The course-level pass (``commit_canvas_course_assignments``) has run.
+    """
+    if mode == "incremental":
+        units = [
+            unit for unit in units
+            if is_sync_due(
+                unit,
+                user_units_by_unit_id[unit.id].synced_at,
+                user_units_by_unit_id[unit.id].assignments_digest,
+                now,
+                interval=0
+            )
+        ]
 
-    if not all_canvas_assignments:
-        session.commit()
-        return []
-    
-    # --------------------------------------------------
-    # 5. Bulk fetch existing Assignments
-    # --------------------------------------------------
-    assignment_canvas_ids = [a.id for _, a in all_canvas_assignments]
+    results : list[tuple[bool, bool]] = await gather_or_cancel(*[
+        commit_canvas_unit_submissions(
+            unit_id=unit.id,
+            canvas_unit_id=unit.canvas_id,
+            since=get_submissions_watermark(unit, user_units_by_unit_id[unit.id]) if mode == "incremental" else None,
+            session=session,
+            user=user,
+            magic=magic
+        )
+        for unit in units
+    ])
 
-    existing_assignments = session.exec(
-        select(Assignment)
-        .join(AssignmentGroup)
-        .join(Unit)
-        .join(Term)
-        .where(Assignment.canvas_id.in_(assignment_canvas_ids))
-        .where(Term.university_name == user.university_name)
-    ).all()
+    digests : dict[int, str | None] = {}
+    changed = False
 
-    existing_assignments_by_key = {
-        (a.group_id, a.canvas_id): a for a in existing_assignments
-    }
+    for unit, (all_matched, unit_changed) in zip(units, results):
+        changed = changed or unit_changed
+        # Do not store the digest of units with submissions for assignments which
+        # are not in the database yet, so that every submission is synced again.
+        digests[unit.id] = unit.assignments_digest if all_matched else None
 
-    modified_assignments: list[Assignment] = []
+    if changed:
+        prompt_cache.invalidate(user.id, "assignments")
 
-    # --------------------------------------------------
-    # 6. Upsert Assignments
-    # --------------------------------------------------
-    for group_id, ca in all_canvas_assignments:
-        data = parse_canvas_assignment(ca)
-        if not data:
-            continue
-        data["group_id"] = group_id
+    await run_in_session(session, record_unit_syncs, user_units_by_unit_id, digests, now, session)
 
-        key = (group_id, ca.id)
-        existing = existing_assignments_by_key.get(key)
+def get_submissions_watermark(
+    unit : Unit,
+    user_unit : UsersUnits
+) -> datetime | None:
+    """
+    Obtain the time since which the user's submissions in a unit
+    must be downloaded again, or None if all of them must be.
 
-        if existing:
-            update = AssignmentUpdate.model_validate(data).model_dump(exclude_unset=True)
-            existing.sqlmodel_update(update)
-            modified_assignments.append(existing)
-        else:
-            new = Assignment.model_validate(AssignmentCreate.model_validate(data))
-            session.add(new)
-            modified_assignments.append(new)
+    The user's enrolment stores the unit's assignments digest which their
+    submissions were last matched against. If the unit's assignments have
+    changed since, every submission is needed, since the submissions of
+    new assignments are neither submitted nor graded.
+    """
+    if user_unit.synced_at is None or user_unit.assignments_digest is None: return None
+    if user_unit.assignments_digest != unit.assignments_digest: return None
+    return parse_timestamp(user_unit.synced_at, "UTC") - timedelta(seconds=CANVAS_SUBMISSIONS_OVERLAP)
 
-    # --------------------------------------------------
-    # 7. Commit once
-    # --------------------------------------------------
-    session.commit()
+async def commit_canvas_unit_submissions(
+    unit_id : int,
+    canvas_unit_id : int,
+    since : datetime | None,
+    session : Session,
+    user : User,
+    magic : str
+) -> tuple[bool, bool]:
+    """
+    Sync the user's submissions in one unit (without committing), one
+    page of submissions at a time (see ``query_canvas_pages``), so that
+    only one page of Canvas data is held in memory at once.
+
+    Canvas combines the ``submitted_since`` and ``graded_since`` filters,
+    so the submissions changed since the watermark are downloaded with one
+    request for each. Stale enrolments are only removed when every
+    submission was downloaded.
+
+    Args:
+        since (datetime | None): Only sync the submissions submitted or graded since this time, or None to sync every submission.
+
+    Returns:
+        all_matched (bool): Whether every submission's assignment is in the database.
+        changed (bool): Whether any of the user's enrolments were written or removed.
+    """
+    if since is None:
+        filters = [None]
+    else:
+        timestamp = since.astimezone(timezone.utc).isoformat()
+        filters = [{"submitted_since" : timestamp}, {"graded_since" : timestamp}]
+
+    enrolled_assignment_ids : list[int] = []
+    all_matched = True
+    changed = False
+
+    for page_filters in filters:
+        async for page in canvas_get_submission_pages(unit_id=canvas_unit_id, user=user, magic=magic, filters=page_filters):
+            submissions = {s.assignment_id: s for s in page.submissions}
+            if not submissions: continue
+
+            page_matched, assignment_ids, page_changed = await run_in_session(
+                session,
+                enrol_user_in_unit_assignments,
+                unit_id=unit_id,
+                submissions=submissions,
+                session=session,
+                user=user
+            )
+            all_matched = all_matched and page_matched
+            enrolled_assignment_ids.extend(assignment_ids)
+            changed = changed or page_changed
+
+    if since is None:
+        removed = await run_in_session(
+            session,
+            remove_stale_user_assignments,
+            unit_id=unit_id,
+            assignment_ids=enrolled_assignment_ids,
+            session=session,
+            user=user
+        )
+        changed = changed or removed > 0
+
+    return all_matched, changed
+
+def enrol_user_in_unit_assignments(
+    unit_id : int,
+    submissions : dict[int, CanvasSubmission],
+    session : Session,
+    user : User
+) -> tuple[bool, list[int], bool]:
+    """
+    Enrol the user in the assignments of a unit which one page of
+    their submissions belongs to (see ``enrol_user_in_assignments``).
 
-    for assignment in modified_assignments:
-        session.refresh(assignment)
+    Args:
+        submissions (dict[int, CanvasSubmission]): The user's submissions, keyed by their Canvas assignment ID.
 
-    canvas_assignments = [a[1] for a in all_canvas_assignments]
+    Returns:
+        all_matched (bool): Whether every submission's assignment is in the database.
+        assignment_ids (list[int]): The IDs of the assignments the user is enrolled in.
+        changed (bool): Whether any of the user's enrolments were written.
+    """
+    assignments = session.exec(
+        select(Assignment)
+        .join(AssignmentGroup)
+        .where(AssignmentGroup.unit_id == unit_id)
+        .where(Assignment.canvas_id.in_(list(submissions.keys())))
+    ).all()
+
+    all_matched = submissions.keys() <= {assignment.canvas_id for assignment in assignments}
 
-    await enrol_user_in_assignments(
-        assignments=modified_assignments,
+    assignment_ids, changed = enrol_user_in_assignments(
+        assignments=assignments,
+        submissions=submissions,
         session=session,
-        magic=magic,
         user=user
     )
-
-    return modified_assignments
+    return all_matched, assignment_ids, changed
 
 def parse_canvas_submission(
     data : CanvasSubmission
@@ -786,81 +1398,99 @@ def parse_canvas_submission(
         "submitted_at" : data.submitted_at
     }
 
-async def enrol_user_in_assignments(
-    assignments: list[Assignment],
-    session: Session,
-    magic: str,
-    user: User
-):
-    session.refresh(user)
-    
-    canvas_assignments: list[CanvasAssignmentWithSubmission] = []
-
-    unit_ids = list({
-        assignment.group.unit.canvas_id
-        for assignment in assignments
-    })
-
-    tasks = [
-        canvas_get_assignments(
-            unit_id=canvas_unit_id,
-            user=user,
-            magic=magic
-        )
-        for canvas_unit_id in unit_ids
-    ]
-
-    results : list[CanvasAssignmentsResult] = await asyncio.gather(*tasks)
-
-    canvas_assignments = []
-    for unit_assignments_result in results:
-        canvas_assignments.extend(unit_assignments_result.assignments)
+def enrol_user_in_assignments(
+    assignments : list[Assignment],
+    submissions : dict[int, CanvasSubmission],
+    session : Session,
+    user : User
+) -> tuple[list[int], bool]:
+    """
+    Sync the user's submission status for each assignment into DB (without committing).
 
-    canvas_by_id = {a.id: a for a in canvas_assignments}
+    The user is only enrolled in assignments which they have a
+    Canvas submission for (i.e., which are assigned to them).
 
-    # ---- Track which assignments user SHOULD have ----
-    valid_assignment_ids = {a.id for a in assignments}
+    Args:
+        assignments (list[Assignment]): The assignments the user may be enrolled in.
+        submissions (dict[int, CanvasSubmission]): The user's submissions keyed by Canvas assignment ID.
+        session (Session): SQLModel connection with the database.
+        user (User): The user to enrol.
 
-    # ---- Existing junction rows ----
-    stmt = select(UsersAssignments).where(
-        UsersAssignments.user_id == user.id
-    )
-    existing_rows = session.exec(stmt).all()
-    existing_by_assignment = {
-        ua.assignment_id: ua for ua in existing_rows
+    Returns:
+        assignment_ids (list[int]): The IDs of the assignments the user is enrolled in.
+        changed (bool): Whether any enrolment was created or updated.
+    """
+    rows = [
+        {
+            "user_id" : user.id,
+            "assignment_id" : assignment.id,
+            **parse_canvas_submission(submissions[assignment.canvas_id])
+        }
+        for assignment in assignments
+        if submissions.get(assignment.canvas_id) is not None
+    ]
+    assignment_ids = [row["assignment_id"] for row in rows]
+    if not rows: return assignment_ids, False
+
+    # users_assignments has no content hash, so compare with the stored rows
+    # to skip the enrolments which have not changed.
+    stored = {
+        r.assignment_id : (r.submitted, parse_timestamp(r.submitted_at, "UTC"))
+        for r in session.exec(
+            select(UsersAssignments.assignment_id, UsersAssignments.submitted, UsersAssignments.submitted_at)
+            .where(UsersAssignments.user_id == user.id)
+            .where(UsersAssignments.assignment_id.in_(assignment_ids))
+        ).all()
     }
+    rows = [
+        row for row in rows
+        if stored.get(row["assignment_id"]) != (row["submitted"], parse_timestamp(row["submitted_at"], "UTC"))
+    ]
 
-    # ---- Create / Update ----
-    for assignment in assignments:
-        canvas_assignment = canvas_by_id.get(assignment.canvas_id)
-        if not canvas_assignment:
-            continue
-
-        update = parse_canvas_submission(
-            canvas_assignment.submission
-        )
+    bulk_upsert(
+        session=session,
+        model=UsersAssignments,
+        rows=rows,
+        key_columns=["assignment_id", "user_id"],
+        update_columns=["submitted", "submitted_at"],
+        hash_column=None,
+        returning=None
+    )
 
-        ua = existing_by_assignment.get(assignment.id)
+    return assignment_ids, bool(rows)
 
-        if not ua:
-            ua = UsersAssignments(
-                user_id=user.id,
-                assignment_id=assignment.id,
-                **update
-            )
-            session.add(ua)
-        else:
-            ua.sqlmodel_update(update)
+def remove_stale_user_assignments(
+    unit_id : int,
+    assignment_ids : list[int],
+    session : Session,
+    user : User
+) -> int:
+    """
+    Unenrol the user from the assignments of a unit which they no
+    longer have a Canvas submission for (without committing).
 
-    # ---- Remove stale assignments ----
-    for assignment_id, ua in existing_by_assignment.items():
-        if assignment_id not in valid_assignment_ids:
-            session.delete(ua)
+    Args:
+        unit_id (int): The ID of the unit.
+        assignment_ids (list[int]): The IDs of the unit's assignments the user is still enrolled in.
 
-    session.commit()
+    Returns:
+        int: The number of enrolments removed.
+    """
+    result = session.execute(
+        delete(UsersAssignments)
+        .where(UsersAssignments.user_id == user.id)
+        .where(UsersAssignments.assignment_id.not_in(assignment_ids))
+        .where(UsersAssignments.assignment_id.in_(
+            select(Assignment.id)
+            .join(AssignmentGroup)
+            .where(AssignmentGroup.unit_id == unit_id)
+        ))
+    )
+    return result.rowcount
 
 @router.post("/canvas/all", response_model = Literal[True])
 async def sync_canvas_to_db(
+    mode : Literal["full", "incremental"] = "incremental",
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session),
     magic : str = Depends(get_current_magic)
@@ -874,7 +1504,15 @@ async def sync_canvas_to_db(
     - Creates if missing
     - Updates if existing
 
+    Each stage writes Canvas results page by page as they are downloaded.
+
+    By default, the sync is incremental: units which were synced
+    recently are not downloaded again (see
+    ``commit_canvas_groups_and_assignments``). Use mode="full"
+    to download every unit.
+
     Args:
+        mode (Literal["full", "incremental"], optional): Whether to sync every unit or only changed units. Defaults to "incremental".
         user (User): The currently logged-in user.
         session (Session): SQLModel connection with the database.
         magic (str): The user's magic..
@@ -885,25 +1523,21 @@ async def sync_canvas_to_db(
     Returns:
         Literal[True]: Returns True if the process succeeded.
     """
-    try:
-        await commit_canvas_terms(user=user, session=session, magic=magic)
-    except Exception as e:
-        session.rollback()
-        raise HTTPException(status_code=500, detail=f"Error downloading semester information from Canvas! Error message: {str(e)}")
-    
+    # The units stage also syncs the units' terms,
+    # so that the units are only downloaded once.
     try:
         await commit_canvas_units(user=user, session=session, magic=magic)
     except HTTPException as e:
-        session.rollback()
+        await run_in_session(session, session.rollback)
         raise e
     except Exception as e:
-        session.rollback()
+        await run_in_session(session, session.rollback)
         raise HTTPException(status_code=500, detail=f"Error downloading units from Canvas! Error message: {str(e)}")
-    
+
     try:
-        await commit_canvas_groups_and_assignments(user=user, session=session, magic=magic)
+        await commit_canvas_groups_and_assignments(mode=mode, user=user, session=session, magic=magic)
     except Exception as e:
-        session.rollback()
+        await run_in_session(session, session.rollback)
         raise HTTPException(status_code=500, detail=f"Error downloading assignments from Canvas! Error message: {str(e)}")
-    
+
     return True
@@ -1,19 +1,72 @@
 from pydantic import BaseModel, TypeAdapter
 from ..models import Conversation, ConversationUpdate, ConversationPublic, ConversationPublicWithMessages
-from ..models import User, NewMessage, Message, MessageCreate
+from ..models import User, NewMessage, Message, MessageCreate, UsersUnits
 from fastapi import APIRouter, Depends, HTTPException, Query, BackgroundTasks
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from anyio import from_thread
 from sqlmodel import Session, select, desc
-from ..dependencies import get_current_magic, get_current_user, get_session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import and_
+from sqlalchemy.orm import selectinload
+from ..dependencies import get_current_magic, get_current_user, get_current_user_async, get_session, get_async_session
 from ..date_utils import parse_timestamp
+from ..prompt_cache import prompt_cache
+from ..summary_worker import summary_worker
+from ..llm_scheduler import llm_scheduler
+from ..llm_pool import llm_pool
+from ..chat_events import StreamFormat, STREAM_MEDIA_TYPES
+from ..chat_disconnect import stream_cancellations
+from ..llm_telemetry import LLMCallTelemetry, save_llm_telemetry, aggregate_llm_telemetry
 from ..llm_api import chat, chat_stream, summarise
 from langchain_core.messages import BaseMessage
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from typing import Literal
 import json
 
 router = APIRouter()
 
+def with_conversation_colour(query):
+    """
+    Extend a query of conversations to also obtain the colour the user
+    gave each conversation's unit, in the same statement.
+
+    ``Conversation.colour_raw`` queries the database for each
+    conversation, so build public conversations from the rows
+    of this query with ``build_conversation_public`` instead.
+
+    Any join to ``User`` in the query needs an explicit ON clause, since
+    ``users_units`` can also be joined to it. The query must be run with
+    ``session.execute`` (not ``session.exec``), which returns rows of
+    (Conversation, colour).
+    """
+    return (
+        query
+        .outerjoin(UsersUnits, and_(
+            UsersUnits.unit_id == Conversation.unit_id,
+            UsersUnits.user_id == Conversation.user_id
+        ))
+        .add_columns(UsersUnits.colour)
+    )
+
+def build_conversation_public(
+    conversation : Conversation,
+    colour : str | None,
+    with_messages : bool = False
+) -> ConversationPublic | ConversationPublicWithMessages:
+    """
+    Build a public conversation from a row of a query extended by ``with_conversation_colour``.
+
+    Args:
+        conversation (Conversation): The conversation.
+        colour (str | None): The colour of the conversation's unit.
+        with_messages (bool, optional): Whether to include the conversation's messages, which must already be loaded. Defaults to False.
+    """
+    data = {**conversation.model_dump(), "colour_raw" : colour}
+    if with_messages:
+        return ConversationPublicWithMessages.model_validate({**data, "messages" : conversation.messages})
+    return ConversationPublic.model_validate(data)
+
 @router.get("/test_chat/{message}")
 async def test_chat(
     message : str,
@@ -67,6 +120,7 @@ async def test_chat_stream(
     if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
     messages = [{"role":"user","content":message}]
 
+    llm_scheduler.check_capacity("chat")
     return StreamingResponse(
         chat_stream(
             user=user,
@@ -145,6 +199,7 @@ async def test_chat_stream_with_messages(
     if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
     # messages = [{"role":"user","content":message}]
 
+    llm_scheduler.check_capacity("chat")
     return StreamingResponse(
         chat_stream(
             user=user,
@@ -161,8 +216,13 @@ async def test_chat_stream_with_messages(
     )
 
 
-@router.get("/conversation/{id}", response_model=ConversationPublicWithMessages)
-async def get_conversation(id : int, user : User = Depends(get_current_user), session : Session = Depends(get_session)):
+def _require_conversation_access(conversation : Conversation | None, id : int, user : User) -> None:
+    if not conversation: raise HTTPException(status_code=404, detail=f"Conversation not found with ID {id}")
+
+    if not conversation.user_id == user.id and not user.admin:
+        raise HTTPException(status_code=401, detail="You are not authorised to view this conversation")
+
+def get_conversation(id : int, user : User = Depends(get_current_user), session : Session = Depends(get_session)):
     """
     Obtain an existing conversation with its messages.
 
@@ -179,42 +239,71 @@ async def get_conversation(id : int, user : User = Depends(get_current_user), se
     """
 
     conversation = session.get(Conversation, id)
+    _require_conversation_access(conversation, id, user)
+    return conversation
 
-    if not conversation: raise HTTPException(status_code=404, detail=f"Conversation not found with ID {id}")
+@router.get("/conversation/{id}", response_model=ConversationPublicWithMessages)
+async def get_conversation_public(
+    id : int,
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> ConversationPublicWithMessages:
+    """
+    Obtain an existing conversation with its messages and colour.
+    The conversation's messages are loaded eagerly.
 
-    if not conversation.user_id == user.id and not user.admin:
-        raise HTTPException(status_code=401, detail="You are not authorised to view this conversation")
+    Args:
+        id (int): The ID of the conversation to retrieve.
+    
+    Raises:
+        HTTPException:
+            If the current user is not an administrator, this will return a 401 (Unauthorized) response when attempting to view other users' conversations.
+            This will also return a 404 (not found) if the conversation did not exist in the DB.
+    
+    Returns:
+        ConversationPublicWithMessages: The conversation with its messages included.
+    """
+    row = (await session.execute(
+        with_conversation_colour(select(Conversation).where(Conversation.id == id))
+        .options(selectinload(Conversation.messages))
+    )).first()
 
-    return conversation
+    conversation, colour = row or (None, None)
+    _require_conversation_access(conversation, id, user)
+
+    return build_conversation_public(conversation, colour, with_messages=True)
 
 @router.post("/user_conversations", response_model=list[ConversationPublicWithMessages])
 async def get_user_conversations(
     date : datetime = datetime(day=27,month=2,year=2026),
     limit : int = Query(default=100, le=500),
-    current_user : User = Depends(get_current_user),
-    session : Session = Depends(get_session),
+    current_user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session),
 ):
     if not current_user.admin: raise HTTPException(status_code=401,detail="Unauthorised")
 
-    messages = session.exec(
-        select(Conversation)
-        .join(User)
-        .where(Conversation.created_at >= date)
-        .where(User.admin == False)
-        .order_by(Conversation.created_at)
-        .limit(limit)
-    ).all()
+    rows = await session.execute(
+        with_conversation_colour(
+            select(Conversation)
+            .join(User, Conversation.user_id == User.id)
+            .where(Conversation.created_at >= date)
+            .where(User.admin == False)
+            .order_by(Conversation.created_at)
+            .limit(limit)
+        )
+        .options(selectinload(Conversation.messages))
+    )
     
-    return messages
+    return [build_conversation_public(*row, with_messages=True) for row in rows.all()]
 
 @router.get("/conversations/{username}", response_model=list[ConversationPublic])
 async def get_conversations_for_user(
     username : str | None = None,
     offset : int = 0, 
     limit : int = Query(default=100, le=100),
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
-):
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[ConversationPublic]:
     """
     Obtain all conversations for a given user.
 
@@ -226,18 +315,20 @@ async def get_conversations_for_user(
             If the current user is not an administrator, this will return a 401 (Unauthorized) response when attempting to view other users' conversations.
 
     Returns:
-        list[ConversationPublicWithMessages]: The conversations with their messages included.
+        list[ConversationPublic]: The conversations.
     """
     if username is None: username = user.username
     if username != user.username and not user.admin:
         raise HTTPException(status_code=401, detail="You are not authorised to view these conversations")
 
-    return session.exec(
-        select(Conversation).order_by(desc(Conversation.created_at)).join(User).where(User.username == username).offset(offset).limit(limit)
-    ).all()
+    rows = await session.execute(
+        with_conversation_colour(
+            select(Conversation).order_by(desc(Conversation.created_at)).join(User, Conversation.user_id == User.id).where(User.username == username).offset(offset).limit(limit)
+        )
+    )
+    return [build_conversation_public(*row) for row in rows.all()]
 
-@router.get("/conversations", response_model=list[ConversationPublic])
-async def get_conversations_for_self(
+def get_conversations_for_self(
     offset : int = 0, 
     limit : int = Query(default=100, le=100),
     user : User = Depends(get_current_user),
@@ -253,8 +344,29 @@ async def get_conversations_for_self(
         select(Conversation).order_by(desc(Conversation.created_at)).where(Conversation.user_id == user.id).offset(offset).limit(limit)
     ).all()
 
+@router.get("/conversations", response_model=list[ConversationPublic])
+async def get_conversations_public_for_self(
+    offset : int = 0, 
+    limit : int = Query(default=100, le=100),
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[ConversationPublic]:
+    """
+    Obtain all conversations for the current user, with their colours.
+
+    Returns:
+        list[ConversationPublic]: The conversations.
+    """
+    return await get_conversations_for_user(
+        username=user.username,
+        offset=offset,
+        limit=limit,
+        user=user,
+        session=session
+    )
+
 @router.patch("/conversation/{id}", response_model=ConversationPublicWithMessages)
-async def update_conversation(
+def update_conversation(
     data : ConversationUpdate,
     id : int,
     user : User = Depends(get_current_user),
@@ -277,7 +389,7 @@ async def update_conversation(
         ConversationPublicWithMessages: The conversation with the summary added.
     """
 
-    existing_conversation : Conversation = await get_conversation(
+    existing_conversation : Conversation = get_conversation(
         id = id,
         user = user,
         session = session
@@ -290,11 +402,12 @@ async def update_conversation(
     session.add(existing_conversation)
     session.commit()
     session.refresh(existing_conversation)
+    prompt_cache.invalidate(existing_conversation.user_id, "history")
     
     return existing_conversation
 
 @router.delete("/conversation/{id}", response_model=Literal[True])
-async def delete_conversation(
+def delete_conversation(
     id : int,
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session)
@@ -315,16 +428,32 @@ async def delete_conversation(
     if not conversation: raise HTTPException(status_code=404, detail="Conversation not found")
 
     if conversation.user_id != user.id and not user.admin: raise HTTPException(status_code=401, detail="You are not authorised to delete this conversation")
+    conversation_user_id = conversation.user_id
     session.delete(conversation)
     session.commit()
+    prompt_cache.invalidate(conversation_user_id, "history")
     return True
 
 # @router.post("/message", response_model=ConversationPublicWithMessages)
-async def add_message_to_conversation(
+def add_message_to_conversation(
     data : MessageCreate,
     user : User,
     session : Session
-):
+) -> Message:
+    """
+    Add a message to an existing conversation.
+
+    Args:
+        data (MessageCreate): The message and the ID of its conversation.
+
+    Raises:
+        HTTPException:
+            Raises a 404 if the conversation does not exist.
+            Raises a 401 if the user attempts to add a message to another user's conversation.
+
+    Returns:
+        Message: The new message (e.g., to link records to its ID).
+    """
     existing_conversation = session.get(Conversation, data.conversation_id)
     if not existing_conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
@@ -337,24 +466,43 @@ async def add_message_to_conversation(
     })
 
     session.add(message)
+
+    # The conversation has continued since it was summarised, so
+    # the summary worker summarises it again once it is idle.
+    summary_outdated = bool(existing_conversation.summary)
+    if summary_outdated:
+        existing_conversation.summary = None
+        session.add(existing_conversation)
+
     session.commit()
     session.refresh(message)
 
-    return existing_conversation
+    if summary_outdated:
+        prompt_cache.invalidate(existing_conversation.user_id, "history")
+
+    return message
 
 async def add_messages_to_conversation(
     messages : list[dict[str,str]],
     conversation_id : int,
     user : User,
-    session : Session
+    session : Session,
+    telemetry : LLMCallTelemetry | None = None
 ) -> Conversation:
     """
     Add a list of messages in the OpenAI chat template
     format to an existing conversation.
 
+    This is the end function of streamed replies (see ``chat_stream``),
+    so the messages are written in the threadpool (see
+    ``write_messages_to_conversation``) rather than on the event loop.
+
     Args:
         messages (list[dict[str,str]]): The messages in OpenAI chat template format.
         conversation_id (int): The conversation ID.
+        telemetry (LLMCallTelemetry | None, optional):
+            The telemetry of the LLM call which generated the messages.
+            If given, it is saved linked to the last assistant message added. Defaults to None.
 
     Raises:
         HTTPException:
@@ -364,13 +512,42 @@ async def add_messages_to_conversation(
     Returns:
         Conversation: The conversation with the LLM response added to the list of messages.
     """
+    existing_conversation, assistant_message_id = await run_in_threadpool(
+        write_messages_to_conversation,
+        messages=messages,
+        conversation_id=conversation_id,
+        user=user,
+        session=session
+    )
+
+    if telemetry is not None:
+        await save_llm_telemetry(telemetry, message_id=assistant_message_id)
 
+    return existing_conversation
+
+def write_messages_to_conversation(
+    messages : list[dict[str,str]],
+    conversation_id : int,
+    user : User,
+    session : Session
+) -> tuple[Conversation, int | None]:
+    """
+    Add a list of messages in the OpenAI chat template
+    format to an existing conversation (see ``add_messages_to_conversation``).
+
+    Returns:
+        existing_conversation (Conversation): The conversation.
+        assistant_message_id (int | None): The ID of the last assistant message added, if any.
+    """
     existing_conversation = session.get(Conversation, conversation_id)
     if not existing_conversation: raise HTTPException(status_code=404, detail="Conversation not found")
     
     if existing_conversation.user_id != user.id and not user.admin:
         raise HTTPException(status_code=401, detail="You are not authorised to add messages to another user's conversation")
 
+    # The last assistant message added, which the telemetry is linked to
+    assistant_message_id = None
+
     for message in messages:
 
         if not message.get("role") or not message.get("content"):
@@ -382,16 +559,17 @@ async def add_messages_to_conversation(
             content=message.get("content")
         )
 
-        new_conversation = await add_message_to_conversation(
+        new_message = add_message_to_conversation(
             message_data,
             user=user,
             session=session
         )
+        if new_message.role == "assistant": assistant_message_id = new_message.id
 
-    return new_conversation
+    return existing_conversation, assistant_message_id
 
 @router.patch("/message/{message_id}", response_model=ConversationPublicWithMessages)
-async def update_message_in_conversation(
+def update_message_in_conversation(
     message_id : int,
     new_message_text : str,
     user : User = Depends(get_current_user),
@@ -444,7 +622,7 @@ async def update_message_in_conversation(
     return existing_conversation 
 
 @router.delete("/message/{message_id}", response_model=ConversationPublicWithMessages)
-async def delete_message_in_conversation(
+def delete_message_in_conversation(
     message_id : int,
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session)
@@ -471,7 +649,7 @@ async def delete_message_in_conversation(
     return existing_conversation
 
 @router.get("/conversation_greeting", response_model=str)
-async def get_conversation_greeting(
+def get_conversation_greeting(
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session)
 ):
@@ -485,7 +663,7 @@ async def get_conversation_greeting(
         str: The greeting message.
     """
 
-    existing_conversations = await get_conversations_for_self(offset=0, limit=1, user=user, session=session)
+    existing_conversations = get_conversations_for_self(offset=0, limit=1, user=user, session=session)
     
     is_first_conversation = len(existing_conversations) == 0
 
@@ -510,7 +688,7 @@ please let the researchers know in the feedback survey 👍
         return f"## Hello! How can I help you today?"
 
 @router.post("/conversation", response_model=ConversationPublicWithMessages)
-async def conversation_start(
+def conversation_start(
     new_message : NewMessage,
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic),
@@ -549,7 +727,7 @@ async def conversation_start(
     
     # is_first_conversation = len(existing_conversations) == 0
     
-    greeting_message = await get_conversation_greeting(
+    greeting_message = get_conversation_greeting(
         user=user, session=session
     )
 
@@ -559,6 +737,21 @@ async def conversation_start(
 
     if not conversation:
         raise HTTPException(status_code=500, detail="System error creating conversation!")
+
+    # The previous conversation is now part of the chat history, so
+    # summarise the user's previous conversations in the background
+    # (as many as the system prompt shows, see get_previous_conversation_summaries).
+    prompt_cache.invalidate(user.id, "history")
+    previous_conversation_ids = session.exec(
+        select(Conversation.id)
+        .where(Conversation.user_id == user.id)
+        .where(Conversation.id != conversation.id)
+        .where(Conversation.summary == None)
+        .order_by(desc(Conversation.created_at))
+        .limit(3)
+    ).all()
+    # This route runs in the threadpool, and the worker's queue belongs to the event loop
+    from_thread.run_sync(summary_worker.enqueue, *previous_conversation_ids)
     
     # Add the chatbot's initial "greeting"
     # message to the conversation.
@@ -570,13 +763,13 @@ async def conversation_start(
         content = greeting_message
     )
 
-    await add_message_to_conversation(
+    add_message_to_conversation(
         greeting_message_data,
         user=user,
         session=session
     )
 
-    conversation_with_response = await conversation_continue(
+    conversation_with_response = conversation_continue(
         conversation_id = conversation.id,
         new_message=new_message,
         user=user,
@@ -586,7 +779,7 @@ async def conversation_start(
     return conversation_with_response
 
 @router.post("/conversation/{conversation_id}", response_model=ConversationPublicWithMessages)
-async def conversation_continue(
+def conversation_continue(
     conversation_id : int,
     new_message : NewMessage,
     user : User = Depends(get_current_user),
@@ -617,13 +810,13 @@ async def conversation_continue(
         content=new_message.message_text
     )
     
-    new_conversation = await add_message_to_conversation(
+    add_message_to_conversation(
         message_data,
         user=user,
         session=session
     )
 
-    return new_conversation
+    return existing_conversation
 
 
 def get_message_list_from_conversation_object(
@@ -704,7 +897,7 @@ async def call_llm_response_to_conversation(
     Returns:
         str: The LLM's response text.
     """
-    messages = get_message_list(conversation_id=conversation_id, user=user, session=session)
+    messages = await run_in_threadpool(get_message_list, conversation_id=conversation_id, user=user, session=session)
     if not messages:
         raise HTTPException(status_code=400, detail="Error responding to conversation: conversation is empty!")
     if messages[-1]["role"] != "user":
@@ -714,7 +907,8 @@ async def call_llm_response_to_conversation(
         user=user,
         magic=magic,
         session=session,
-        messages=messages
+        messages=messages,
+        conversation_id=conversation_id
     )
 
     response_text = str(response_messages[-1].content)
@@ -735,6 +929,7 @@ async def call_llm_response_to_conversation(
 async def stream_llm_response_to_conversation(
     conversation_id : int,
     background_tasks : BackgroundTasks,
+    stream_format : StreamFormat = "text",
     user : User = Depends(get_current_user),
     magic : str = Depends(get_current_magic),
     session : Session = Depends(get_session)
@@ -743,10 +938,15 @@ async def stream_llm_response_to_conversation(
     Queries the LLM to respond to a given conversation.
     Returns the LLM's response text. Adds the LLM's response
     to the list of messages in the conversation as a side
-    effect using a background task.
+    effect using a background task. If the client disconnects,
+    generation stops and the partial response is added.
 
     Args:
         conversation_id (int): The conversation ID.
+        stream_format (StreamFormat, optional):
+            "text" streams the bare response text. "ndjson" (one JSON object per line)
+            and "sse" (server-sent events) stream typed events instead: text deltas,
+            tool calls and timings (see chat_events.py). Defaults to "text".
 
     Raises:
         HTTPException:
@@ -754,16 +954,17 @@ async def stream_llm_response_to_conversation(
             Raises a 401 if the user attempts to call the LLM to respond to another user's conversation.
             Raises a 400 if the conversation does not have any messages (nothing to respond to).
             Raises a 400 if the last message in the conversation was not a user message.
+            Raises a 503 if too many LLM requests are waiting.
 
     Returns:
         StreamingResponse: The LLM's response text in chunks.
     """
 
-    conversation : Conversation = session.get(Conversation, conversation_id)
+    conversation : Conversation = await run_in_threadpool(session.get, Conversation, conversation_id)
     if not conversation:
         raise HTTPException(status_code=500, detail="Error responding to conversation: Could not obtain conversation object!")
 
-    messages = get_message_list(conversation_id=conversation_id, user=user, session=session)
+    messages = await run_in_threadpool(get_message_list, conversation_id=conversation_id, user=user, session=session)
     if not messages:
         raise HTTPException(status_code=500, detail="Error responding to conversation: Conversation is empty!")
     if messages[-1]["role"] != "user":
@@ -779,6 +980,10 @@ async def stream_llm_response_to_conversation(
         "user" : user,
         "session" : session
     }
+
+    # Reject the request now if the LLM queue is full,
+    # since it cannot be rejected once streaming starts.
+    llm_scheduler.check_capacity("chat")
     
     response = StreamingResponse(
         chat_stream(
@@ -789,9 +994,11 @@ async def stream_llm_response_to_conversation(
             unit_id=conversation.unit_id,
             background_tasks=background_tasks,
             end_function=end_function,
-            end_function_kwargs=end_function_kwargs
+            end_function_kwargs=end_function_kwargs,
+            stream_format=stream_format,
+            conversation_id=conversation_id
         ),
-        media_type="text/plain",
+        media_type=STREAM_MEDIA_TYPES[stream_format],
         headers={
             "Cache-Control": "no-cache, no-transform",
             "X-Accel-Buffering": "no"
@@ -822,26 +1029,32 @@ async def create_conversation_summary(
             The conversation with the summary added.
     """
 
+    # Reading the conversation may query the database (e.g., if it
+    # expired when another summary was committed), so read it in the threadpool
+    conversation_pub = await run_in_threadpool(ConversationPublic.model_validate, conversation)
+
     # Return the conversation summary if it exists
-    if conversation.summary:
+    if conversation_pub.summary:
         return conversation
 
     # Create a summary if not exists
     
     # Obtain OpenAI-formatted list of messages for the conversation
-    messages : list[dict[str,str]] = get_message_list_from_conversation_object(
+    messages : list[dict[str,str]] = await run_in_threadpool(
+        get_message_list_from_conversation_object,
         conversation=conversation
     )
 
     # Get LLM to summarise conversation text
     summary : str = await summarise(
         chat_message_log = messages,
-        max_words = max_words
+        max_words = max_words,
+        user_id = user.id,
+        conversation_id = conversation_pub.id
     )
-    
-    conversation_pub = ConversationPublic.model_validate(conversation)
 
-    conversation = await update_conversation(
+    conversation = await run_in_threadpool(
+        update_conversation,
         data = ConversationUpdate(summary = summary),
         id = conversation_pub.id,
         user = user,
@@ -875,7 +1088,8 @@ async def get_conversation_summary(
         ConversationPublic:
             The conversation with a summary added.
     """
-    conversation = await get_conversation(
+    conversation = await run_in_threadpool(
+        get_conversation,
         id = id,
         user = user,
         session = session
@@ -888,7 +1102,98 @@ async def get_conversation_summary(
         max_words = max_words
     )
 
-    return summary
+    # Serialising the conversation queries its colour (see Conversation.colour_raw)
+    return await run_in_threadpool(ConversationPublic.model_validate, summary)
+
+@router.get("/summary_worker", response_model=dict)
+async def get_summary_worker_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the state of the background conversation summary worker (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: Whether the worker is running, and the number of queued, summarised and failed conversations.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return summary_worker.stats()
+
+@router.get("/llm_scheduler", response_model=dict)
+async def get_llm_scheduler_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the LLM request queue depth and wait times of each priority (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The active and queued requests, and the admitted and rejected requests and wait times of each priority.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return llm_scheduler.stats()
+
+@router.get("/llm_pool", response_model=dict)
+async def get_llm_pool_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the health, latency and load of each LLM server (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The model, and the health, latency, outstanding requests and errors of each server.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return llm_pool.stats()
+
+@router.get("/stream_cancellations", response_model=dict)
+async def get_stream_cancellation_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the number of streamed replies which were completed or cancelled
+    because the client disconnected, and an estimate of the LLM generation
+    time saved by cancelling them (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The completed and cancelled stream counts, mean reply duration and estimated reclaimed seconds.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return stream_cancellations.stats()
+
+@router.get("/llm_telemetry", response_model=dict)
+async def get_llm_telemetry(
+    days : int = Query(default=7, ge=1, le=90),
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+):
+    """
+    Obtain the total, median and 95th percentile latency, queue time,
+    prompt build time, token counts and tool calls of the LLM calls made
+    in the last few days, by endpoint and by day (ADMIN ONLY).
+
+    Args:
+        days (int, optional): How many days of LLM calls to include. Defaults to 7.
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The summary of the telemetry (see llm_telemetry.aggregate_llm_telemetry).
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    return await aggregate_llm_telemetry(session, since)
 
 class ConversationSummary(BaseModel):
     summary : str
@@ -921,7 +1226,8 @@ async def get_conversation_summaries(
         list[ConversationSummary]: A list of conversation summaries.
     """
 
-    conversations = await get_conversations_for_self(
+    conversations = await run_in_threadpool(
+        get_conversations_for_self,
         offset=offset,
         limit=limit,
         user=user,
@@ -943,18 +1249,24 @@ async def get_conversation_summaries(
             session=session
         )
     
+    # The conversations expire when a summary is committed,
+    # so reading them again may query the database.
+    return await run_in_threadpool(build_conversation_summaries, conversations)
+
+def build_conversation_summaries(conversations : list[Conversation]) -> list[ConversationSummary]:
+    """
+    Obtain the summaries of the conversations which have one.
+    """
     # Filter out all conversations which don't have a summmary
     conversations = [c for c in conversations if c.summary]
 
-    summaries = [
+    return [
         ConversationSummary(
             date = conversation.created_at,
             summary = conversation.summary or ""
         ) for conversation in conversations
     ]
 
-    return summaries
-
 summary_list_adapter = TypeAdapter(list[ConversationSummary])
 
 @router.get("/tool/conversation_summaries_json", response_model=str)
@@ -6,8 +6,11 @@ from ..models import Unit,  UnitPublic, UnitPublicWithAssignmentGroups
 from ..models import AssignmentGroup, AssignmentGroupPublicWithUnit, AssignmentGroupPublicWithAssignments
 from ..models import Assignment, AssignmentPublic, AssignmentPublicWithGroup
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import and_
+from sqlalchemy.orm import selectinload, contains_eager
 from fastapi import APIRouter, Depends, HTTPException, Query
-from ..dependencies import get_session, get_current_user
+from ..dependencies import get_session, get_async_session, get_current_user, get_current_user_async
 from datetime import datetime, timezone
 from ..date_utils import parse_timestamp, timestamp_to_string, get_days_remaining
 from typing import Literal
@@ -15,10 +18,21 @@ import json
 
 router = APIRouter()
 
+# The read-only routes below use an AsyncSession, which never lazy-loads
+# relationships. These loader options load everything the public
+# response models and payload builders read (e.g., the assignment's
+# group, and the group's unit and term). Grade contributions and group
+# totals are stored columns, so the group's assignments are not needed.
+def group_loader(attribute):
+    return selectinload(attribute).selectinload(AssignmentGroup.unit).selectinload(Unit.term)
+
+def assignment_loader(attribute):
+    return selectinload(attribute).options(group_loader(Assignment.group))
+
 @router.get("/university", response_model=list[UniversityPublicWithAliases])
-def get_universities(
-    session : Session = Depends(get_session),
-    current_user : User = Depends(get_current_user)
+async def get_universities(
+    session : AsyncSession = Depends(get_async_session),
+    current_user : User = Depends(get_current_user_async)
 ):
     """
     Obtain all universities (ADMIN ONLY).
@@ -27,13 +41,16 @@ def get_universities(
         List[University]: The universities.
     """
     if not current_user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
-    return session.exec(select(University)).all()
+    universities = await session.exec(
+        select(University).options(selectinload(University.aliases))
+    )
+    return universities.all()
 
 @router.get("/university/{name}", response_model=UniversityPublicWithAliases)
-def get_university(
+async def get_university(
     name : str,
-    session : Session = Depends(get_session),
-    current_user : User = Depends(get_current_user)
+    session : AsyncSession = Depends(get_async_session),
+    current_user : User = Depends(get_current_user_async)
 ):
     """
     Obtain a given university and its alias list (ADMIN ONLY).
@@ -45,7 +62,7 @@ def get_university(
         UniversityPublicWithAliases: The university and its aliases.
     """
     if not current_user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
-    existing_university = session.get(University, name)
+    existing_university = await session.get(University, name, options=[selectinload(University.aliases)])
     if not existing_university: raise HTTPException(status_code=404, detail="University not found")
     return existing_university
 
@@ -159,11 +176,11 @@ def update_university_alias(
     return existing_alias
 
 @router.get("/terms", response_model=list[TermPublic])
-def get_terms(
+async def get_terms(
     offset : int = 0,
     limit : int = Query(default=100, le=100),
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ):
     """
     Obtain every teaching period (term)
@@ -178,30 +195,31 @@ def get_terms(
             Pagination length. Defaults to 100. Max of 100.
         user (User):
             The currently logged-in user.
-        session (Session, optional):
+        session (AsyncSession, optional):
             Active connection with the SQLModel database.
 
     Returns:
         list[TermPublic]: The teaching period.
     """
-    terms = session.exec(
+    terms = await session.exec(
         select(Term).offset(offset).limit(limit)
-    ).all()
-    return terms 
+    )
+    return terms.all()
 
 @router.get("/term/{id}", response_model=TermPublicWithUnits)
-def get_term(
+async def get_term(
     id : int,
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ):
     """
     Obtain a term (teaching period) with all its units.
+    The term's units are loaded eagerly.
 
     Args:
         id (int): The term ID.
         user (User): The currently logged-in user.
-        session (Session, optional): Active connection with the SQLModel database.
+        session (AsyncSession, optional): Active connection with the SQLModel database.
 
     Raises:
         HTTPException: If the term is not found, raises a 404.
@@ -209,11 +227,10 @@ def get_term(
     Returns:
         TermPublicWithUnits: The term with units included.
     """
-    term = session.get(Term, id)
+    term = await session.get(Term, id, options=[selectinload(Term.units)])
     if not term: raise HTTPException(status_code=404, detail="Term not found")
     return term
 
-@router.get("/user_units", response_model=list[UsersUnitsPublic])
 def get_user_units(
     date : datetime = datetime.now(timezone.utc),
     offset : int = 0,
@@ -246,24 +263,50 @@ def get_user_units(
         select(UsersUnits)
         .join(Unit)
         .join(Term)
-        .join(User)
-        .where(User.id == user.id)
+        .where(UsersUnits.user_id == user.id)
         .where(Term.start_at < date)
         .where(Term.end_at > date)
+        .options(
+            selectinload(UsersUnits.user).selectinload(User.university).selectinload(University.aliases),
+            selectinload(UsersUnits.unit).selectinload(Unit.term)
+        )
         .offset(offset)
         .limit(limit)
     ).all()
     
     return user_units
 
+@router.get("/user_units", response_model=list[UsersUnitsPublic])
+async def get_user_units_async(
+    date : datetime = datetime.now(timezone.utc),
+    offset : int = 0,
+    limit : int = Query(default=100, le=100),
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[UsersUnits]:
+    """
+    Route for ``get_user_units``, which runs it on the
+    connection of an AsyncSession so that it does not
+    block the event loop.
+    """
+    return await session.run_sync(
+        lambda sync_session: get_user_units(
+            date=date,
+            offset=offset,
+            limit=limit,
+            user=user,
+            session=sync_session
+        )
+    )
+
 @router.get("/units", response_model=list[UnitPublic])
-def get_units(
+async def get_units(
     date : datetime = datetime.now(timezone.utc),
     offset : int = 0,
     limit : int = Query(default=100, le=100),
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
-):
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[Unit]:
     """
     Obtain the user's current units.
 
@@ -276,29 +319,23 @@ def get_units(
             Pagination length. Defaults to 100. Max of 100.
         user (User):
             The currently logged-in user.
-        session (Session, optional):
+        session (AsyncSession, optional):
             Active connection with the SQLModel database.
 
     Returns:
         list[UnitPublic]: The user's units.
     """
-
-    user_units = get_user_units(
-        date=date,
-        offset=offset,
-        limit=limit,
-        user=user,
-        session=session
-    ) 
-
-    unit_ids = [u.unit_id for u in user_units]
-    
-    units = session.exec(
+    units = await session.exec(
         select(Unit)
-        .where(Unit.id.in_(unit_ids))
+        .join(UsersUnits)
+        .join(Term)
+        .where(UsersUnits.user_id == user.id)
+        .where(Term.start_at < date)
+        .where(Term.end_at > date)
+        .offset(offset)
+        .limit(limit)
     )
-
-    return units
+    return list(units.all())
 
 class UnitJSON(BaseModel):
     id : int
@@ -334,28 +371,31 @@ def build_units_list_json(user : User, session : Session) -> str:
     return units_list_adapter.dump_json(unit_list).decode("utf-8")
 
 @router.get("/tool/units_json", response_model=str)
-def get_units_list_json(
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+async def get_units_list_json(
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ) -> str:
     """
     Returns the student's units in JSON format.
     """
-    return build_units_list_json(user=user, session=session)
+    return await session.run_sync(
+        lambda sync_session: build_units_list_json(user=user, session=sync_session)
+    )
 
 @router.get("/units/{id}", response_model=UnitPublicWithAssignmentGroups)
-def get_unit(
+async def get_unit(
     id : int,
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ):
     """
     Obtain a unit with all its assignment groups.
+    The unit's assignment groups are loaded eagerly.
 
     Args:
         id (int): The unit ID.
         user (User): The currently logged-in user.
-        session (Session, optional): Active connection with the SQLModel database.
+        session (AsyncSession, optional): Active connection with the SQLModel database.
 
     Raises:
         HTTPException: If the unit is not found, raises a 404.
@@ -363,22 +403,26 @@ def get_unit(
     Returns:
         UnitPublicWithAssignmentGroups: The unit with assignment groups included.
     """
-    unit = session.get(Unit, id)
+    unit = await session.get(
+        Unit, id,
+        options=[selectinload(Unit.assignment_groups)]
+    )
     if not unit: raise HTTPException(status_code=404, detail="Unit not found")
     return unit
 
 @router.get("/assignment_groups", response_model=list[AssignmentGroupPublicWithUnit])
-def get_assignment_groups(
+async def get_assignment_groups(
     date : datetime = datetime.now(timezone.utc),
     unit_id : int | None = None,
     offset : int = 0,
     limit : int = Query(default=100, le=100),
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
-):
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[AssignmentGroup]:
     """
     Obtain the user's current assignment groups
-    along with their unit information.
+    along with their unit information. Each
+    group's unit (with its term) is loaded eagerly.
 
     Args:
         date (datetime, optional):
@@ -391,46 +435,45 @@ def get_assignment_groups(
             Pagination length. Defaults to 100. Max of 100.
         user (User):
             The currently logged-in user.
-        session (Session, optional):
+        session (AsyncSession, optional):
             Active connection with the SQLModel database.
 
     Returns:
         list[AssignmentGroupPublicWithUnit]: The assignment groups with unit information included.
     """
-    user_units = get_units(user=user, session=session, limit=100, offset=0)
-    user_unit_ids = [u.id for u in user_units]
-
     query = (
         select(AssignmentGroup)
         .join(Unit)
         .join(Term)
-        .where(Unit.id.in_(user_unit_ids))
+        .join(UsersUnits, UsersUnits.unit_id == Unit.id)
+        .where(UsersUnits.user_id == user.id)
         .where(Term.start_at < date)
         .where(Term.end_at > date)
+        .options(selectinload(AssignmentGroup.unit).selectinload(Unit.term))
     )
 
     if unit_id is not None:
         query = query.where(Unit.id == unit_id)
-    
+
     query = query.offset(offset).limit(limit)
 
-    groups = session.exec(query).all()
-    
-    return groups
+    groups = await session.exec(query)
+    return list(groups.all())
 
 @router.get("/assignment_groups/{id}", response_model=AssignmentGroupPublicWithAssignments)
-def get_assignment_group(
+async def get_assignment_group(
     id : int,
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ):
     """
     Obtain an assignment group with all its assignments.
+    The group's assignments are loaded eagerly.
 
     Args:
         id (int): The assignment group ID.
         user (User): The currently logged-in user.
-        session (Session, optional): Active connection with the SQLModel database.
+        session (AsyncSession, optional): Active connection with the SQLModel database.
 
     Raises:
         HTTPException: If the assignment group is not found, raises a 404.
@@ -438,12 +481,15 @@ def get_assignment_group(
     Returns:
         AssignmentGroupPublicWithAssignments: The assignment group with its assignments included.
     """
-    group = session.get(AssignmentGroup, id)
+    group = await session.get(
+        AssignmentGroup, id,
+        options=[selectinload(AssignmentGroup.assignments)]
+    )
     if not group: raise HTTPException(status_code=404, detail="Assignment group not found")
     return group
 
 @router.get("/assignments", response_model=list[AssignmentPublic])
-def get_assignments(
+async def get_assignments(
     date : datetime = datetime.now(timezone.utc),
     exclude_complete : bool = True,
     exclude_no_due_date : bool = True,
@@ -451,14 +497,15 @@ def get_assignments(
     unit_id : int | None = None,
     offset : int = 0,
     limit : int = Query(default=100, le=100),
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
-):
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> list[Assignment]:
     """
     Obtains a list of assignments for the user.
     By default, this obtains only incomplete
     assignments for the user's current units
-    which have a due date assigned.
+    which have a due date assigned. Each
+    assignment's group and unit are loaded eagerly.
 
     Args:
         date (datetime, optional):
@@ -478,23 +525,22 @@ def get_assignments(
             Pagination length. Defaults to 100. Max of 100.
         user (User):
             The currently logged-in user.
-        session (Session, optional):
+        session (AsyncSession, optional):
             Active connection with the SQLModel database.
 
     Returns:
         list[AssignmentPublic]: The user's assignments.
     """
-
     query = (
         select(UsersAssignments)
-        .join(User)
         .join(Assignment)
         .join(AssignmentGroup)
         .join(Unit)
         .join(Term)
-        .where(User.id == user.id)
+        .where(UsersAssignments.user_id == user.id)
         .where(Term.start_at < date)
         .where(Term.end_at > date)
+        .options(assignment_loader(UsersAssignments.assignment))
     )
 
     if exclude_ungraded:
@@ -511,19 +557,17 @@ def get_assignments(
 
     query = query.offset(offset).limit(limit).order_by(Assignment.due_at)
 
-    users_assignments = session.exec(query).all()
+    users_assignments = await session.exec(query)
 
-    assignments = [ua.assignment for ua in users_assignments]
-
-    return assignments
+    return [ua.assignment for ua in users_assignments.all()]
 
 @router.get("/assignments/{id}", response_model=AssignmentPublic)
-def get_assignment(
+async def get_assignment(
     id : int,
-    user : User = Depends(get_current_user),
-    session : Session = Depends(get_session)
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
 ):
-    assignment = session.get(Assignment, id)
+    assignment = await session.get(Assignment, id, options=[group_loader(Assignment.group)])
     if not assignment: raise HTTPException(status_code=404, detail="Assignment not found")
     return assignment 
 
@@ -602,55 +646,132 @@ class UnitAssignmentsJSON(BaseModel):
 
 assignments_list_adapter = TypeAdapter(list[UnitAssignmentsJSON])
 
+# Key of the assignments payloads memoised in ``session.info`` (see build_assignments_payload)
+ASSIGNMENTS_PAYLOAD_CACHE_KEY = "assignments_payloads"
+
+def get_assignments_payload_query(user_id : int, date : datetime):
+    """
+    Obtain the query for every incomplete assignment (with a due date)
+    in the user's units which are active during the given date, with
+    each assignment's group and unit loaded by the same query.
+
+    This replaces one ``get_assignments`` query for each unit
+    (each followed by lazy loads of every assignment's group and unit).
+    """
+    return (
+        select(Assignment)
+        .join(UsersAssignments, UsersAssignments.assignment_id == Assignment.id)
+        .join(AssignmentGroup, Assignment.group_id == AssignmentGroup.id)
+        .join(Unit, AssignmentGroup.unit_id == Unit.id)
+        .join(Term, Unit.term_id == Term.id)
+        .join(UsersUnits, and_(UsersUnits.unit_id == Unit.id, UsersUnits.user_id == user_id))
+        .where(UsersAssignments.user_id == user_id)
+        .where(UsersAssignments.submitted == False)
+        .where(Assignment.due_at != None)
+        .where(Term.start_at < date)
+        .where(Term.end_at > date)
+        .options(contains_eager(Assignment.group).contains_eager(AssignmentGroup.unit))
+        .order_by(Unit.id, Assignment.due_at, Assignment.id)
+    )
+
+def group_assignments_payload(
+    assignments : list[Assignment],
+    university_name : str | None
+) -> list[UnitAssignmentsJSON]:
+    """
+    Group the assignments obtained by ``get_assignments_payload_query`` by unit.
+    """
+    units_assignments_json : dict[int, UnitAssignmentsJSON] = {}
+
+    for assignment in assignments:
+        unit = assignment.group.unit
+
+        unit_json = units_assignments_json.get(unit.id)
+        if unit_json is None:
+            # Same number of units as get_units returns
+            if len(units_assignments_json) >= 100: continue
+            unit_json = UnitAssignmentsJSON(
+                unit_id=unit.id,
+                unit_name=unit.readable_name,
+                assignments=[]
+            )
+            units_assignments_json[unit.id] = unit_json
+
+        # Same number of assignments per unit as get_assignments returns
+        if len(unit_json.assignments) >= 100: continue
+
+        url = f"https://www.{university_name}.instructure.com/"
+        url += f"courses/{unit.canvas_id}/assignments/{assignment.canvas_id}"
+
+        unit_json.assignments.append(
+            AssignmentJSON(
+                id=assignment.id,
+                name=assignment.name or "",
+                description=assignment.prompt_description,
+                due_date=parse_timestamp(assignment.due_at),
+                days_remaining=get_days_remaining(assignment.due_at),
+                grade_contribution=int(assignment.grade_contribution * 100),
+                is_group=assignment.is_group,
+                url=url
+            )
+        )
+
+    return list(units_assignments_json.values())
+
+def get_memoised_assignments_payload(
+    user : User,
+    session : Session | AsyncSession
+) -> list[UnitAssignmentsJSON] | None:
+    return session.info.get(ASSIGNMENTS_PAYLOAD_CACHE_KEY, {}).get(user.id)
+
+def memoise_assignments_payload(
+    user : User,
+    session : Session | AsyncSession,
+    payload : list[UnitAssignmentsJSON]
+):
+    session.info.setdefault(ASSIGNMENTS_PAYLOAD_CACHE_KEY, {})[user.id] = payload
+
+def forget_assignments_payloads(session : Session | AsyncSession):
+    """
+    Discard the assignments payloads memoised in a session,
+    e.g., after syncing new assignments from Canvas.
+    """
+    session.info.pop(ASSIGNMENTS_PAYLOAD_CACHE_KEY, None)
+
+def filter_assignments_payload(
+    payload : list[UnitAssignmentsJSON],
+    unit_id : int | None
+) -> list[UnitAssignmentsJSON]:
+    return [u for u in payload if unit_id is None or u.unit_id == unit_id]
+
 def build_assignments_payload(
     user: User,
     session: Session,
     unit_id: int | None = None,
 ) -> list[UnitAssignmentsJSON]:
-    """Incomplete assignments by unit for the given student (same filters as assignments_json)."""
-    units = get_units(user=user, session=session, offset=0, limit=100)
-    units = [UnitPublic.model_validate(u) for u in units]
-    units_assignments_json: list[UnitAssignmentsJSON] = []
-
-    user_public = UserPublic.model_validate(user)
-    university_name = user_public.actual_university_name
+    """
+    Incomplete assignments by unit for the given student (same filters as assignments_json).
 
-    for unit in units:
-        if unit_id is not None and unit.id != unit_id:
-            continue
+    Every assignment is obtained by a single query (see
+    ``get_assignments_payload_query``), so the number of queries does
+    not grow with the number of units. The payload is memoised in the
+    session, so the system prompt, the task generation prompt and the
+    assignments snapshot of one request reuse the same payload.
 
-        assignments = get_assignments(user=user, session=session, unit_id=unit.id, offset=0, limit=100)
-        assignments = [AssignmentPublic.model_validate(a) for a in assignments]
-
-        assignment_list: list[AssignmentJSON] = []
-        for assignment in assignments:
-            url = f"https://www.{university_name}.instructure.com/"
-            url += f"courses/{unit.canvas_id}/assignments/{assignment.canvas_id}"
-            days_remaining = get_days_remaining(assignment.due_at)
-
-            assignment_list.append(
-                AssignmentJSON(
-                    id=assignment.id,
-                    name=assignment.name or "",
-                    description=assignment.readable_description,
-                    due_date=parse_timestamp(assignment.due_at),
-                    days_remaining=days_remaining,
-                    grade_contribution=int(assignment.grade_contribution * 100),
-                    is_group=assignment.is_group,
-                    url=url
-                )
-            )
+    Usage (e.g., in a test):
+        with assert_query_budget(1):
+            build_assignments_payload(user=user, session=session)
+    """
+    payload = get_memoised_assignments_payload(user, session)
 
-        if assignment_list:
-            units_assignments_json.append(
-                UnitAssignmentsJSON(
-                    unit_id=unit.id,
-                    unit_name=unit.readable_name,
-                    assignments=assignment_list
-                )
-            )
+    if payload is None:
+        assignments = session.exec(
+            get_assignments_payload_query(user.id, datetime.now(timezone.utc))
+        ).all()
+        payload = group_assignments_payload(assignments, user.actual_university_name)
+        memoise_assignments_payload(user, session, payload)
 
-    return units_assignments_json
+    return filter_assignments_payload(payload, unit_id)
 
 
 def build_assignments_list_json(
@@ -840,10 +961,10 @@ def compute_assignments_delta(
 
 
 @router.get("/tool/assignments_json", response_model=str)#list[UnitAssignmentsJSON])
-def get_assignments_list_json(
+async def get_assignments_list_json(
     unit_id : int | None = None,
-    user: User = Depends(get_current_user),
-    session: Session = Depends(get_session)
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session)
 ):
     """
     Return the student's incomplete assignments in JSON format,
@@ -852,4 +973,6 @@ def get_assignments_list_json(
     Args:
         unit_id (int | None, optional): Which unit to obtain assignment information for. If not given, returns assignments for all units. Defaults to None.
     """
-    return build_assignments_list_json(user=user, session=session, unit_id=unit_id)
+    return await session.run_sync(
+        lambda sync_session: build_assignments_list_json(user=user, session=sync_session, unit_id=unit_id)
+    )
@@ -1,6 +1,8 @@
 import json
+import inspect
 
 from pydantic import BaseModel, TypeAdapter
+from starlette.concurrency import run_in_threadpool
 
 from ..models import TaskAutofillCreate, User, Unit, UnitPublic, TaskList
 from ..date_utils import parse_timestamp, timestamp_to_string
@@ -9,12 +11,11 @@ from ..routers.curriculum import (
     build_assignments_payload,
     build_units_list_json,
     compute_assignments_delta,
-    get_assignments_list_json,
-    get_units_list_json,
 )
 from ..routers.reminders import get_reminders_list_json
 from ..routers.users import get_user_biography_text
 from ..dependencies import get_current_user, get_session
+from ..prompt_cache import prompt_cache, PromptSection
 from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import Session, select
 from datetime import datetime
@@ -22,6 +23,52 @@ from zoneinfo import ZoneInfo
 
 router = APIRouter()
 
+async def get_prompt_section(
+    user : User,
+    unit_id : int | None,
+    section : PromptSection,
+    build
+) -> str:
+    """
+    Obtain a section of the user's system prompt from the prompt
+    cache (see prompt_cache.py), or build and cache it if it is not
+    cached.
+
+    Args:
+        user (User): The student the prompt is for.
+        unit_id (int | None): The unit the section is built for, if it depends on the unit.
+        section (PromptSection): The name of the section.
+        build (Callable[[], str | Awaitable[str]]): Builds the section. Sync builders
+            query the database, so they are run in the threadpool.
+
+    Returns:
+        str: The section text.
+    """
+    text = prompt_cache.get(user.id, unit_id, section)
+    if text is not None: return text
+
+    version = prompt_cache.version(user.id)
+    text = await run_in_threadpool(build)
+    if inspect.isawaitable(text): text = await text
+    prompt_cache.set(user.id, unit_id, section, text, version)
+    return text
+
+@router.get("/prompt/cache", response_model=dict)
+async def get_prompt_cache_stats(
+    user : User = Depends(get_current_user)
+):
+    """
+    Obtain the hit-ratio counters of the system prompt section cache (ADMIN ONLY).
+
+    Raises:
+        HTTPException: Raises a 401 if the current user is not an admin.
+
+    Returns:
+        dict: The number of cached sections, hits, misses, invalidated sections and evicted sections.
+    """
+    if not user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
+    return prompt_cache.stats()
+
 @router.get("/prompt/biography")
 def get_user_biography(
     user : User = Depends(get_current_user),
@@ -44,16 +91,22 @@ async def get_previous_conversation_summaries(
     session : Session = Depends(get_session),
     offset : int = 1,
     limit : int = 3,
-    creation_limit : int = 1,
+    creation_limit : int = 0,
     max_words : int = 200
 ) -> str:
     """
     Obtain a JSON list of the summaries of
     the student's prior conversations.
 
+    By default, only stored summaries are included: conversations
+    are summarised in the background by the summary worker (see
+    summary_worker.py), so building the prompt never waits for
+    the LLM to write a summary.
+
     Args:
         user (User): The currently logged-in user.
         session (Session): Connection to the database.
+        creation_limit (int, optional): Maximum number of missing summaries to create while building the list. Defaults to 0.
 
     Returns:
         str: The summary list.
@@ -353,7 +406,7 @@ Apply only **TASK LIST UPDATE RULES** above (especially overdue tasks). Return t
     return TaskGenerationPrepare(prompt=prompt.strip())
 
 @router.get("/prompt/tasks/self")
-async def get_task_creation_prompt_for_self(
+def get_task_creation_prompt_for_self(
     tasks_per_day : int = 10,
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session)
@@ -447,7 +500,7 @@ You must return the following fields for the user's task:
 Use the student's list of assignments to decide which assignment this task should be created for,
 what steps are necessary to complete it, and how long it should take to complete in minutes.
 ```json
-{get_assignments_list_json(user=existing_user, session=session)}
+{build_assignments_list_json(user=existing_user, session=session)}
 ```
     """.strip()
 
@@ -470,13 +523,41 @@ async def get_system_prompt(
         if now.hour > 9 and now.hour < 17:
             is_business_hours = True
 
+    def get_unit_name() -> str:
+        unit = session.get(Unit, unit_id)
+        if not unit:
+            raise HTTPException(status_code=500, detail=f"Error obtaining unit name for unit {unit_id}")
+        return UnitPublic.model_validate(unit).readable_name
+
+    # Each section which is read from the database is cached until
+    # its data changes or the day ends (see prompt_cache.py), so a
+    # chat turn does not query the database for the prompt.
     unit_name : str | None = None
-    unit = session.get(Unit, unit_id)
-    if unit:
-        unit = UnitPublic.model_validate(unit)
-        unit_name = unit.readable_name
+    if unit_id:
+        unit_name = await get_prompt_section(user, unit_id, "unit_name", get_unit_name)
     if unit_id and not unit_name:
         raise HTTPException(status_code=500, detail=f"Error obtaining unit name for unit {unit_id}")
+
+    biography = await get_prompt_section(
+        user, None, "biography",
+        lambda: get_user_biography(user=user, session=session)
+    )
+    units_json = await get_prompt_section(
+        user, None, "units",
+        lambda: build_units_list_json(user=user, session=session)
+    )
+    assignments_json = await get_prompt_section(
+        user, unit_id, "assignments",
+        lambda: build_assignments_list_json(user=user, session=session, unit_id=unit_id)
+    )
+    task_list = await get_prompt_section(
+        user, unit_id, "tasks",
+        lambda: get_task_list(user=user, session=session, unit_id=unit_id)
+    )
+    conversation_summaries = await get_prompt_section(
+        user, None, "history",
+        lambda: get_previous_conversation_summaries(user=user, session=session)
+    )
     
     return f"""
 You are Exemi, a study assistance chatbot.
@@ -523,31 +604,24 @@ Remember these principles for helping students with ADHD:
 3. Mention assignments which have less time left and greater grade contributions FIRST.
 4. Ask the student which assignment they would like to prioritise first.
 
-{get_user_biography(user=user, session=session)}
+{biography}
 
 ## UNITS
 You have access to the student's curriculum and assessment information from their Canvas account, including their units and assignments.
 The student is enrolled in the following units:
 ```json
-{get_units_list_json(user=user, session=session)}
+{units_json}
 ```
 {f"\nFor this conversation, the student is ONLY needing assistance with the unit: {unit_name}.\n" if unit_name else ""}
 ## ASSIGNMENTS
 The student has the following assignments:
 ```json
-{get_assignments_list_json(user=user, session=session, unit_id=unit_id)}
+{assignments_json}
 ```
 
-{get_task_list(
-    user=user,
-    session=session,
-    unit_id=unit_id
-)}
+{task_list}
 
-{await get_previous_conversation_summaries(
-    user=user,
-    session=session
-)}
+{conversation_summaries}
 
 NOTE: Do NOT mention unit, assignment, or task IDs in your response to the student. The IDs are only needed for tool calling.
 
@@ -1,20 +1,64 @@
 from ..models import TaskAutofillCreate, User, UsersAssignments
 from ..models import Task, TaskCreate, TaskUpdate, TaskPublic, TaskList, TaskLLM
-from ..models import Assignment, AssignmentGroup, Unit
+from ..models import Assignment, AssignmentGroup, AssignmentPublic, Unit, UsersUnits
 from typing import Literal
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlalchemy import and_, or_, asc
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, contains_eager
 from fastapi import APIRouter, Depends, HTTPException, Query
-from ..dependencies import get_session, get_current_user, get_current_magic
+from ..dependencies import get_session, get_async_session, get_current_user, get_current_user_async, get_current_magic
 from ..date_utils import parse_timestamp
+from ..prompt_cache import prompt_cache
 from datetime import date, datetime, time, timedelta, timezone
 from zoneinfo import ZoneInfo
 from pydantic import BaseModel, TypeAdapter
+from starlette.concurrency import run_in_threadpool
 import warnings
 
 router = APIRouter()
 
+def with_task_details(query):
+    """
+    Extend a query of tasks (which must already join ``User`` with an
+    explicit ON clause) to also
+    obtain each task's assignment, the colour the user gave the task's
+    unit, and the user's break interval, in the same statement.
+
+    Building TaskPublic objects from the tasks themselves costs several
+    queries per task, because ``Task.colour_raw`` and
+    ``Task.break_interval_mins`` each query the database. Build them
+    from the rows of this query with ``build_task_public`` instead.
+
+    The query must be run with ``session.execute`` (not ``session.exec``),
+    which returns rows of (Task, colour, break interval).
+    """
+    return (
+        query
+        .outerjoin(Assignment, Task.assignment_id == Assignment.id)
+        .outerjoin(AssignmentGroup, Assignment.group_id == AssignmentGroup.id)
+        .outerjoin(Unit, AssignmentGroup.unit_id == Unit.id)
+        .outerjoin(UsersUnits, and_(UsersUnits.unit_id == Unit.id, UsersUnits.user_id == Task.user_id))
+        .add_columns(UsersUnits.colour, User.task_break_interval_mins)
+        .options(
+            contains_eager(Task.assignment)
+            .contains_eager(Assignment.group)
+            .contains_eager(AssignmentGroup.unit)
+        )
+    )
+
+def build_task_public(task : Task, colour : str | None, break_interval_mins : int | None) -> TaskPublic:
+    """
+    Build a TaskPublic object from a row of a query extended by ``with_task_details``.
+    """
+    return TaskPublic.model_validate({
+        **task.model_dump(),
+        "assignment" : AssignmentPublic.model_validate(task.assignment) if task.assignment else None,
+        # Same default as Task.break_interval_mins
+        "break_interval_mins" : break_interval_mins or 10,
+        "colour_raw" : colour
+    })
+
 def _utc_naive_bounds_for_local_calendar_day(
     d: date, timezone_name: str
 ) -> tuple[datetime, datetime]:
@@ -31,6 +75,13 @@ def _utc_naive_bounds_for_local_calendar_day(
         end_local.astimezone(timezone.utc).replace(tzinfo=None),
     )
 
+def _require_task_access(task : Task | None, user : User) -> None:
+    if not task: raise HTTPException(status_code=404, detail="Task not found")
+
+    if task.user_id != user.id and not user.admin:
+        # Don't return tasks from other users unless the user is an admin
+        raise HTTPException(status_code=404, detail="Task not found")
+
 def _require_valid_timezone(timezone_name: str) -> None:
     try:
         ZoneInfo(timezone_name)
@@ -105,7 +156,6 @@ def save_tasks_generation_assignments_snapshot(username: str, session: Session)
     session.commit()
 
 
-@router.get("/task/{id}", response_model=TaskPublic)
 def get_task(
     id: int,
     user: User = Depends(get_current_user),
@@ -127,23 +177,49 @@ def get_task(
         Task: _description_
     """
     task = session.get(Task, id)
-    if not task: raise HTTPException(status_code=404, detail="Task not found")
+    _require_task_access(task, user)
+    return task
 
-    if task.user_id != user.id and not user.admin:
-        # Don't return tasks from other users unless the user is an admin
-        raise HTTPException(status_code=404, detail="Task not found")
+@router.get("/task/{id}", response_model=TaskPublic)
+async def get_task_public(
+    id: int,
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session),
+) -> TaskPublic:
+    """
+    Obtains a given task by ID, with its assignment,
+    colour and break interval (see ``with_task_details``).
 
-    return task
+    Args:
+        id (int): ID of the task to obtain.
+        user (User, optional): The currently logged in user.
+        session (AsyncSession, optional): Connection to SQL database.
+
+    Raises:
+        HTTPException: Raises a 404 if the task was not found.
+        HTTPException: Raises a 404 if a non-adminstrator user attempts to read another user's task.
+
+    Returns:
+        TaskPublic: The task.
+    """
+    row = (await session.execute(
+        with_task_details(select(Task).join(User, Task.user_id == User.id).where(Task.id == id))
+    )).first()
+
+    task, colour, break_interval_mins = row or (None, None, None)
+    _require_task_access(task, user)
+
+    return build_task_public(task, colour, break_interval_mins)
 
 @router.get("/tasks_all/self", response_model=list[TaskPublic])
-def get_all_tasks_for_self(
+async def get_all_tasks_for_self(
     incomplete_only : bool = False,
     unit_id : int | None = None,
     offset: int = 0,
     limit: int = Query(default=100, le=100),
-    user: User = Depends(get_current_user),
-    session: Session = Depends(get_session)
-) -> list[Task]:
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session)
+) -> list[TaskPublic]:
     """
     Obtain all incomplete and complete tasks for the current user.
 
@@ -153,12 +229,12 @@ def get_all_tasks_for_self(
         offset (int, optional): Pagination start index. Defaults to 0.
         limit (int, optional): Maximum number of tasks to obtain. Defaults to 100. Max of 100.
         user (User, optional): The currently logged in user.
-        session (Session, optional): Connection to SQL database.
+        session (AsyncSession, optional): Connection to SQL database.
 
     Returns:
-        list[Task]: The list of tasks.
+        list[TaskPublic]: The list of tasks.
     """
-    return get_all_tasks_for_user(
+    return await get_all_tasks_public_for_user(
         username=user.username,
         incomplete_only=incomplete_only,
         unit_id=unit_id,
@@ -168,7 +244,37 @@ def get_all_tasks_for_self(
         session=session,
     )
 
-@router.get("/tasks_all/{username}", response_model=list[TaskPublic])
+def get_unit_assignment_ids(unit_id : int):
+    """
+    Subquery of the IDs of a unit's assignments, used to filter tasks by unit.
+    """
+    return select(Assignment.id).join(AssignmentGroup).where(AssignmentGroup.unit_id == unit_id)
+
+def get_all_tasks_query(
+    username : str,
+    incomplete_only : bool,
+    unit_id : int | None,
+    offset : int,
+    limit : int
+):
+    """
+    Build the query used by ``get_all_tasks_for_user`` and ``get_all_tasks_public_for_user``.
+    """
+    query = select(Task)
+    query = query.join(User, Task.user_id == User.id)
+    query = query.where(User.username==username)
+
+    if incomplete_only:
+        query = query.where(Task.completed == False)
+
+    if unit_id:
+        query = query.where(Task.assignment_id.in_(get_unit_assignment_ids(unit_id)))
+
+    query = query.order_by(Task.due_at, asc(Task.created_at))
+    query = query.offset(offset)
+    query = query.limit(limit)
+    return query
+
 def get_all_tasks_for_user(
     username : str,
     incomplete_only : bool = False,
@@ -196,26 +302,61 @@ def get_all_tasks_for_user(
     if user.username != username and not user.admin:
         raise HTTPException(status_code=401, detail="Unauthorised")
     
-    query = select(Task)
-    query = query.join(User)
-    query = query.where(User.username==username)
+    query = get_all_tasks_query(
+        username=username,
+        incomplete_only=incomplete_only,
+        unit_id=unit_id,
+        offset=offset,
+        limit=limit
+    )
 
-    if incomplete_only:
-        query = query.where(Task.completed == False)
+    tasks = session.exec(query)
 
-    if unit_id:
-        query = query.join(Assignment)
-        query = query.join(AssignmentGroup)
-        query = query.join(Unit)
-        query = query.where(Unit.id == unit_id)
+    return tasks
 
-    query = query.order_by(Task.due_at, asc(Task.created_at))
-    query = query.offset(offset)
-    query = query.limit(limit)
+@router.get("/tasks_all/{username}", response_model=list[TaskPublic])
+async def get_all_tasks_public_for_user(
+    username : str,
+    incomplete_only : bool = False,
+    unit_id : int | None = None,
+    offset: int = 0,
+    limit: int = Query(default=100, le=100),
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session)
+) -> list[TaskPublic]:
+    """
+    Obtain all incomplete and complete tasks for an arbitrary user,
+    with each task's assignment, colour and break interval
+    (see ``with_task_details``).
 
-    tasks = session.exec(query)
+    Args:
+        username (str): Which user to obtain task list for.
+        incomplete_only (bool, optional): Whether to only return incomplete tasks.
+        unit_id (int | None, optional): If given, only select tasks for this unit. Defaults to None.
+        offset (int, optional): Pagination start index. Defaults to 0.
+        limit (int, optional): Maximum number of tasks to obtain. Defaults to 100. Max of 100.
+        user (User, optional): The currently logged in user.
+        session (AsyncSession, optional): Connection to SQL database.
 
-    return tasks
+    Returns:
+        list[TaskPublic]: The list of tasks.
+    """
+    if user.username != username and not user.admin:
+        raise HTTPException(status_code=401, detail="Unauthorised")
+
+    query = with_task_details(
+        get_all_tasks_query(
+            username=username,
+            incomplete_only=incomplete_only,
+            unit_id=unit_id,
+            offset=offset,
+            limit=limit
+        )
+    )
+
+    rows = await session.execute(query)
+
+    return [build_task_public(*row) for row in rows.all()]
 
 class TaskJSON(BaseModel):
     id : int
@@ -228,7 +369,6 @@ class TaskJSON(BaseModel):
 
 tasks_list_adapter = TypeAdapter(list[TaskJSON])
 
-@router.get("/tool/tasks_json/self", response_model=str)
 def get_tasks_list_for_self_json(
     incomplete_only : bool = False,
     unit_id : int | None = None,
@@ -257,7 +397,27 @@ def get_tasks_list_for_self_json(
         session=session
     )
 
-@router.get("/tool/tasks_json/{username}", response_model=str)
+@router.get("/tool/tasks_json/self", response_model=str)
+async def get_tasks_list_for_self_json_async(
+    incomplete_only : bool = False,
+    unit_id : int | None = None,
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> str:
+    """
+    Route for ``get_tasks_list_for_self_json``, which runs it on
+    the connection of an AsyncSession so that it does not block
+    the event loop.
+    """
+    return await session.run_sync(
+        lambda sync_session: get_tasks_list_for_self_json(
+            incomplete_only=incomplete_only,
+            unit_id=unit_id,
+            user=user,
+            session=sync_session
+        )
+    )
+
 def get_tasks_list_for_user_json(
     username : str,
     incomplete_only : bool = False,
@@ -304,16 +464,39 @@ def get_tasks_list_for_user_json(
 
     return tasks_list_adapter.dump_json(tasks_json).decode("utf-8")
 
+@router.get("/tool/tasks_json/{username}", response_model=str)
+async def get_tasks_list_for_user_json_async(
+    username : str,
+    incomplete_only : bool = False,
+    unit_id : int | None = None,
+    user : User = Depends(get_current_user_async),
+    session : AsyncSession = Depends(get_async_session)
+) -> str:
+    """
+    Route for ``get_tasks_list_for_user_json``, which runs it on
+    the connection of an AsyncSession so that it does not block
+    the event loop.
+    """
+    return await session.run_sync(
+        lambda sync_session: get_tasks_list_for_user_json(
+            username=username,
+            incomplete_only=incomplete_only,
+            unit_id=unit_id,
+            user=user,
+            session=sync_session
+        )
+    )
+
 @router.get("/tasks/self", response_model=list[TaskPublic])
-def get_tasks_for_self(
+async def get_tasks_for_self(
     date: datetime = datetime.now(timezone.utc),
     current_date: datetime = datetime.now(timezone.utc),
     timezone_name: str = "Australia/Sydney",
     unit_id : int | None = None,
     offset: int = 0,
     limit: int = Query(default=100, le=100),
-    user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session),
 ) -> list[TaskPublic]:
     """
     Obtain a list of tasks for the current user.
@@ -348,12 +531,12 @@ def get_tasks_for_self(
         offset (int, optional): Pagination start index. Defaults to 0.
         limit (int, optional): Maximum number of tasks to obtain. Defaults to 100. Max of 100.
         user (User, optional): The currently logged in user.
-        session (Session, optional): Connection to SQL database.
+        session (AsyncSession, optional): Connection to SQL database.
 
     Returns:
-        list[Task]: The list of tasks.
+        list[TaskPublic]: The list of tasks.
     """
-    return get_tasks_for_user(
+    return await get_tasks_for_user(
         username=user.username,
         date=date,
         current_date=current_date,
@@ -365,8 +548,74 @@ def get_tasks_for_self(
         session=session,
     )
 
+def get_tasks_query(
+    username : str,
+    date : datetime,
+    current_date : datetime,
+    timezone_name : str,
+    unit_id : int | None,
+    offset : int,
+    limit : int
+):
+    """
+    Build the query used by ``get_tasks_for_user``.
+
+    Raises:
+        HTTPException: Raises a 400 if the timezone or either date is invalid.
+    """
+    _require_valid_timezone(timezone_name)
+
+    current_local = parse_timestamp(current_date, australia_tz=timezone_name)
+    target_local = parse_timestamp(date, australia_tz=timezone_name)
+    if current_local is None or target_local is None:
+        raise HTTPException(status_code=400, detail="Invalid date")
+
+    today_date = current_local.date()
+    target_date = target_local.date()
+
+    is_present = target_date == today_date
+    is_future = target_date > today_date
+    is_past = target_date < today_date
+
+    query = (
+        select(Task)
+        .join(User, Task.user_id == User.id)
+        .where(User.username == username)
+    )
+
+    if unit_id:
+        query = query.where(Task.assignment_id.in_(get_unit_assignment_ids(unit_id)))
+
+    if is_present:
+        today_start, today_end = _utc_naive_bounds_for_local_calendar_day(
+            today_date, timezone_name
+        )
+        query = query.where(
+            or_(
+                and_(Task.completed == False, Task.due_at < today_end),
+                and_(
+                    Task.completed == True,
+                    Task.due_at >= today_start,
+                    Task.due_at < today_end,
+                ),
+            )
+        )
+    elif is_future:
+        ts, te = _utc_naive_bounds_for_local_calendar_day(target_date, timezone_name)
+        query = query.where(
+            and_(Task.completed == False, Task.due_at >= ts, Task.due_at < te)
+        )
+    elif is_past:
+        ts, te = _utc_naive_bounds_for_local_calendar_day(target_date, timezone_name)
+        query = query.where(
+            and_(Task.completed == True, Task.due_at >= ts, Task.due_at < te)
+        )
+
+    query = query.order_by(Task.due_at, asc(Task.created_at)).offset(offset).limit(limit)
+    return query
+
 @router.get("/tasks/{username}", response_model=list[TaskPublic])
-def get_tasks_for_user(
+async def get_tasks_for_user(
     username: str,
     date: datetime = datetime.now(timezone.utc),
     current_date: datetime = datetime.now(timezone.utc),
@@ -374,9 +623,9 @@ def get_tasks_for_user(
     unit_id : int | None = None,
     offset: int = 0,
     limit: int = Query(default=100, le=100),
-    user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
-) -> list[Task]:
+    user: User = Depends(get_current_user_async),
+    session: AsyncSession = Depends(get_async_session),
+) -> list[TaskPublic]:
     """
     Obtain a list of tasks for an arbitrary user.
     Automatically pushes overdue tasks into the
@@ -411,74 +660,32 @@ def get_tasks_for_user(
         offset (int, optional): Pagination start index. Defaults to 0.
         limit (int, optional): Maximum number of tasks to obtain. Defaults to 100. Max of 100.
         user (User, optional): The currently logged in user.
-        session (Session, optional): Connection to SQL database.
+        session (AsyncSession, optional): Connection to SQL database.
 
     Raises:
         HTTPException: Raises a 401 if a non-administrator user tries to read another user's task list.
 
     Returns:
-        list[Task]: The list of tasks.
+        list[TaskPublic]: The list of tasks.
     """
     if user.username != username and not user.admin:
         raise HTTPException(status_code=401, detail="Unauthorised")
 
-    _require_valid_timezone(timezone_name)
-
-    current_local = parse_timestamp(current_date, australia_tz=timezone_name)
-    target_local = parse_timestamp(date, australia_tz=timezone_name)
-    if current_local is None or target_local is None:
-        raise HTTPException(status_code=400, detail="Invalid date")
-
-    today_date = current_local.date()
-    target_date = target_local.date()
-
-    is_present = target_date == today_date
-    is_future = target_date > today_date
-    is_past = target_date < today_date
-
-    query = (
-        select(Task)
-        .join(User)
-        .where(User.username == username)
-        .options(selectinload(Task.user), selectinload(Task.assignment))
-    )
-
-    if unit_id:
-        query = query.join(Assignment)
-        query = query.join(AssignmentGroup)
-        query = query.join(Unit)
-        query = query.where(Unit.id == unit_id)
-
-    if is_present:
-        today_start, today_end = _utc_naive_bounds_for_local_calendar_day(
-            today_date, timezone_name
-        )
-        query = query.where(
-            or_(
-                and_(Task.completed == False, Task.due_at < today_end),
-                and_(
-                    Task.completed == True,
-                    Task.due_at >= today_start,
-                    Task.due_at < today_end,
-                ),
-            )
-        )
-    elif is_future:
-        ts, te = _utc_naive_bounds_for_local_calendar_day(target_date, timezone_name)
-        query = query.where(
-            and_(Task.completed == False, Task.due_at >= ts, Task.due_at < te)
-        )
-    elif is_past:
-        ts, te = _utc_naive_bounds_for_local_calendar_day(target_date, timezone_name)
-        query = query.where(
-            and_(Task.completed == True, Task.due_at >= ts, Task.due_at < te)
+    query = with_task_details(
+        get_tasks_query(
+            username=username,
+            date=date,
+            current_date=current_date,
+            timezone_name=timezone_name,
+            unit_id=unit_id,
+            offset=offset,
+            limit=limit
         )
+    )
 
-    query = query.order_by(Task.due_at, asc(Task.created_at)).offset(offset).limit(limit)
-
-    tasks = session.exec(query).all()
+    rows = await session.execute(query)
 
-    return tasks
+    return [build_task_public(*row) for row in rows.all()]
 
 
 @router.post("/task/{username}", response_model=TaskPublic)
@@ -565,6 +772,7 @@ def create_task_for_user(
     session.add(task)
     session.commit()
     session.refresh(task)
+    prompt_cache.invalidate(task.user_id, "tasks")
     return task
 
 @router.post("/task", response_model=TaskPublic)
@@ -741,6 +949,7 @@ def update_task(
     session.add(task)
     session.commit()
     session.refresh(task)
+    prompt_cache.invalidate(task.user_id, "tasks")
 
     return task
 
@@ -767,9 +976,11 @@ def delete_task(
     """
 
     task = get_task(id=id, user=user, session=session)
+    task_user_id = task.user_id
 
     session.delete(task)
     session.commit()
+    prompt_cache.invalidate(task_user_id, "tasks")
     return True
 
 @router.delete("/tasks/self", response_model=Literal[True])
@@ -820,6 +1031,8 @@ def delete_tasks_for_user(
         session=session
     )
     
+    task_user_ids = {task.user_id for task in existing_tasks}
+
     for task in existing_tasks:
         session.delete(task)
     
@@ -828,6 +1041,9 @@ def delete_tasks_for_user(
     session.add(user)
 
     session.commit()
+
+    for task_user_id in task_user_ids:
+        prompt_cache.invalidate(task_user_id, "tasks")
     return True
 
 class TaskGenerationResult(BaseModel):
@@ -926,6 +1142,7 @@ def cleanup_tasks_for_user(
                 existing_tasks_by_id.pop(task_id)
 
     session.commit()
+    prompt_cache.invalidate(existing_user.id, "tasks")
 
     return existing_tasks_by_id.values()
 
@@ -1035,6 +1252,7 @@ def commit_generated_tasks(
             session.delete(task)
 
     session.commit()
+    prompt_cache.invalidate(existing_user.id, "tasks")
 
     for task in modified_tasks:
         session.refresh(task)
@@ -1103,7 +1321,9 @@ async def generate_tasks_for_user(
         raise HTTPException(status_code=401, detail="Unauthorised")
 
     # First, delete all tasks which no longer reference an assignment the user has.
-    cleanup_tasks_for_user(
+    # The database work runs in the threadpool, since this route waits for the LLM.
+    await run_in_threadpool(
+        cleanup_tasks_for_user,
         username=username,
         user=user,
         session=session
@@ -1118,8 +1338,29 @@ async def generate_tasks_for_user(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting LLM to generate tasks list for user: {str(e)}")
 
-    new_tasks = gen_result.tasks
+    return await run_in_threadpool(
+        save_generated_tasks,
+        new_tasks=gen_result.tasks,
+        commit=commit and not gen_result.llm_bypassed,
+        username=username,
+        user=user,
+        session=session
+    )
+
+def save_generated_tasks(
+    new_tasks : TaskList,
+    commit : bool,
+    username : str,
+    user : User,
+    session : Session
+) -> TaskGenerationResult:
+    """
+    Update a student's tasks list to match the LLM-generated tasks
+    (see ``generate_tasks_for_user``), if ``commit`` is True.
 
+    Returns:
+        TaskGenerationResult: The list of LLM generated task as well as the current list of user tasks in the database.
+    """
     existing_tasks : list[Task] = get_all_tasks_for_user(
         username=username,
         incomplete_only=False,
@@ -1129,7 +1370,7 @@ async def generate_tasks_for_user(
         session=session
     )
 
-    if commit and not gen_result.llm_bypassed:
+    if commit:
         existing_tasks = commit_generated_tasks(
             new_tasks=new_tasks,
             existing_tasks=existing_tasks,
@@ -10,8 +10,10 @@ from ..dependencies import get_current_magic, get_session, get_secret_key, encry
 from ..dependencies import get_current_user as root_get_current_user
 from ..dependencies import is_magic_valid as root_is_magic_valid
 from ..dependencies import create_university_if_not_exists, get_fallback_providers
+from ..prompt_cache import prompt_cache
 from datetime import datetime, timedelta, timezone
 from pwdlib import PasswordHash
+from starlette.concurrency import run_in_threadpool
 PasswordHasher = PasswordHash.recommended()
 LOGIN_SESSION_EXPIRY = timedelta(weeks=4)
 router = APIRouter()
@@ -147,7 +149,7 @@ def login(
     }
 
 @router.get("/users/self", response_model = UserPublic)
-async def get_current_user(current_user : User = Depends(root_get_current_user)):
+def get_current_user(current_user : User = Depends(root_get_current_user)):
     """
     Obtain a UserPublic object representing the logged in user.
     """
@@ -168,7 +170,8 @@ async def is_magic_valid(
     Returns:
         Literal[True]: If magic is valid, returns True.
     """
-    user_public = UserPublic.model_validate(current_user)
+    # Reading the user's universities may lazy-load them through the sync Session
+    user_public = await run_in_threadpool(UserPublic.model_validate, current_user)
 
     university = user_public.actual_university_name
 
@@ -206,7 +209,7 @@ async def test_is_magic_valid(
     return True
 
 @router.get("/users/{username}", response_model = UserPublic)
-async def get_user_safe(
+def get_user_safe(
     username : str,
     current_user : User = Depends(root_get_current_user),
     session : Session = Depends(get_session)
@@ -231,7 +234,7 @@ async def get_user_safe(
     return get_user_unsafe(username, session)
 
 @router.get("/admins")
-async def do_admin_accounts_exist(
+def do_admin_accounts_exist(
     session : Session = Depends(get_session)
 ):
     """
@@ -248,6 +251,37 @@ async def do_admin_accounts_exist(
 
     return len(existing_admins) > 0
 
+def get_university_fallback_providers(
+    university_name : str | None,
+    session : Session
+) -> list[str]:
+    """
+    Create a university if it does not exist yet, and obtain
+    the names of its fallback providers (see ``get_fallback_providers``).
+
+    Args:
+        university_name (str | None): The university's name, if any.
+
+    Returns:
+        list[str]: The names of the fallback universities.
+    """
+    if university_name is not None:
+        create_university_if_not_exists(university_name, session=session)
+    return get_fallback_providers(university_name, session=session)
+
+def save_user(user : User, session : Session) -> User:
+    """
+    Save a new or modified user to the database,
+    and reload it with its generated fields.
+
+    Returns:
+        User: The saved user object.
+    """
+    session.add(user)
+    session.commit()
+    session.refresh(user)
+    return user
+
 @router.post("/users/admin", response_model = UserPublic)
 async def create_admin_user(
     data : UserCreate,
@@ -277,23 +311,23 @@ async def create_admin_user(
     if len(data.username) == 0 or len(data.password) == 0:
         raise HTTPException(status_code=400, detail="Username or password must not be empty")
     
-    existing_admins = session.exec(
-        select(User).where(User.admin == True)
-    ).all()
+    # The database (sync Session) and password hashing
+    # steps are run in the threadpool, since this route
+    # awaits the magic validation request to Canvas.
+    existing_admins = await run_in_threadpool(do_admin_accounts_exist, session=session)
 
     if existing_admins:
         raise HTTPException(status_code=401, detail="Unauthorised")
     
     extra_data = {
-        "password_hash" : PasswordHasher.hash(data.password),
+        "password_hash" : await run_in_threadpool(PasswordHasher.hash, data.password),
         "admin" : True
     }
     
     fallback_providers = []
 
     if data.university_name is not None:
-        create_university_if_not_exists(data.university_name, session=session)
-        fallback_providers = get_fallback_providers(data.university_name, session=session)
+        fallback_providers = await run_in_threadpool(get_university_fallback_providers, data.university_name, session)
 
     if data.magic is not None:
         extra_data["magic_hash"], extra_data["active_university_name"] = await encrypt_magic(
@@ -304,10 +338,7 @@ async def create_admin_user(
 
     user = User.model_validate(data, update = extra_data)
 
-    session.add(user)
-    session.commit()
-    session.refresh(user)
-    return user
+    return await run_in_threadpool(save_user, user, session)
 
 @router.post("/users", response_model = UserPublic)
 async def create_user(
@@ -338,9 +369,12 @@ async def create_user(
     if len(data.username) == 0 or len(data.password) == 0:
         raise HTTPException(status_code=400, detail="Username or password must not be empty")
 
-    existing_user = session.exec(
-        select(User).where(User.username == data.username)
-    ).first()
+    # See create_admin_user for why these steps run in the threadpool
+    existing_user = await run_in_threadpool(
+        lambda: session.exec(
+            select(User).where(User.username == data.username)
+        ).first()
+    )
     if existing_user is not None:
         raise HTTPException(
             status_code = 400,
@@ -348,13 +382,10 @@ async def create_user(
         )
 
     extra_data = {
-        "password_hash" : PasswordHasher.hash(data.password)
+        "password_hash" : await run_in_threadpool(PasswordHasher.hash, data.password)
     }
 
-    if data.university_name is not None:
-        create_university_if_not_exists(data.university_name, session=session)
-    
-    fallback_providers = get_fallback_providers(data.university_name, session=session)
+    fallback_providers = await run_in_threadpool(get_university_fallback_providers, data.university_name, session)
 
     if data.magic is not None:
         extra_data["magic_hash"], extra_data["active_university_name"] = await encrypt_magic(
@@ -365,10 +396,7 @@ async def create_user(
     
     user = User.model_validate(data, update = extra_data)
 
-    session.add(user)
-    session.commit()
-    session.refresh(user)
-    return user
+    return await run_in_threadpool(save_user, user, session)
 
 @router.patch("/users/self", response_model = UserPublic)
 async def update_user(
@@ -392,17 +420,17 @@ async def update_user(
     """
     new_data_dict = new_data.model_dump(exclude_none=True)
 
+    # See create_admin_user for why these steps run in the threadpool
     extra_data = {}
     if new_data.password is not None:
-        extra_data["password_hash"] = PasswordHasher.hash(new_data.password)
+        extra_data["password_hash"] = await run_in_threadpool(PasswordHasher.hash, new_data.password)
 
     university_name = user.university_name
 
     if new_data.university_name is not None:
-        create_university_if_not_exists(new_data.university_name, session=session)
         university_name = new_data.university_name
 
-    fallback_providers = get_fallback_providers(university_name, session=session)
+    fallback_providers = await run_in_threadpool(get_university_fallback_providers, university_name, session)
 
     if new_data.magic is not None:
         extra_data["magic_hash"], extra_data["active_university_name"] = await encrypt_magic(
@@ -412,9 +440,9 @@ async def update_user(
         ) 
     
     user.sqlmodel_update(new_data_dict, update=extra_data)
-    session.add(user)
-    session.commit()
-    session.refresh(user)
+    user = await run_in_threadpool(save_user, user, session)
+    # The university decides the Canvas URLs in the prompt
+    prompt_cache.invalidate(user.id)
     return user
 
 @router.delete("/users/{username}")
@@ -437,8 +465,10 @@ def delete_user(
     """
     if not current_user.admin: raise HTTPException(status_code=401, detail="Unauthorised")
     user : User = get_user_unsafe(username, session)
+    user_id = user.id
     session.delete(user)
     session.commit()
+    prompt_cache.invalidate(user_id)
     return True 
 
 @router.get("/bio/{username}", response_model=list[UserBiographyPublic])
@@ -544,7 +574,7 @@ def get_user_biography_text(
     return bios[0].content
 
 @router.delete("/bio/{id}", response_model=Literal[True])
-async def delete_user_bio(
+def delete_user_bio(
     id : int,
     user : User = Depends(get_current_user),
     session : Session = Depends(get_session)
@@ -555,6 +585,7 @@ async def delete_user_bio(
 
     session.delete(existing_bio)
     session.commit()
+    prompt_cache.invalidate(user.id, "biography")
     return True
 
 @router.post("/bio/self", response_model=UserBiographyPublic)
@@ -580,7 +611,9 @@ async def update_user_biography(
 
     from ..llm_api import update_user_bio
 
-    previous_biography = get_user_biography_text(
+    # The database steps run in the threadpool while the LLM is awaited
+    previous_biography = await run_in_threadpool(
+        get_user_biography_text,
         user=user,
         session=session
     )
@@ -588,7 +621,8 @@ async def update_user_biography(
     new_biography = await update_user_bio(
         new_information=new_information.content,
         previous_biography=previous_biography,
-        max_words=max_words
+        max_words=max_words,
+        user_id=user.id
     )
 
     update = {
@@ -600,8 +634,13 @@ async def update_user_biography(
 
     bio = UserBiography.model_validate(data, update=update)
 
-    session.add(bio)
-    session.commit()
-    session.refresh(bio)
+    def save_biography() -> UserBiography:
+        session.add(bio)
+        session.commit()
+        session.refresh(bio)
+        return bio
+
+    bio = await run_in_threadpool(save_biography)
+    prompt_cache.invalidate(user.id, "biography")
 
     return bio
@@ -53,9 +53,12 @@ pkgs.mkShell {
     sqlmodel
     sqlalchemy
     mariadb
+    aiomysql # Asynchronous MariaDB driver used by the read-only routes
     cryptography
     beautifulsoup4
     types-beautifulsoup4
+    httpx
+    h2 # HTTP/2 support for the pooled Canvas API clients
   ]))
   ];
 #   shellHook = ''
@@ -0,0 +1,251 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func, update
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from dotenv import load_dotenv
+from .models import Conversation, Message
+from .dependencies import get_async_engine
+from .prompt_cache import prompt_cache
+
+"""
+Background worker which summarises conversations.
+
+The summaries of a student's previous conversations are part of
+the system prompt. They used to be created while building the
+prompt, so the first reply of a new conversation waited for a
+whole extra LLM generation (the summary of the previous
+conversation). The system prompt now only reads stored summaries,
+and this worker creates them in the background:
+
+- When a student starts a new conversation, their previous
+  conversations without a summary are queued (see ``enqueue``).
+- Every SUMMARY_SCAN_INTERVAL seconds, conversations without a
+  summary whose last message is older than SUMMARY_IDLE_SECONDS
+  are queued.
+
+Conversations are summarised one at a time, so the worker never
+takes more than one LLM slot away from chat replies.
+
+NOTE: Each worker process runs its own summary worker. If the API
+runs in several processes, set SUMMARY_WORKER_ENABLED to "false"
+in all but one of them to avoid summarising a conversation twice.
+"""
+
+load_dotenv()
+
+# Summary worker settings. These can be overridden in the .env file.
+SUMMARY_WORKER_ENABLED = os.environ.get("SUMMARY_WORKER_ENABLED", "true").lower() == "true"
+SUMMARY_IDLE_SECONDS = float(os.environ.get("SUMMARY_IDLE_SECONDS", 60 * 30))
+SUMMARY_SCAN_INTERVAL = float(os.environ.get("SUMMARY_SCAN_INTERVAL", 60))
+SUMMARY_SCAN_LIMIT = int(os.environ.get("SUMMARY_SCAN_LIMIT", 20))
+SUMMARY_RETRY_SECONDS = float(os.environ.get("SUMMARY_RETRY_SECONDS", 60 * 15))
+SUMMARY_MAX_WORDS = int(os.environ.get("SUMMARY_MAX_WORDS", 200))
+
+logger = logging.getLogger(__name__)
+
+class SummaryWorker:
+    """
+    Summarises queued conversations in the background
+    and stores their summaries in ``Conversation.summary``.
+
+    Args:
+        idle_seconds (float, optional): How long a conversation must be inactive before it is summarised by a scan. Defaults to SUMMARY_IDLE_SECONDS.
+        scan_interval (float, optional): Seconds between scans for idle conversations. Defaults to SUMMARY_SCAN_INTERVAL.
+        scan_limit (int, optional): Maximum number of conversations queued by each scan. Defaults to SUMMARY_SCAN_LIMIT.
+        retry_seconds (float, optional): Seconds before a conversation which failed to be summarised is tried again. Defaults to SUMMARY_RETRY_SECONDS.
+        max_words (int, optional): Summary word limit. Defaults to SUMMARY_MAX_WORDS.
+    """
+
+    def __init__(
+        self,
+        idle_seconds : float = SUMMARY_IDLE_SECONDS,
+        scan_interval : float = SUMMARY_SCAN_INTERVAL,
+        scan_limit : int = SUMMARY_SCAN_LIMIT,
+        retry_seconds : float = SUMMARY_RETRY_SECONDS,
+        max_words : int = SUMMARY_MAX_WORDS
+    ):
+        self.idle_seconds = idle_seconds
+        self.scan_interval = scan_interval
+        self.scan_limit = scan_limit
+        self.retry_seconds = retry_seconds
+        self.max_words = max_words
+
+        self._queue : asyncio.Queue[int] | None = None
+        self._queued : set[int] = set()
+        self._failed_at : dict[int, float] = {}
+        self._tasks : list[asyncio.Task] = []
+
+        self.summarised = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        """
+        Start summarising conversations (call from the app's lifespan).
+        """
+        if self.running: return
+        self._queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._work()),
+            asyncio.create_task(self._scan())
+        ]
+
+    async def stop(self):
+        """
+        Stop summarising conversations. A summary which
+        is being generated is discarded.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        self._queued.clear()
+
+    def enqueue(self, *conversation_ids : int):
+        """
+        Queue conversations to be summarised. Conversations
+        which are already queued are not queued twice.
+        """
+        if self._queue is None: return
+        for conversation_id in conversation_ids:
+            if conversation_id in self._queued: continue
+            self._queued.add(conversation_id)
+            self._queue.put_nowait(conversation_id)
+
+    async def _work(self):
+        while True:
+            conversation_id = await self._queue.get()
+            self._queued.discard(conversation_id)
+            try:
+                await self.summarise_conversation(conversation_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                self._failed_at[conversation_id] = time.monotonic()
+                logger.exception("Could not summarise conversation %d", conversation_id)
+
+    async def _scan(self):
+        while True:
+            await asyncio.sleep(self.scan_interval)
+            try:
+                self.enqueue(*await self.get_idle_conversation_ids())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Could not scan for idle conversations")
+
+    async def get_idle_conversation_ids(self) -> list[int]:
+        """
+        Obtain the conversations without a summary whose last message
+        is older than ``idle_seconds`` (most recently active first),
+        except conversations which recently failed to be summarised.
+        """
+        idle_since = datetime.now(timezone.utc) - timedelta(seconds=self.idle_seconds)
+
+        last_messages = (
+            select(
+                Message.conversation_id,
+                func.max(Message.created_at).label("last_message_at")
+            )
+            .group_by(Message.conversation_id)
+            .subquery()
+        )
+
+        async with AsyncSession(get_async_engine()) as session:
+            conversation_ids = await session.exec(
+                select(Conversation.id)
+                .join(last_messages, last_messages.c.conversation_id == Conversation.id)
+                .where(Conversation.summary == None)
+                .where(last_messages.c.last_message_at < idle_since)
+                .order_by(last_messages.c.last_message_at.desc())
+                .limit(self.scan_limit + len(self._failed_at))
+            )
+            conversation_ids = conversation_ids.all()
+
+        now = time.monotonic()
+        self._failed_at = {
+            conversation_id : failed_at for conversation_id, failed_at in self._failed_at.items()
+            if now - failed_at < self.retry_seconds
+        }
+        return [c for c in conversation_ids if c not in self._failed_at][:self.scan_limit]
+
+    async def summarise_conversation(self, conversation_id : int):
+        """
+        Summarise a conversation and store its summary,
+        unless it has already been summarised.
+
+        The session is closed while the LLM generates the summary, so that
+        it does not hold a database connection for the whole generation.
+        The summary is then only stored if the conversation still has no
+        summary and the same last message, since the student may have
+        replied (or the conversation may have been summarised elsewhere)
+        in the meantime. A discarded summary is generated again once the
+        conversation is idle again.
+        """
+        # Imported lazily to avoid circular imports (llm_api → routers → this module).
+        from .llm_api import summarise
+
+        async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+            conversation = await session.get(
+                Conversation, conversation_id,
+                options=[selectinload(Conversation.messages)]
+            )
+            if not conversation or conversation.summary or not conversation.messages:
+                return
+
+            user_id = conversation.user_id
+            last_message_id = max(message.id for message in conversation.messages)
+            messages = [
+                {"role" : message.role, "content" : message.content}
+                for message in conversation.messages
+            ]
+
+        summary = await summarise(
+            chat_message_log=messages,
+            max_words=self.max_words,
+            user_id=user_id,
+            conversation_id=conversation_id
+        )
+
+        async with AsyncSession(get_async_engine()) as session:
+            result = await session.execute(
+                update(Conversation)
+                .where(Conversation.id == conversation_id)
+                .where(Conversation.summary == None)
+                .where(
+                    select(func.max(Message.id))
+                    .where(Message.conversation_id == conversation_id)
+                    .scalar_subquery() == last_message_id
+                )
+                .values(summary=summary)
+            )
+            await session.commit()
+
+        if result.rowcount == 0:
+            logger.info("Discarded the summary of conversation %d, which changed while it was summarised", conversation_id)
+            return
+
+        self.summarised += 1
+        self._failed_at.pop(conversation_id, None)
+        prompt_cache.invalidate(user_id, "history")
+
+    def stats(self) -> dict:
+        return {
+            "running" : self.running,
+            "queued" : len(self._queued),
+            "summarised" : self.summarised,
+            "failed" : self.failed,
+            "retry_pending" : len(self._failed_at)
+        }
+
+summary_worker = SummaryWorker()
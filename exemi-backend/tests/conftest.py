@@ -0,0 +1,22 @@
+import os
+import sys
+
+"""
+Settings for running the tests without a database or Ollama server.
+
+The backend is a package (with relative imports), so it is imported
+from the repository's root like ``fastapi dev main.py`` does, e.g.,
+``importlib.import_module("exemi-backend.llm_api")``.
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# The engines are created on import, but never connect in these tests
+for name in ("DB_USER", "DB_PASS", "DB_HOST", "DB_NAME"):
+    os.environ.setdefault(name, "test")
+os.environ.setdefault("SECRET_KEY", "test")
+
+# Use the scripted fake LLM (see llm_fake.py)
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("LLM_MODEL", "fake")
+os.environ.setdefault("LLM_API_URL", "http://localhost:11434")
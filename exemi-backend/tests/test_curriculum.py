@@ -0,0 +1,94 @@
+import importlib
+from datetime import datetime, timedelta, timezone
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+models = importlib.import_module("exemi-backend.models")
+curriculum = importlib.import_module("exemi-backend.routers.curriculum")
+query_profiler = importlib.import_module("exemi-backend.query_profiler")
+
+# How many assignments each unit has
+ASSIGNMENTS_PER_UNIT = 3
+
+def create_student(unit_count : int) -> tuple:
+    """
+    Create an in-memory database with a student enrolled in
+    ``unit_count`` active units, each with a few incomplete assignments.
+
+    Returns:
+        engine (Engine): The database's engine, attached to the query profiler.
+        user_id (int): The student's ID.
+    """
+    engine = create_engine("sqlite://", connect_args={"check_same_thread" : False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    now = datetime.now(timezone.utc)
+
+    with Session(engine) as session:
+        university = models.University(name="Test University")
+        user = models.User(username="student", password_hash="x", university_name=university.name)
+        term = models.Term(
+            name="Semester 1",
+            canvas_id=1,
+            university_name=university.name,
+            start_at=now - timedelta(days=30),
+            end_at=now + timedelta(days=60)
+        )
+        session.add_all([university, user, term])
+        session.flush()
+
+        for u in range(unit_count):
+            unit = models.Unit(name=f"UNIT{u}", canvas_id=100 + u, term_id=term.id, apply_assignment_group_weights=False)
+            session.add(unit)
+            session.flush()
+            session.add(models.UsersUnits(user_id=user.id, unit_id=unit.id))
+
+            group = models.AssignmentGroup(name="Assessments", canvas_id=1000 + u, unit_id=unit.id, group_weight=100)
+            session.add(group)
+            session.flush()
+
+            for a in range(ASSIGNMENTS_PER_UNIT):
+                assignment = models.Assignment(
+                    name=f"Assignment {a}",
+                    canvas_id=10000 + u * 100 + a,
+                    group_id=group.id,
+                    due_at=now + timedelta(days=a + 1),
+                    points=10,
+                    is_group=False
+                )
+                session.add(assignment)
+                session.flush()
+                session.add(models.UsersAssignments(user_id=user.id, assignment_id=assignment.id))
+
+        session.commit()
+        user_id = user.id
+
+    query_profiler.query_profiler.attach(engine)
+    return engine, user_id
+
+def count_payload_queries(unit_count : int) -> int:
+    """
+    Build a student's assignments payload and count the statements it sent.
+    """
+    engine, user_id = create_student(unit_count)
+
+    with Session(engine) as session:
+        user = session.get(models.User, user_id)
+        user_university_name = user.actual_university_name
+
+        with query_profiler.assert_query_budget(1) as stats:
+            payload = curriculum.build_assignments_payload(user=user, session=session)
+
+    assert user_university_name is not None
+    assert len(payload) == unit_count
+    assert all(len(unit.assignments) == ASSIGNMENTS_PER_UNIT for unit in payload)
+    return stats.queries
+
+def test_assignments_payload_queries_do_not_grow_with_units():
+    """
+    The assignments payload must be built with the same number of
+    statements however many units the student is enrolled in, i.e.,
+    without a query (or lazy load) for each unit or assignment.
+    """
+    one_unit_queries = count_payload_queries(1)
+    assert one_unit_queries > 0
+    assert count_payload_queries(10) == one_unit_queries
@@ -0,0 +1,106 @@
+import time
+import asyncio
+import importlib
+from fastapi import BackgroundTasks
+
+models = importlib.import_module("exemi-backend.models")
+llm_api = importlib.import_module("exemi-backend.llm_api")
+llm_fake = importlib.import_module("exemi-backend.llm_fake")
+llm_scheduler = importlib.import_module("exemi-backend.llm_scheduler")
+
+# How long the background LLM call (a conversation summary) takes
+SUMMARY_SECONDS = 1.0
+# The longest allowed pause between two chunks of a chat reply
+MAX_CHUNK_GAP_SECONDS = 0.25
+
+def test_chat_stream_is_not_blocked_by_background_llm_calls(monkeypatch):
+    """
+    A chat reply must keep streaming while a slow background LLM call
+    (a conversation summary) runs. A call which blocks the event loop
+    (e.g., ``invoke`` instead of ``ainvoke``) would pause every chat
+    stream until the summary is complete.
+    """
+    async def save_llm_telemetry(telemetry, message_id=None): pass
+    monkeypatch.setattr(llm_api, "save_llm_telemetry", save_llm_telemetry)
+    # Both calls get an LLM slot straight away
+    monkeypatch.setattr(llm_api, "llm_scheduler", llm_scheduler.LLMScheduler(max_concurrency=2))
+
+    # summarise uses the (slow) model, and the chat agent a fast streaming model
+    monkeypatch.setattr(llm_api, "model", llm_fake.ScriptedChatModel(
+        first_token_seconds=SUMMARY_SECONDS,
+        tokens_per_second=1000,
+        response_words=5
+    ))
+    monkeypatch.setattr(llm_api, "agent", llm_api.create_chat_agent(llm_fake.ScriptedChatModel(
+        first_token_seconds=0.05,
+        tokens_per_second=50,
+        response_words=20
+    )))
+
+    user = models.User(id=1, username="student", password_hash="x")
+
+    async def stream_during_summary() -> tuple[list[float], bool]:
+        summary = asyncio.create_task(llm_api.summarise(
+            chat_message_log=[{"role" : "user", "content" : "hello"}],
+            user_id=2
+        ))
+        await asyncio.sleep(0) # Start the summary first
+
+        chunk_times = [time.monotonic()]
+        async for chunk in llm_api.chat_stream(
+            messages=[{"role" : "user", "content" : "hello"}],
+            background_tasks=BackgroundTasks(),
+            user=user,
+            magic="magic",
+            session=None,
+            system_prompt="You are a study assistant."
+        ):
+            chunk_times.append(time.monotonic())
+
+        summary_running = not summary.done()
+        assert await summary
+        return chunk_times, summary_running
+
+    chunk_times, summary_running = asyncio.run(stream_during_summary())
+    gaps = [later - earlier for earlier, later in zip(chunk_times, chunk_times[1:])]
+
+    assert summary_running
+    assert len(gaps) > 10
+    assert max(gaps) < MAX_CHUNK_GAP_SECONDS
+
+# How many chat calls the agent benchmark makes
+BENCHMARK_CALLS = 20
+
+def test_compiling_the_agent_once_is_faster_than_per_call(monkeypatch):
+    """
+    Micro-benchmark of the chat agent's graph construction: compiling
+    the agent for every call (as chat_stream used to) against reusing
+    the agent compiled on import (``llm_api.agent``).
+    """
+    llm_tools = importlib.import_module("exemi-backend.llm_tools")
+    monkeypatch.setattr(llm_api, "llm_scheduler", llm_scheduler.LLMScheduler(max_concurrency=1))
+
+    model = llm_fake.ScriptedChatModel(first_token_seconds=0, tokens_per_second=1_000_000, response_words=5)
+    context = llm_tools.AgentContext(
+        user=models.User(id=1, username="student", password_hash="x"),
+        system_prompt="You are a study assistant."
+    )
+    messages = [{"role" : "user", "content" : "hello"}]
+
+    async def call(agent):
+        response = await agent.ainvoke({"messages" : messages}, context=context)
+        assert response["messages"][-1].content
+
+    async def benchmark(compile_per_call : bool) -> float:
+        agent = llm_api.create_chat_agent(model)
+        await call(agent) # Warm up
+        started_at = time.perf_counter()
+        for _ in range(BENCHMARK_CALLS):
+            await call(llm_api.create_chat_agent(model) if compile_per_call else agent)
+        return (time.perf_counter() - started_at) / BENCHMARK_CALLS
+
+    before = asyncio.run(benchmark(compile_per_call=True))
+    after = asyncio.run(benchmark(compile_per_call=False))
+    print(f"Per chat call: {before * 1000:.2f}ms compiling the agent each time, {after * 1000:.2f}ms reusing it")
+
+    assert after < before